@@ -0,0 +1,159 @@
+"""
+Audit log retention
+Events older than AUDIT_RETENTION_DAYS are moved out of MongoDB one calendar
+month at a time: the month is exported to a gzip-compressed JSON Lines file
+(audit_logs-YYYY-MM.jsonl.gz in AUDIT_ARCHIVE_DIR, extended JSON so dates
+and ids round-trip), the file is checked against the month's count, and only
+then is the month deleted. Only whole months past the cutoff are archived.
+
+The TTL index on `timestamp` (see indexes.py) is a backstop that expires
+events AUDIT_TTL_GRACE_DAYS after the retention window, should archiving stop
+running; AUDIT_TTL_GRACE_DAYS=0 disables it.
+
+Runs daily from cron_jobs.py, or: python audit_archive.py [--dry-run]
+"""
+import argparse
+import asyncio
+import gzip
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import json_util
+from bson.json_util import JSONOptions, JSONMode
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).parent
+
+AUDIT_RETENTION_DAYS = int(os.getenv('AUDIT_RETENTION_DAYS', 365))
+AUDIT_TTL_GRACE_DAYS = int(os.getenv('AUDIT_TTL_GRACE_DAYS', 30))
+AUDIT_ARCHIVE_DIR = Path(os.getenv('AUDIT_ARCHIVE_DIR', ROOT_DIR / 'archives' / 'audit_logs'))
+AUDIT_ARCHIVE_BATCH_SIZE = 1000
+
+# TTL of the timestamp_ttl index; a TTL of ~68 years effectively disables it
+AUDIT_TTL_SECONDS = (
+    (AUDIT_RETENTION_DAYS + AUDIT_TTL_GRACE_DAYS) * 86400 if AUDIT_TTL_GRACE_DAYS > 0 else 2**31 - 1
+)
+
+_JSON_OPTIONS = JSONOptions(json_mode=JSONMode.RELAXED, tz_aware=True)
+
+
+def month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def next_month(value: datetime) -> datetime:
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def months_to_archive(oldest: Optional[datetime], cutoff: datetime) -> List[Tuple[datetime, datetime]]:
+    """[(start, end)] of every whole month from `oldest` that ends before `cutoff`"""
+    if oldest is None:
+        return []
+    if oldest.tzinfo is None:
+        oldest = oldest.replace(tzinfo=timezone.utc)
+    months = []
+    start = month_start(oldest)
+    while next_month(start) <= cutoff:
+        months.append((start, next_month(start)))
+        start = next_month(start)
+    return months
+
+
+def archive_path(archive_dir: Path, start: datetime) -> Path:
+    """File for a month; a month archived again (events written late) gets a new part"""
+    path = archive_dir / f"audit_logs-{start:%Y-%m}.jsonl.gz"
+    part = 2
+    while path.exists():
+        path = archive_dir / f"audit_logs-{start:%Y-%m}.{part}.jsonl.gz"
+        part += 1
+    return path
+
+
+def _write_lines(out, docs: List[Dict[str, Any]]):
+    out.write("".join(json_util.dumps(doc, json_options=_JSON_OPTIONS) + "\n" for doc in docs))
+
+
+async def archive_month(db, start: datetime, end: datetime, archive_dir: Path, dry_run: bool = False) -> Dict[str, Any]:
+    """Export one month to a gzip file, then delete it from the collection"""
+    month_filter = {"timestamp": {"$gte": start, "$lt": end}}
+    expected = await db.audit_logs.count_documents(month_filter)
+    result = {"month": f"{start:%Y-%m}", "events": expected, "file": None, "deleted": 0}
+    if expected == 0 or dry_run:
+        return result
+
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    path = archive_path(archive_dir, start)
+    tmp_path = path.with_name(path.name + ".tmp")
+
+    written = 0
+    cursor = db.audit_logs.find(month_filter).sort("timestamp", 1)
+    out = await asyncio.to_thread(gzip.open, tmp_path, "wt", encoding="utf-8")
+    try:
+        while True:
+            batch = await cursor.to_list(AUDIT_ARCHIVE_BATCH_SIZE)
+            if not batch:
+                break
+            await asyncio.to_thread(_write_lines, out, batch)
+            written += len(batch)
+    finally:
+        await asyncio.to_thread(out.close)
+
+    if written < expected:
+        await asyncio.to_thread(tmp_path.unlink)
+        raise RuntimeError(f"Archive of {start:%Y-%m} incomplete: {written} of {expected} events")
+    await asyncio.to_thread(os.replace, tmp_path, path)
+
+    deleted = await db.audit_logs.delete_many(month_filter)
+    result.update(file=str(path), events=written, deleted=deleted.deleted_count)
+    return result
+
+
+async def archive_audit_logs(
+    db,
+    retention_days: int = AUDIT_RETENTION_DAYS,
+    archive_dir: Path = AUDIT_ARCHIVE_DIR,
+    dry_run: bool = False,
+    now: Optional[datetime] = None
+) -> List[Dict[str, Any]]:
+    """Archive and delete every whole month older than the retention window"""
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=retention_days)
+    # Only dates: BSON sorts strings first, and events not yet converted by
+    # migrate_dates.py are not matched by the month filters either
+    oldest = await db.audit_logs.find_one({"timestamp": {"$type": "date"}}, {"timestamp": 1}, sort=[("timestamp", 1)])
+    months = months_to_archive(oldest.get("timestamp") if oldest else None, cutoff)
+
+    results = []
+    for start, end in months:
+        results.append(await archive_month(db, start, end, archive_dir, dry_run=dry_run))
+    return results
+
+
+async def main():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Archive and delete audit logs past the retention window")
+    parser.add_argument("--retention-days", type=int, default=AUDIT_RETENTION_DAYS)
+    parser.add_argument("--archive-dir", type=Path, default=AUDIT_ARCHIVE_DIR)
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be archived")
+    args = parser.parse_args()
+
+    load_dotenv(ROOT_DIR / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+
+    print(f"🔄 Archiving audit logs older than {args.retention_days} days to {args.archive_dir}")
+    print("=" * 50)
+    results = await archive_audit_logs(db, args.retention_days, args.archive_dir, dry_run=args.dry_run)
+    for result in results:
+        target = "(dry run)" if args.dry_run else result["file"]
+        print(f"✓ {result['month']}: {result['events']} events -> {target}")
+    if not results:
+        print("✅ Nothing to archive")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,16 +1,151 @@
 """
 Audit Logging System
 Tracks all critical operations for security and compliance
+
+Events are written through AuditSink: AuditLogger.log only appends the event
+to a bounded in-memory buffer and a background task writes the buffer with
+insert_many, every AUDIT_FLUSH_INTERVAL seconds or as soon as
+AUDIT_BATCH_SIZE events are waiting. The buffer is flushed on shutdown.
+
+Overflow policy: when AUDIT_QUEUE_SIZE events are already waiting, a new
+'info'/'warning' event is dropped and counted in `dropped`; a 'critical'
+event is written directly instead, so it is never lost to overflow.
+Before the sink is started (scripts, tests) events are written directly.
 """
 
+from collections import deque
 from datetime import datetime, timezone
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
+import asyncio
+import os
 import uuid
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import BulkWriteError
 import logging
 
+from pagination import fetch_page, InvalidCursor
+
 logger = logging.getLogger(__name__)
 
+AUDIT_QUEUE_SIZE = int(os.getenv('AUDIT_QUEUE_SIZE', 10_000))
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', 200))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', 1.0))
+
+
+class AuditSink:
+    """Buffered writer for audit events (see module docstring)"""
+
+    def __init__(
+        self,
+        max_queue: int = AUDIT_QUEUE_SIZE,
+        batch_size: int = AUDIT_BATCH_SIZE,
+        flush_interval: float = AUDIT_FLUSH_INTERVAL
+    ):
+        self.max_queue = max(1, max_queue)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._buffer: deque = deque()
+        self._db: Optional[AsyncIOMotorDatabase] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._closing = False
+
+        # Metrics
+        self.written = 0
+        self.dropped = 0
+        self.direct = 0
+        self.batches = 0
+        self.write_errors = 0
+        self.lost = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, db: AsyncIOMotorDatabase):
+        """Start the background writer (called from app startup)"""
+        if self.running:
+            return
+        self._db = db
+        self._closing = False
+        self._batch_ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer and flush everything still buffered"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._batch_ready.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self._flush()
+
+    async def submit(self, db: AsyncIOMotorDatabase, event: Dict[str, Any]):
+        """Buffer an event; writes directly when not running or for critical overflow"""
+        if not self.running:
+            await self._write_direct(db, event)
+            return
+        if len(self._buffer) >= self.max_queue:
+            if event.get("severity") == "critical":
+                await self._write_direct(db, event)
+            else:
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 1000 == 0:
+                    logger.warning(f"Audit buffer full: {self.dropped} events dropped so far")
+            return
+        self._buffer.append(event)
+        if len(self._buffer) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def _write_direct(self, db: AsyncIOMotorDatabase, event: Dict[str, Any]):
+        await db.audit_logs.insert_one(event)
+        self.direct += 1
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self._flush()
+
+    async def _flush(self):
+        while self._buffer:
+            batch: List[Dict[str, Any]] = []
+            while self._buffer and len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+            try:
+                await self._db.audit_logs.insert_many(batch, ordered=False)
+                self.written += len(batch)
+                self.batches += 1
+            except Exception as e:
+                # Don't retry forever: a failing batch is logged and counted
+                inserted = e.details.get("nInserted", 0) if isinstance(e, BulkWriteError) else 0
+                self.written += inserted
+                self.write_errors += 1
+                self.lost += len(batch) - inserted
+                logger.error(f"Failed to write {len(batch)} audit logs: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "queued": len(self._buffer),
+            "max_queue": self.max_queue,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "written": self.written,
+            "batches": self.batches,
+            "direct": self.direct,
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+            "lost": self.lost,
+        }
+
+
+audit_sink = AuditSink()
+
 
 class AuditLogger:
     """Audit logger for tracking critical operations"""
@@ -45,7 +180,7 @@ class AuditLogger:
         try:
             audit_log = {
                 "id": str(uuid.uuid4()),
-                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "timestamp": datetime.now(timezone.utc),
                 "action": action,
                 "actor": {
                     "id": actor_id,
@@ -61,7 +196,7 @@ class AuditLogger:
                 "severity": severity
             }
             
-            await db.audit_logs.insert_one(audit_log)
+            await audit_sink.submit(db, audit_log)
             
             # Log critical actions to system logger as well
             if severity == "critical":
@@ -79,9 +214,34 @@ class AuditLogger:
         action: Optional[str] = None,
         severity: Optional[str] = None,
         limit: int = 100,
-        skip: int = 0
+        skip: int = 0,
+        cursor: Optional[str] = None
     ) -> list:
-        """Query audit logs with filters"""
+        """
+        Query audit logs with filters, newest first
+        Pass `cursor` (see get_logs_page) to page without skip
+        """
+        logs, _ = await AuditLogger.get_logs_page(
+            db, actor_id=actor_id, target_id=target_id, action=action,
+            severity=severity, limit=limit, skip=skip, cursor=cursor
+        )
+        return logs
+    
+    @staticmethod
+    async def get_logs_page(
+        db: AsyncIOMotorDatabase,
+        actor_id: Optional[str] = None,
+        target_id: Optional[str] = None,
+        action: Optional[str] = None,
+        severity: Optional[str] = None,
+        limit: int = 100,
+        skip: int = 0,
+        cursor: Optional[str] = None
+    ) -> Tuple[list, Optional[str]]:
+        """
+        Like get_logs, also returning the cursor of the next page (None on the last page)
+        A cursor that was not produced here raises InvalidCursor (a 400 for API callers).
+        """
         try:
             query = {}
             
@@ -94,15 +254,12 @@ class AuditLogger:
             if severity:
                 query["severity"] = severity
             
-            logs = await db.audit_logs.find(
-                query,
-                {"_id": 0}
-            ).sort("timestamp", -1).skip(skip).limit(limit).to_list(limit)
-            
-            return logs
+            return await fetch_page(db.audit_logs, query, "timestamp", limit, cursor=cursor, offset=skip)
+        except InvalidCursor:
+            raise
         except Exception as e:
             logger.error(f"Failed to query audit logs: {e}")
-            return []
+            return [], None
     
     @staticmethod
     async def get_user_activity(
@@ -113,7 +270,7 @@ class AuditLogger:
         """Get activity summary for a user"""
         try:
             from datetime import timedelta
-            cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+            cutoff = datetime.now(timezone.utc) - timedelta(days=days)
             
             pipeline = [
                 {
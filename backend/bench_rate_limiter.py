@@ -0,0 +1,74 @@
+"""
+Microbenchmark for the rate limiter
+Measures decisions per second with requests spread over many distinct IPs.
+
+Usage: python bench_rate_limiter.py [--ips 10000] [--requests 1000000] [--max-keys 100000]
+                                    [--backend memory|shm]
+"""
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+
+from rate_limit_store import MemoryStore, SharedMemoryStore
+from rate_limiter import RateLimiter
+
+
+def make_store(backend: str, max_keys: int):
+    if backend == "shm":
+        store = SharedMemoryStore(name="walreef_rate_limits_bench", slots=max_keys)
+        store.unlink()
+        return store
+    return MemoryStore(max_keys=max_keys)
+
+
+async def run(ips: int, requests: int, max_keys: int, backend: str):
+    limiter = RateLimiter(make_store(backend, max_keys))
+    addresses = [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in range(ips)]
+    endpoints = list(limiter.limits.keys())
+    rng = random.Random(42)
+    workload = [(rng.choice(addresses), rng.choice(endpoints)) for _ in range(requests)]
+
+    async def replay(limiter):
+        now = time.time()
+        allowed = 0
+        for i, (ip, endpoint) in enumerate(workload):
+            # Spread the workload over ten simulated minutes
+            if (await limiter.hit(ip, endpoint, now=now + i * 600 / requests)).allowed:
+                allowed += 1
+        return allowed
+
+    start = time.perf_counter()
+    allowed = await replay(limiter)
+    elapsed = time.perf_counter() - start
+
+    # Memory is measured on a second run; tracing slows the timed run down
+    tracemalloc.start()
+    await replay(RateLimiter(make_store(backend, max_keys)))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if backend == "shm":
+        limiter.store.unlink()
+
+    print("🔄 Rate limiter benchmark")
+    print("=" * 50)
+    print(f"Backend:             {backend}")
+    print(f"Distinct IPs:        {ips:,}")
+    print(f"Decisions:           {requests:,} ({allowed:,} allowed)")
+    print(f"Decisions/second:    {requests / elapsed:,.0f}")
+    print(f"Mean decision:       {elapsed / requests * 1e6:.2f} µs")
+    if backend == "memory":
+        store = limiter.store
+        print(f"Keys kept:           {len(store.windows):,} (cap {max_keys:,}, evicted {store.evicted:,})")
+    print(f"Peak traced memory:  {peak / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rate limiter microbenchmark")
+    parser.add_argument("--ips", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=1_000_000)
+    parser.add_argument("--max-keys", type=int, default=100_000)
+    parser.add_argument("--backend", choices=["memory", "shm"], default="memory")
+    args = parser.parse_args()
+    asyncio.run(run(args.ips, args.requests, args.max_keys, args.backend))
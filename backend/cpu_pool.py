@@ -0,0 +1,144 @@
+"""
+Bounded worker pool for CPU-heavy work
+Keeps work such as bcrypt off the event loop so a burst of logins does not
+stall every other request (e.g. POS redemptions). bcrypt releases the GIL,
+so worker threads run it in parallel on all cores.
+
+Usage:
+    result = await cpu_pool.run(func, *args)
+    hashed = await hash_password(password)
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import bcrypt
+
+# Workers default to the number of cores
+CPU_POOL_WORKERS = int(os.getenv('CPU_POOL_WORKERS', os.cpu_count() or 1))
+# Jobs allowed to wait for a worker; more are rejected with CPUPoolBusy
+CPU_POOL_MAX_QUEUE = int(os.getenv('CPU_POOL_MAX_QUEUE', CPU_POOL_WORKERS * 16))
+
+
+class CPUPoolBusy(Exception):
+    """Raised when the pool queue is full"""
+
+
+class CPUPool:
+    def __init__(self, workers: int = CPU_POOL_WORKERS, max_queue: int = CPU_POOL_MAX_QUEUE):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Counters are updated from the event loop and from worker threads
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.running = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._total_wait = 0.0
+        self._total_run = 0.0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cpu-pool")
+        return self._executor
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Run func(*args) on a worker thread and await its result"""
+        with self._lock:
+            if self.running + self.queued >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise CPUPoolBusy("CPU pool queue is full")
+            self.submitted += 1
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+
+        submitted_at = time.perf_counter()
+        state = {"started": False, "abandoned": False}
+
+        def job():
+            with self._lock:
+                if state["abandoned"]:
+                    return None
+                state["started"] = True
+                self.queued -= 1
+                self.running += 1
+                self._total_wait += time.perf_counter() - submitted_at
+            started_at = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self._total_run += time.perf_counter() - started_at
+
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._get_executor(), job)
+        except BaseException:
+            with self._lock:
+                if state["started"]:
+                    self.failed += 1
+                else:
+                    # Cancelled while still queued: the worker will skip it
+                    state["abandoned"] = True
+                    self.queued -= 1
+            raise
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "queued": self.queued,
+            "peak_queued": self.peak_queued,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self._total_wait / finished * 1000, 2) if finished else 0,
+            "avg_run_ms": round(self._total_run / finished * 1000, 2) if finished else 0,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+cpu_pool = CPUPool()
+
+
+async def run_cpu_bound(func: Callable[..., Any], *args: Any) -> Any:
+    """Run CPU-heavy func(*args) in the shared pool"""
+    return await cpu_pool.run(func, *args)
+
+
+def _hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+
+def _verify_password(password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+async def hash_password(password: str) -> str:
+    """bcrypt hash of a password, computed off the event loop"""
+    return await run_cpu_bound(_hash_password, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    """Check a password against its bcrypt hash, off the event loop"""
+    return await run_cpu_bound(_verify_password, password, hashed_password)
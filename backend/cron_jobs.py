@@ -3,10 +3,13 @@ Cron Jobs for Al-Reef Loyalty System
 - Token refresh (every 55 minutes)
 - Invoice sync (every 15 minutes)
 - Points expiry check (daily)
+- Audit log archiving (daily)
 """
 import asyncio
 import sys
 import os
+import time
+from collections import deque
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -15,20 +18,190 @@ from dotenv import load_dotenv
 # Add parent directory to path
 sys.path.append(str(Path(__file__).parent))
 
-from rewaa import rewaa_service
-from models import Invoice, PointsTransaction
+from rewaa import rewaa_service, RewaaUnavailable
+from models import Customer, Invoice, PointsTransaction, parse_datetime
 from utils import format_phone_for_twilio
 from email_service import send_sync_failure_notification
-import uuid
+from sync_commit import InvoiceCommitBuffer, invoice_id, invoice_transaction_id
+from indexes import ensure_indexes
+from daily_stats import record_stats
+from customer_search import search_fields
+from audit_archive import archive_audit_logs
+from points_expiry import expire_points
+from points_lots import ensure_lots_backfilled
+from ledger_outbox import drain_pending_ledger
+from settings_cache import settings_cache
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
+# Windowed invoice fetching: how many invoice numbers are requested ahead of
+# the commit point, and how many of those requests may be in flight at once.
+# SYNC_WINDOW_SIZE=1 and SYNC_CONCURRENCY=1 give the old one-at-a-time sync.
+SYNC_WINDOW_SIZE = int(os.getenv('SYNC_WINDOW_SIZE', 20))
+SYNC_CONCURRENCY = int(os.getenv('SYNC_CONCURRENCY', 5))
+
+class InvoiceWindowFetcher:
+    """
+    Fetch a sliding window of invoice numbers from Rewaa concurrently.
+    
+    Results are handed out strictly in invoice-number order, so the sync loop
+    still commits invoices one by one and last_synced_invoice only ever moves
+    past a contiguous prefix. A fetch that fails for a reason other than 404
+    raises RewaaUnavailable from next() once its retries are used up.
+    on_fetched, if given, is called with each invoice as soon as it arrives,
+    so work for it can start before the loop reaches it.
+    """
+    
+    def __init__(self, start_number: int, window_size: int = SYNC_WINDOW_SIZE, concurrency: int = SYNC_CONCURRENCY,
+                 on_fetched=None):
+        self.next_number = start_number
+        self.on_fetched = on_fetched
+        self.window_size = max(1, window_size)
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.pending = deque()  # (invoice_number, task) in invoice-number order
+        self.fetched_count = 0
+    
+    async def _fetch(self, invoice_number: int):
+        async with self.semaphore:
+            invoice_data = await rewaa_service.get_invoice_by_number(invoice_number)
+        if invoice_data and self.on_fetched:
+            self.on_fetched(invoice_data)
+        return invoice_data
+    
+    def _fill_window(self):
+        while len(self.pending) < self.window_size:
+            number = self.next_number
+            self.pending.append((number, asyncio.create_task(self._fetch(number))))
+            self.next_number += 1
+    
+    async def next(self):
+        """Return (invoice_number, invoice_data) for the next number in order"""
+        self._fill_window()
+        number, task = self.pending.popleft()
+        invoice_data = await task
+        self.fetched_count += 1
+        return number, invoice_data
+    
+    def close(self):
+        """Cancel requests still in flight past the point where the sync stopped"""
+        for _, task in self.pending:
+            if task.done() and not task.cancelled():
+                task.exception()  # retrieved, so a failed fetch is not reported as unhandled
+            task.cancel()
+        self.pending.clear()
+
+def find_customer_phone(invoice_data):
+    """Return (customer phone, where it was found) from a Rewaa invoice"""
+    # 1. Check for mobileNumber at root level
+    if invoice_data.get('mobileNumber'):
+        return invoice_data.get('mobileNumber'), "root.mobileNumber"
+    
+    # 2. Check Customer object, 3. then customer (lowercase)
+    for key in ('Customer', 'customer'):
+        customer_data = invoice_data.get(key)
+        if customer_data:
+            for field in ('mobileNumber', 'mobile', 'phone'):
+                if customer_data.get(field):
+                    return customer_data.get(field), f"{key}.{field}"
+            break
+    
+    # 4. Check PayableInvoice
+    payable = invoice_data.get('PayableInvoice')
+    if payable:
+        customer_phone = payable.get('mobileNumber') or payable.get('customerMobile') or payable.get('customerPhone')
+        if customer_phone:
+            return customer_phone, "PayableInvoice"
+    
+    # 5. Check payments array
+    for payment in invoice_data.get('payments', []):
+        for field in ('mobileNumber', 'customerMobile', 'customerPhone'):
+            if payment.get(field):
+                return payment.get(field), f"payments[].{field}"
+    
+    return None, None
+
+class SyncCustomerLookup:
+    """
+    Find (or auto-register from Rewaa) the customer of each synced invoice.
+    
+    Lookups are started by InvoiceWindowFetcher as invoices arrive and run
+    concurrently with the fetches, so the sync loop only waits on them. There
+    is one lookup per phone per run: invoices of a new customer share it, and
+    the customer is registered once.
+    """
+    
+    def __init__(self, db_instance, concurrency: int = SYNC_CONCURRENCY):
+        self.db = db_instance
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.lookups = {}  # international phone -> task returning the customer or None
+    
+    def prefetch(self, invoice_data):
+        customer_phone, _ = find_customer_phone(invoice_data)
+        if customer_phone:
+            self.get(format_phone_for_twilio(customer_phone))
+    
+    def get(self, international_phone: str):
+        """Awaitable customer for the phone (None if Rewaa does not know it either)"""
+        if international_phone not in self.lookups:
+            self.lookups[international_phone] = asyncio.create_task(self._lookup(international_phone))
+        return self.lookups[international_phone]
+    
+    async def _lookup(self, international_phone: str):
+        async with self.semaphore:
+            customer = await self.db.customers.find_one({"phone": international_phone}, {"_id": 0})
+            if customer:
+                return customer
+            
+            print(f"   ⚠️  Customer {international_phone} not in loyalty program")
+            print(f"   → Fetching customer from Rewaa...")
+            
+            # Get customer from Rewaa
+            rewaa_customer_data = await rewaa_service.get_customer_by_mobile(international_phone)
+            if not rewaa_customer_data:
+                print(f"   ❌ Customer {international_phone} not found in Rewaa either, skipping")
+                return None
+            
+            # Handle email - may be None or empty from Rewaa
+            customer_email = rewaa_customer_data.get('email')
+            if not customer_email:
+                customer_email = None  # Keep as None if not provided
+            
+            # Handle rewaa_customer_id - convert to string if it's an int
+            rewaa_id = rewaa_customer_data.get('id')
+            if rewaa_id is not None:
+                rewaa_id = str(rewaa_id)
+            
+            new_customer = Customer(
+                name=rewaa_customer_data.get('name') or 'عميل',
+                email=customer_email,
+                phone=international_phone,
+                rewaa_customer_id=rewaa_id
+            )
+            
+            customer_doc = new_customer.model_dump()
+            customer_doc.update(search_fields(new_customer.name, new_customer.email, new_customer.phone))
+            
+            await self.db.customers.insert_one(customer_doc)
+            await record_stats(self.db, new_customer.created_at, new_customers=1)
+            print(f"   ✓ Customer auto-registered: {new_customer.name}")
+            
+            # Fetch the newly created customer
+            return await self.db.customers.find_one({"phone": international_phone}, {"_id": 0})
+    
+    def close(self):
+        """Cancel lookups for invoices the sync did not reach"""
+        for task in self.lookups.values():
+            if task.done() and not task.cancelled():
+                task.exception()  # retrieved, so a failed lookup is not reported as unhandled
+            task.cancel()
+        self.lookups.clear()
+
 async def refresh_rewaa_token():
     """Refresh Rewaa API token every 55 minutes"""
     print(f"[{datetime.now()}] Refreshing Rewaa token...")
@@ -42,18 +215,25 @@ async def refresh_rewaa_token():
 async def sync_invoices_once(db_instance):
     """Sync invoices from Rewaa - single run"""
     print(f"[{datetime.now()}] Starting invoice sync...")
+    commit_buffer = None
+    synced_count = 0
     
     try:
         # Check if sync is enabled
-        sync_enabled_setting = await db_instance.settings.find_one({"key": "sync_enabled"}, {"_id": 0})
-        if not sync_enabled_setting or sync_enabled_setting.get("value") != "true":
+        if not await settings_cache.get(db_instance, "sync_enabled"):
             print(f"[{datetime.now()}] Sync is disabled, skipping...")
             return {"status": "disabled", "synced_count": 0}
         
+        # One run at a time: the cron job and a manual sync may overlap
+        commit_buffer = InvoiceCommitBuffer(db_instance)
+        if not await commit_buffer.acquire_lease():
+            print(f"[{datetime.now()}] Another invoice sync is running, skipping...")
+            return {"status": "busy", "synced_count": 0}
+        
         # Update sync status to running
         await db_instance.settings.update_one(
             {"key": "last_sync_status"},
-            {"$set": {"value": "running", "updated_at": datetime.now(timezone.utc).isoformat()}},
+            {"$set": {"value": "running", "updated_at": datetime.now(timezone.utc)}},
             upsert=True
         )
         
@@ -61,272 +241,183 @@ async def sync_invoices_once(db_instance):
         setting = await db_instance.settings.find_one({"key": "last_synced_invoice"}, {"_id": 0})
         last_invoice_number = int(setting.get("value", 160110)) if setting else 160110
         
-        synced_count = 0
         failed_count = 0
         max_failures = 10
         
-        # Start from next invoice
-        current_invoice_number = last_invoice_number + 1
+        # Start from next invoice, fetching a window of numbers ahead
+        current_invoice_number = last_invoice_number
+        customers = SyncCustomerLookup(db_instance)
+        fetcher = InvoiceWindowFetcher(last_invoice_number + 1, on_fetched=customers.prefetch)
+        started_at = time.monotonic()
         
-        while failed_count < max_failures:
-            # Get invoice from Rewaa
-            invoice_data = await rewaa_service.get_invoice_by_number(current_invoice_number)
-            
-            if not invoice_data:
-                failed_count += 1
-                print(f"Invoice {current_invoice_number} not found. Failed attempts: {failed_count}/{max_failures}")
+        fetch_error = None
+        
+        try:
+            while failed_count < max_failures:
+                # Get invoice from Rewaa (next number in order)
+                try:
+                    current_invoice_number, invoice_data = await fetcher.next()
+                except RewaaUnavailable as e:
+                    # Not a missing invoice: stop here so the checkpoint stays before it
+                    fetch_error = str(e)
+                    print(f"   ❌ Rewaa unavailable, stopping sync: {fetch_error}")
+                    break
+            
+                if not invoice_data:
+                    failed_count += 1
+                    print(f"Invoice {current_invoice_number} not found. Failed attempts: {failed_count}/{max_failures}")
                 
-                # Update last_synced_invoice even for missing invoices
-                # This prevents getting stuck on non-existent invoice numbers
-                await db_instance.settings.update_one(
-                    {"key": "last_synced_invoice"},
-                    {"$set": {"value": str(current_invoice_number), "updated_at": datetime.now(timezone.utc).isoformat()}},
-                    upsert=True
-                )
+                    # Move last_synced_invoice past missing invoices too
+                    # This prevents getting stuck on non-existent invoice numbers
+                    commit_buffer.advance(current_invoice_number)
                 
-                current_invoice_number += 1
-                continue
-            
-            # Reset failed count on success
-            failed_count = 0
-            
-            # Extract invoice data - search in multiple places
-            customer_phone = None
-            
-            # 1. Check for mobileNumber at root level
-            if invoice_data.get('mobileNumber'):
-                customer_phone = invoice_data.get('mobileNumber')
-                print(f"   Found in: root.mobileNumber")
-            
-            # 2. Check Customer object
-            elif invoice_data.get('Customer'):
-                customer_data = invoice_data.get('Customer')
-                customer_phone = customer_data.get('mobileNumber') or customer_data.get('mobile') or customer_data.get('phone')
-                if customer_phone:
-                    print(f"   Found in: Customer.{[k for k,v in customer_data.items() if v == customer_phone][0]}")
+                    continue
             
-            # 3. Check customer (lowercase)
-            elif invoice_data.get('customer'):
-                customer_data = invoice_data.get('customer')
-                customer_phone = customer_data.get('mobileNumber') or customer_data.get('mobile') or customer_data.get('phone')
-                if customer_phone:
-                    print(f"   Found in: customer.{[k for k,v in customer_data.items() if v == customer_phone][0]}")
+                # Reset failed count on success
+                failed_count = 0
             
-            # 4. Check PayableInvoice
-            if not customer_phone and invoice_data.get('PayableInvoice'):
-                payable = invoice_data.get('PayableInvoice')
-                customer_phone = payable.get('mobileNumber') or payable.get('customerMobile') or payable.get('customerPhone')
+                # Extract invoice data - search in multiple places
+                customer_phone, phone_source = find_customer_phone(invoice_data)
                 if customer_phone:
-                    print(f"   Found in: PayableInvoice")
-            
-            # 5. Check payments array
-            if not customer_phone:
-                payments = invoice_data.get('payments', [])
-                for payment in payments:
-                    customer_phone = payment.get('mobileNumber') or payment.get('customerMobile') or payment.get('customerPhone')
-                    if customer_phone:
-                        print(f"   Found in: payments[].{[k for k,v in payment.items() if v == customer_phone][0]}")
-                        break
+                    print(f"   Found in: {phone_source}")
             
-            total_amount = float(invoice_data.get('totalTaxInclusive') or invoice_data.get('total', 0))
-            invoice_date_str = invoice_data.get('completeDate') or invoice_data.get('date')
-            is_return_invoice = invoice_data.get('isReturnInvoice', False)
+                total_amount = float(invoice_data.get('totalTaxInclusive') or invoice_data.get('total', 0))
+                invoice_date_str = invoice_data.get('completeDate') or invoice_data.get('date')
+                is_return_invoice = invoice_data.get('isReturnInvoice', False)
             
-            print(f"\n📋 Invoice {current_invoice_number}:")
-            print(f"   Total: {total_amount} SAR")
-            print(f"   Is Return: {is_return_invoice}")
-            print(f"   Customer phone: {customer_phone}")
+                print(f"\n📋 Invoice {current_invoice_number}:")
+                print(f"   Total: {total_amount} SAR")
+                print(f"   Is Return: {is_return_invoice}")
+                print(f"   Customer phone: {customer_phone}")
             
-            if not customer_phone:
-                print(f"   ❌ No customer phone found, skipping")
-                print(f"   Available fields: {list(invoice_data.keys())[:10]}...")
+                if not customer_phone:
+                    print(f"   ❌ No customer phone found, skipping")
+                    print(f"   Available fields: {list(invoice_data.keys())[:10]}...")
                 
-                # Update last_synced_invoice to skip this invoice in future
-                await db_instance.settings.update_one(
-                    {"key": "last_synced_invoice"},
-                    {"$set": {"value": str(current_invoice_number), "updated_at": datetime.now(timezone.utc).isoformat()}},
-                    upsert=True
-                )
+                    # Move last_synced_invoice past this invoice on the next flush
+                    commit_buffer.advance(current_invoice_number)
                 
-                current_invoice_number += 1
-                continue
-            
-            # Format phone to international
-            international_phone = format_phone_for_twilio(customer_phone)
-            print(f"   Converted to: {international_phone}")
-            
-            # Find customer by phone - if not found, create from Rewaa
-            customer = await db_instance.customers.find_one({"phone": international_phone}, {"_id": 0})
-            
-            if not customer:
-                print(f"   ⚠️  Customer {international_phone} not in loyalty program")
-                print(f"   → Fetching customer from Rewaa...")
-                
-                # Get customer from Rewaa
-                rewaa_customer_data = await rewaa_service.get_customer_by_mobile(international_phone)
-                
-                if rewaa_customer_data:
-                    # Create customer in loyalty program
-                    from models import Customer
-                    
-                    # Handle email - may be None or empty from Rewaa
-                    customer_email = rewaa_customer_data.get('email')
-                    if not customer_email:
-                        customer_email = None  # Keep as None if not provided
-                    
-                    # Handle rewaa_customer_id - convert to string if it's an int
-                    rewaa_id = rewaa_customer_data.get('id')
-                    if rewaa_id is not None:
-                        rewaa_id = str(rewaa_id)
-                    
-                    new_customer = Customer(
-                        name=rewaa_customer_data.get('name') or 'عميل',
-                        email=customer_email,
-                        phone=international_phone,
-                        rewaa_customer_id=rewaa_id
-                    )
-                    
-                    customer_doc = new_customer.model_dump()
-                    customer_doc['created_at'] = customer_doc['created_at'].isoformat()
-                    customer_doc['updated_at'] = customer_doc['updated_at'].isoformat()
-                    
-                    await db_instance.customers.insert_one(customer_doc)
-                    print(f"   ✓ Customer auto-registered: {new_customer.name}")
-                    
-                    # Fetch the newly created customer
-                    customer = await db_instance.customers.find_one({"phone": international_phone}, {"_id": 0})
-                else:
-                    print(f"   ❌ Customer not found in Rewaa either, skipping")
-                    current_invoice_number += 1
                     continue
             
-            print(f"   ✓ Customer found: {customer['name']}")
-            
-            # Calculate points
-            setting = await db_instance.settings.find_one({"key": "points_multiplier"}, {"_id": 0})
-            multiplier = float(setting.get("value", 10)) if setting else 10
-            points_amount = total_amount / multiplier
-            
-            # For return invoices, points should be negative (deducted)
-            if is_return_invoice:
-                points_earned = -abs(points_amount)  # Ensure negative
-                transaction_type = "returned"
-                description_ar = f"رجيع فاتورة رقم {current_invoice_number}"
-                description_en = f"Return Invoice #{current_invoice_number}"
-                print(f"   🔴 Return invoice - Points to deduct: {abs(points_earned):.2f}")
-            else:
-                points_earned = abs(points_amount)  # Ensure positive
-                transaction_type = "earned"
-                description_ar = f"فاتورة رقم {current_invoice_number}"
-                description_en = f"Invoice #{current_invoice_number}"
-                print(f"   Points to earn: {points_earned:.2f}")
-            
-            # Check if invoice already exists
-            existing_invoice = await db_instance.invoices.find_one({"invoice_number": current_invoice_number})
-            if existing_invoice:
-                print(f"   ⚠️  Already synced, skipping")
-                
-                # Still update last_synced_invoice to move forward
-                await db_instance.settings.update_one(
-                    {"key": "last_synced_invoice"},
-                    {"$set": {"value": str(current_invoice_number), "updated_at": datetime.now(timezone.utc).isoformat()}},
-                    upsert=True
-                )
-                
-                current_invoice_number += 1
-                continue
-            
-            # Save invoice
-            invoice_doc = {
-                "id": str(uuid.uuid4()),
-                "invoice_number": current_invoice_number,
-                "customer_id": customer["id"],
-                "customer_phone": international_phone,
-                "total_amount": total_amount,
-                "points_earned": points_earned,
-                "is_return": is_return_invoice,
-                "payment_method": invoice_data.get('paymentMethod'),
-                "invoice_date": invoice_date_str or datetime.now(timezone.utc).isoformat(),
-                "synced_at": datetime.now(timezone.utc).isoformat()
-            }
-            
-            await db_instance.invoices.insert_one(invoice_doc)
+                # Format phone to international
+                international_phone = format_phone_for_twilio(customer_phone)
+                print(f"   Converted to: {international_phone}")
             
-            # Create points transaction
-            transaction_doc = {
-                "id": str(uuid.uuid4()),
-                "customer_id": customer["id"],
-                "transaction_type": transaction_type,
-                "points": points_earned,
-                "description": f"{description_ar} | {description_en}",
-                "invoice_id": invoice_doc["id"],
-                "created_at": datetime.now(timezone.utc).isoformat(),
-            }
+                # Find customer by phone - if not found, create from Rewaa. The lookup
+                # was started when the invoice was fetched, so it ran inside the window
+                customer = await customers.get(international_phone)
+                if not customer:
+                    continue
             
-            # Only add expires_at for earned points (not for returns)
-            if not is_return_invoice:
-                transaction_doc["expires_at"] = (datetime.now(timezone.utc) + timedelta(days=365)).isoformat()
+                print(f"   ✓ Customer found: {customer['name']}")
             
-            await db_instance.points_transactions.insert_one(transaction_doc)
+                # Calculate points
+                multiplier = await settings_cache.get(db_instance, "points_multiplier")
+                points_amount = total_amount / multiplier
             
-            # Update customer points
-            await db_instance.customers.update_one(
-                {"id": customer["id"]},
-                {
-                    "$inc": {
-                        "total_points": points_earned,
-                        "active_points": points_earned
-                    },
-                    "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+                # For return invoices, points should be negative (deducted)
+                if is_return_invoice:
+                    points_earned = -abs(points_amount)  # Ensure negative
+                    transaction_type = "returned"
+                    description_ar = f"رجيع فاتورة رقم {current_invoice_number}"
+                    description_en = f"Return Invoice #{current_invoice_number}"
+                    print(f"   🔴 Return invoice - Points to deduct: {abs(points_earned):.2f}")
+                else:
+                    points_earned = abs(points_amount)  # Ensure positive
+                    transaction_type = "earned"
+                    description_ar = f"فاتورة رقم {current_invoice_number}"
+                    description_en = f"Invoice #{current_invoice_number}"
+                    print(f"   Points to earn: {points_earned:.2f}")
+            
+                # Build invoice; ids come from the invoice number, so a re-fetched
+                # invoice is recognised and its commit resumed when the batch is flushed
+                invoice_doc = {
+                    "id": invoice_id(current_invoice_number),
+                    "invoice_number": current_invoice_number,
+                    "customer_id": customer["id"],
+                    "customer_phone": international_phone,
+                    "total_amount": total_amount,
+                    "points_earned": points_earned,
+                    "is_return": is_return_invoice,
+                    "payment_method": invoice_data.get('paymentMethod'),
+                    "invoice_date": parse_datetime(invoice_date_str) or datetime.now(timezone.utc),
+                    "synced_at": datetime.now(timezone.utc)
                 }
-            )
             
-            # Update last synced invoice after successful save
-            await db_instance.settings.update_one(
-                {"key": "last_synced_invoice"},
-                {"$set": {"value": str(current_invoice_number), "updated_at": datetime.now(timezone.utc).isoformat()}},
-                upsert=True
-            )
+                # Create points transaction
+                transaction_doc = {
+                    "id": invoice_transaction_id(current_invoice_number),
+                    "customer_id": customer["id"],
+                    "transaction_type": transaction_type,
+                    "points": points_earned,
+                    "description": f"{description_ar} | {description_en}",
+                    "invoice_id": invoice_doc["id"],
+                    "created_at": datetime.now(timezone.utc),
+                }
             
-            if is_return_invoice:
-                print(f"🔴 Return Invoice {current_invoice_number} synced: {total_amount} SAR = {points_earned:.2f} points deducted from {customer['name']}")
-            else:
-                print(f"✓ Invoice {current_invoice_number} synced: {total_amount} SAR = {points_earned:.2f} points for {customer['name']}")
-            synced_count += 1
+                # Earned points are a lot that expires (returns consume lots instead)
+                if not is_return_invoice:
+                    transaction_doc["expires_at"] = datetime.now(timezone.utc) + timedelta(days=365)
+                    transaction_doc["remaining_points"] = points_earned
             
-            current_invoice_number += 1
+                # Queue invoice, transaction and balance update for the batched commit
+                commit_buffer.add(invoice_doc, transaction_doc)
             
-            # Small delay to avoid overwhelming the API
-            await asyncio.sleep(0.5)
+                if is_return_invoice:
+                    print(f"🔴 Return Invoice {current_invoice_number} queued: {total_amount} SAR = {points_earned:.2f} points deducted from {customer['name']}")
+                else:
+                    print(f"✓ Invoice {current_invoice_number} queued: {total_amount} SAR = {points_earned:.2f} points for {customer['name']}")
+                
+                if commit_buffer.is_full:
+                    synced_count += await commit_buffer.flush()
+            
+            # Commit the last partial batch and the final checkpoint
+            synced_count += await commit_buffer.flush()
+        finally:
+            fetcher.close()
+            customers.close()
+        
+        if fetch_error:
+            raise RewaaUnavailable(f"{fetch_error} (synced {synced_count} invoices before stopping)")
+        
+        elapsed = time.monotonic() - started_at
+        invoices_per_second = synced_count / elapsed if elapsed > 0 else 0.0
         
         # Update sync information
         await db_instance.settings.update_one(
             {"key": "last_sync_time"},
-            {"$set": {"value": datetime.now(timezone.utc).isoformat(), "updated_at": datetime.now(timezone.utc).isoformat()}},
+            {"$set": {"value": datetime.now(timezone.utc).isoformat(), "updated_at": datetime.now(timezone.utc)}},
             upsert=True
         )
         await db_instance.settings.update_one(
             {"key": "last_sync_count"},
-            {"$set": {"value": str(synced_count), "updated_at": datetime.now(timezone.utc).isoformat()}},
+            {"$set": {"value": str(synced_count), "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        await db_instance.settings.update_one(
+            {"key": "last_sync_rate"},
+            {"$set": {"value": f"{invoices_per_second:.2f}", "updated_at": datetime.now(timezone.utc)}},
             upsert=True
         )
         await db_instance.settings.update_one(
             {"key": "last_sync_status"},
-            {"$set": {"value": "success", "updated_at": datetime.now(timezone.utc).isoformat()}},
+            {"$set": {"value": "success", "updated_at": datetime.now(timezone.utc)}},
             upsert=True
         )
         await db_instance.settings.update_one(
             {"key": "last_sync_error"},
-            {"$set": {"value": "", "updated_at": datetime.now(timezone.utc).isoformat()}},
+            {"$set": {"value": "", "updated_at": datetime.now(timezone.utc)}},
             upsert=True
         )
         
-        print(f"[{datetime.now()}] Invoice sync completed. Synced: {synced_count}, Last invoice: {current_invoice_number - 1}")
+        print(f"[{datetime.now()}] Invoice sync completed. Synced: {synced_count}, Last invoice: {current_invoice_number}, "
+              f"Rate: {invoices_per_second:.2f} invoices/s ({fetcher.fetched_count} fetched in {elapsed:.1f}s)")
         
         return {
             "status": "success",
             "synced_count": synced_count,
-            "last_invoice": current_invoice_number - 1
+            "last_invoice": current_invoice_number,
+            "invoices_per_second": round(invoices_per_second, 2)
         }
     
     except Exception as e:
@@ -336,12 +427,12 @@ async def sync_invoices_once(db_instance):
         # Update sync status to failed
         await db_instance.settings.update_one(
             {"key": "last_sync_status"},
-            {"$set": {"value": "failed", "updated_at": datetime.now(timezone.utc).isoformat()}},
+            {"$set": {"value": "failed", "updated_at": datetime.now(timezone.utc)}},
             upsert=True
         )
         await db_instance.settings.update_one(
             {"key": "last_sync_error"},
-            {"$set": {"value": error_message[:500], "updated_at": datetime.now(timezone.utc).isoformat()}},
+            {"$set": {"value": error_message[:500], "updated_at": datetime.now(timezone.utc)}},
             upsert=True
         )
         
@@ -359,91 +450,114 @@ async def sync_invoices_once(db_instance):
         except Exception as email_error:
             print(f"[{datetime.now()}] Failed to send email notification: {email_error}")
         
+        # Batches flushed before the error stay committed
         return {
             "status": "failed",
             "error": error_message,
-            "synced_count": 0
+            "synced_count": synced_count
         }
+    finally:
+        if commit_buffer is not None:
+            try:
+                await commit_buffer.release_lease()
+            except Exception as e:
+                print(f"[{datetime.now()}] Failed to release the sync lease: {e}")
 
 async def sync_invoices():
     """Wrapper for sync_invoices_once using global db"""
     return await sync_invoices_once(db)
 
 async def check_expired_points():
-    """Check and expire points daily"""
+    """Expire due points lots in batches (daily, see points_expiry.py)"""
     print(f"[{datetime.now()}] Checking expired points...")
     
     try:
-        # Find all expired transactions
-        now = datetime.now(timezone.utc).isoformat()
-        expired_transactions = await db.points_transactions.find({
-            "transaction_type": "earned",
-            "expires_at": {"$lte": now}
-        }, {"_id": 0}).to_list(1000)
-        
-        expired_count = 0
-        
-        for trans in expired_transactions:
-            customer_id = trans["customer_id"]
-            points = trans["points"]
-            
-            # Update customer expired points
-            await db.customers.update_one(
-                {"id": customer_id},
-                {
-                    "$inc": {
-                        "active_points": -points,
-                        "expired_points": points
-                    },
-                    "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
-                }
-            )
-            
-            # Create expiry transaction
-            expiry_doc = {
-                "id": str(uuid.uuid4()),
-                "customer_id": customer_id,
-                "transaction_type": "expired",
-                "points": -points,
-                "description": "نقاط منتهية الصلاحية | Expired points",
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }
-            
-            await db.points_transactions.insert_one(expiry_doc)
-            
-            # Mark original transaction as processed
-            await db.points_transactions.update_one(
-                {"id": trans["id"]},
-                {"$set": {"transaction_type": "earned_expired"}}
-            )
-            
-            expired_count += 1
-        
-        print(f"[{datetime.now()}] Expired points check completed. Expired: {expired_count} transactions")
-        return expired_count
+        stats = await expire_points(db)
+        if stats["replayed"]:
+            print(f"[{datetime.now()}] Replayed {stats['replayed']} interrupted expiry batches")
+        print(
+            f"[{datetime.now()}] Expired points check completed. Expired: {stats['lots']} lots, "
+            f"{stats['points']} points in {stats['batches']} batches ({stats['lots_per_second']} lots/s)"
+        )
+        return stats["lots"]
     
     except Exception as e:
         print(f"[{datetime.now()}] Error checking expired points: {e}")
         return 0
 
+async def drain_ledger_outbox():
+    """Write redemption ledger entries left pending in the customers' outbox"""
+    try:
+        stats = await drain_pending_ledger(db)
+        if stats["entries"] or stats["errors"]:
+            print(f"[{datetime.now()}] Ledger outbox drained: {stats['entries']} entries of {stats['customers']} customers, {stats['errors']} errors")
+        return stats
+    except Exception as e:
+        print(f"[{datetime.now()}] Error draining ledger outbox: {e}")
+        return None
+
+async def archive_old_audit_logs():
+    """Archive and delete audit logs past the retention window (daily)"""
+    print(f"[{datetime.now()}] Archiving old audit logs...")
+    
+    try:
+        results = await archive_audit_logs(db)
+        for result in results:
+            print(f"[{datetime.now()}] Audit logs {result['month']}: {result['deleted']} archived to {result['file']}")
+        print(f"[{datetime.now()}] Audit log archiving completed. Months: {len(results)}")
+        return results
+    except Exception as e:
+        print(f"[{datetime.now()}] Error archiving audit logs: {e}")
+        return []
+
+async def run_daily_jobs():
+    """Jobs that run once a day, on the first loop of each UTC day"""
+    try:
+        backfill = await ensure_lots_backfilled(db)
+        if backfill:
+            print(f"[{datetime.now()}] Points lots initialised: {backfill['lots']} lots of {backfill['customers']} customers")
+    except Exception as e:
+        print(f"[{datetime.now()}] Error initialising points lots: {e}")
+    await check_expired_points()
+    await archive_old_audit_logs()
+
 async def run_jobs():
     """Run all cron jobs"""
     print(f"[{datetime.now()}] Starting cron jobs...")
     
-    # Initial token refresh
-    await refresh_rewaa_token()
+    # Shared keep-alive HTTP client for all Rewaa calls
+    await rewaa_service.start()
     
-    while True:
-        try:
-            # Run invoice sync every 15 minutes
-            await sync_invoices()
-            
-            # Wait 15 minutes
-            await asyncio.sleep(15 * 60)
-            
-        except Exception as e:
-            print(f"[{datetime.now()}] Error in cron jobs: {e}")
-            await asyncio.sleep(60)  # Wait 1 minute before retrying
+    try:
+        # Indexes, including the unique ones that make invoice ingestion idempotent
+        await ensure_indexes(db)
+        
+        # Initial token refresh
+        await refresh_rewaa_token()
+        
+        last_daily_run = None
+        
+        while True:
+            try:
+                today = datetime.now(timezone.utc).date()
+                if last_daily_run != today:
+                    await run_daily_jobs()
+                    last_daily_run = today
+                
+                # Redemptions whose ledger entry was not drained by the API
+                await drain_ledger_outbox()
+                
+                # Run invoice sync every 15 minutes
+                await sync_invoices()
+                
+                # Wait 15 minutes
+                await asyncio.sleep(15 * 60)
+                
+            except Exception as e:
+                print(f"[{datetime.now()}] Error in cron jobs: {e}")
+                await asyncio.sleep(60)  # Wait 1 minute before retrying
+    finally:
+        await rewaa_service.close()
 
 if __name__ == "__main__":
     asyncio.run(run_jobs())
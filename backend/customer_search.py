@@ -0,0 +1,192 @@
+"""
+Customer search
+Precomputed, indexed search fields on each customer document replace the
+unanchored case-insensitive regex over name, phone and email:
+
+- phone_digits:      digits of the international phone ("966550755465"), prefix search
+- phone_digits_rev:  the same digits reversed, so "last digits" searches are prefix searches too
+- search_tokens:     normalized words of the name and parts of the email, prefix search
+- name_key:          the whole normalized name, prefix search ("محمد عبد" finds "مُحمّد عبدالله")
+
+Arabic text is normalized the same way on write and on query: diacritics and
+tatweel removed, alef/hamza forms folded to ا, ة to ه, ى to ي, so spelling
+variants of a name find the same customer.
+
+All regexes built here are anchored (^) and escaped, so they use the indexes
+and user input is never interpreted as a pattern.
+
+Backfill: python customer_search.py [--batch-size 500]
+"""
+import argparse
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from utils import format_phone_for_twilio
+
+# Shortest digit string searched against the phone fields
+MIN_PHONE_DIGITS = 3
+# Maximum number of words of a query that are matched
+MAX_QUERY_TOKENS = 5
+
+_TOKEN_SPLIT = re.compile(r"[\s,;]+")
+
+# Harakat, tanween, shadda, sukun, superscript alef and tatweel
+_ARABIC_MARKS = re.compile(r"[\u064B-\u065F\u0670\u06D6-\u06ED\u0640]")
+_ARABIC_FOLD = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ؤ": "و",
+    "ئ": "ي",
+    "ى": "ي", "ی": "ي",
+    "ة": "ه",
+    "ک": "ك",
+    # Arabic-Indic digits
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4",
+    "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+})
+
+
+# Fields written by search_fields; internal, never returned by the API
+SEARCH_FIELDS = ["phone_digits", "phone_digits_rev", "search_tokens", "name_key"]
+
+
+def normalize_arabic(text: Optional[str]) -> str:
+    """Lowercase text with Arabic spelling variants and diacritics folded"""
+    if not text:
+        return ""
+    text = _ARABIC_MARKS.sub("", text.lower())
+    return " ".join(text.translate(_ARABIC_FOLD).split())
+
+
+def normalize_phone_digits(phone: Optional[str]) -> str:
+    """Digits of the international form of a phone number"""
+    if not phone:
+        return ""
+    return re.sub(r"\D", "", format_phone_for_twilio(phone))
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Normalized words of a name or query"""
+    if not text:
+        return []
+    return [token for token in _TOKEN_SPLIT.split(normalize_arabic(text)) if token]
+
+
+def email_tokens(email: Optional[str]) -> List[str]:
+    """The full address, its local part and its domain"""
+    if not email:
+        return []
+    email = email.strip().lower()
+    local, _, domain = email.partition("@")
+    return [token for token in (email, local, domain) if token]
+
+
+def search_fields(name: Optional[str], email: Optional[str], phone: Optional[str]) -> Dict[str, Any]:
+    """Search fields to $set whenever a customer's name, email or phone is written"""
+    digits = normalize_phone_digits(phone)
+    tokens = tokenize(name) + email_tokens(email)
+    return {
+        "phone_digits": digits,
+        "phone_digits_rev": digits[::-1],
+        "search_tokens": sorted(set(tokens)),
+        "name_key": " ".join(tokenize(name)),
+    }
+
+
+def _prefix(value: str) -> Dict[str, str]:
+    return {"$regex": f"^{re.escape(value)}"}
+
+
+def _phone_prefixes(digits: str) -> List[str]:
+    """Query digits as typed plus their international form (05.. / 5.. -> 9665..)"""
+    prefixes = [digits]
+    if digits.startswith("00"):
+        prefixes.append(digits[2:])
+    elif digits.startswith("0"):
+        prefixes.append("966" + digits[1:])
+    elif digits.startswith("5"):
+        prefixes.append("966" + digits)
+    return list(dict.fromkeys(prefixes))
+
+
+def build_search_query(search: str) -> Dict[str, Any]:
+    """
+    Mongo filter for an admin search box query
+    Digit queries match the phone by prefix (as typed or international) and by
+    suffix; word queries need every word to prefix-match a name/email token.
+    """
+    text = normalize_arabic(search)
+    clauses: List[Dict[str, Any]] = []
+
+    compact = re.sub(r"[\s\-()+]", "", text)
+    if compact.isdigit() and len(compact) >= MIN_PHONE_DIGITS:
+        for prefix in _phone_prefixes(compact):
+            clauses.append({"phone_digits": _prefix(prefix)})
+        clauses.append({"phone_digits_rev": _prefix(compact[::-1])})
+
+    tokens = tokenize(text)[:MAX_QUERY_TOKENS]
+    if tokens:
+        # The name as typed from its start, then the words in any order
+        clauses.append({"name_key": _prefix(" ".join(tokens))})
+        token_clauses = [{"search_tokens": _prefix(token)} for token in tokens]
+        clauses.append(token_clauses[0] if len(token_clauses) == 1 else {"$and": token_clauses})
+
+    if not clauses:
+        # Nothing searchable (e.g. two digits): match nothing rather than everything
+        return {"id": {"$in": []}}
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def exact_phone(search: str) -> Optional[str]:
+    """International phone when the query is a complete phone number, else None"""
+    compact = re.sub(r"[\s\-()]", "", normalize_arabic(search))
+    if not re.fullmatch(r"\+?\d{9,15}", compact):
+        return None
+    return format_phone_for_twilio(compact)
+
+
+def backfill_search_fields(batch_size: int = 500):
+    """Set the search fields on every customer (safe to re-run)"""
+    from pymongo import MongoClient, UpdateOne
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost:27017'))
+    db = client[os.getenv('DB_NAME', 'alreef_loyalty')]
+
+    print("🔄 Backfilling customer search fields (phone digits, tokens, name_key)")
+    print("=" * 50)
+
+    updated = 0
+    last_id = None
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        batch = list(
+            db.customers.find(query, {"_id": 1, "name": 1, "email": 1, "phone": 1})
+            .sort("_id", 1).limit(batch_size)
+        )
+        if not batch:
+            break
+        operations = [
+            UpdateOne(
+                {"_id": customer["_id"]},
+                {"$set": search_fields(customer.get("name"), customer.get("email"), customer.get("phone"))}
+            )
+            for customer in batch
+        ]
+        result = db.customers.bulk_write(operations, ordered=False)
+        updated += result.modified_count
+        last_id = batch[-1]["_id"]
+        print(f"✓ Processed up to {last_id} ({updated} updated)")
+
+    print(f"\n✅ Updated {updated} customers")
+    client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill customer search fields")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    backfill_search_fields(batch_size=args.batch_size)
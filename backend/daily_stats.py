@@ -0,0 +1,356 @@
+"""
+Daily rollup of loyalty activity
+One daily_stats document per UTC day, updated incrementally by the write
+paths (sync, redemption, manual points, expiry, registration) so reports read
+a few dozen small documents instead of scanning the ledger.
+
+Rebuild / backfill: python daily_stats.py [--since YYYY-MM-DD]
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+REBUILD_KEY = "daily_stats_rebuild"
+
+# Timestamp each collection is rolled up by; the rebuild only reads BSON dates
+# there, so migrate_dates.py must have converted them first
+ROLLUP_DATE_FIELDS = [
+    ("points_transactions", "created_at"),
+    ("invoices", "invoice_date"),
+    ("customers", "created_at"),
+]
+
+# Counters kept per day; the value written by the rebuild for each one
+COUNTER_FIELDS = [
+    "earned",          # points from earned + manual_add transactions
+    "redeemed",        # points redeemed (positive)
+    "expired",         # points expired (positive)
+    "returned",        # points deducted by return invoices (positive)
+    "sales",           # invoice total_amount
+    "invoice_count",
+    "new_customers",
+]
+
+
+def day_start(value: datetime) -> datetime:
+    """Midnight UTC of the day `value` falls in"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class StatsDelta:
+    """Increments for one or more days, written with a single bulk_write"""
+
+    def __init__(self):
+        self.days: Dict[datetime, Dict[str, Any]] = {}
+
+    def __bool__(self):
+        return bool(self.days)
+
+    def add(self, when: datetime, active_customer_id: Optional[str] = None, **counters):
+        day = self.days.setdefault(day_start(when), {"inc": {}, "active": set()})
+        for field, amount in counters.items():
+            if field not in COUNTER_FIELDS:
+                raise ValueError(f"Unknown daily_stats counter: {field}")
+            if amount:
+                day["inc"][field] = day["inc"].get(field, 0) + amount
+        if active_customer_id:
+            day["active"].add(active_customer_id)
+
+    def add_transaction(self, transaction: Dict[str, Any], sign: int = 1):
+        """Count a points transaction by its type (sign=-1 removes it)"""
+        transaction_type = transaction.get("transaction_type")
+        points = sign * transaction.get("points", 0)
+        when = transaction["created_at"]
+        if transaction_type == "earned":
+            active_customer_id = transaction.get("customer_id") if sign > 0 else None
+            self.add(when, active_customer_id=active_customer_id, earned=points)
+        elif transaction_type == "manual_add":
+            self.add(when, earned=points)
+        elif transaction_type == "redeemed":
+            self.add(when, redeemed=abs(points))
+        elif transaction_type == "expired":
+            self.add(when, expired=abs(points))
+        elif transaction_type == "returned":
+            self.add(when, returned=abs(points))
+
+    def add_invoice(self, invoice: Dict[str, Any], sign: int = 1):
+        self.add(invoice["invoice_date"], sales=sign * invoice.get("total_amount", 0), invoice_count=sign)
+
+    def operations(self) -> List[UpdateOne]:
+        now = datetime.now(timezone.utc)
+        operations = []
+        for day, change in self.days.items():
+            update: Dict[str, Any] = {"$set": {"updated_at": now}}
+            if change["inc"]:
+                update["$inc"] = change["inc"]
+            if change["active"]:
+                update["$addToSet"] = {"active_customer_ids": {"$each": sorted(change["active"])}}
+            operations.append(UpdateOne({"day": day}, update, upsert=True))
+        return operations
+
+
+async def apply_delta(db, delta: StatsDelta):
+    """Write a StatsDelta; no-op when it is empty"""
+    if delta:
+        await db.daily_stats.bulk_write(delta.operations(), ordered=False)
+
+
+async def record_stats(db, when: datetime, active_customer_id: Optional[str] = None, **counters):
+    """
+    Increment the rollup of the day `when` falls in
+    Failures are logged, not raised: the ledger write already succeeded and
+    the rebuild command repairs the rollup
+    """
+    try:
+        delta = StatsDelta()
+        delta.add(when, active_customer_id=active_customer_id, **counters)
+        await apply_delta(db, delta)
+    except Exception as e:
+        logger.error(f"Failed to update daily stats: {e}")
+
+
+async def record_transaction(db, transaction: Dict[str, Any]):
+    """Increment the rollup for one points transaction (logged on failure)"""
+    try:
+        delta = StatsDelta()
+        delta.add_transaction(transaction)
+        await apply_delta(db, delta)
+    except Exception as e:
+        logger.error(f"Failed to update daily stats: {e}")
+
+
+async def record_customer_deleted(db, customer: Dict[str, Any], invoices_deleted: bool = True):
+    """
+    Remove a customer's registration, transactions and (optionally) invoices
+    from the rollup; call before they are deleted. Logged on failure.
+    """
+    try:
+        delta = StatsDelta()
+        if isinstance(customer.get("created_at"), datetime):
+            delta.add(customer["created_at"], new_customers=-1)
+
+        transactions = db.points_transactions.find(
+            {"customer_id": customer["id"], "created_at": {"$type": "date"}},
+            {"_id": 0, "transaction_type": 1, "points": 1, "created_at": 1}
+        )
+        async for transaction in transactions:
+            delta.add_transaction(transaction, sign=-1)
+
+        if invoices_deleted:
+            invoices = db.invoices.find(
+                {"customer_id": customer["id"], "invoice_date": {"$type": "date"}},
+                {"_id": 0, "total_amount": 1, "invoice_date": 1}
+            )
+            async for invoice in invoices:
+                delta.add_invoice(invoice, sign=-1)
+
+        await apply_delta(db, delta)
+        await db.daily_stats.update_many(
+            {"active_customer_ids": customer["id"]},
+            {"$pull": {"active_customer_ids": customer["id"]}}
+        )
+    except Exception as e:
+        logger.error(f"Failed to update daily stats: {e}")
+
+
+async def sum_stats(db, start: datetime, end: Optional[datetime] = None) -> Dict[str, float]:
+    """Totals of every counter for the days in [start, end)"""
+    match: Dict[str, Any] = {"day": {"$gte": day_start(start)}}
+    if end is not None:
+        match["day"]["$lt"] = day_start(end)
+
+    group: Dict[str, Any] = {"_id": None}
+    for field in COUNTER_FIELDS:
+        group[field] = {"$sum": f"${field}"}
+
+    result = await db.daily_stats.aggregate([{"$match": match}, {"$group": group}]).to_list(1)
+    totals = result[0] if result else {}
+    return {field: totals.get(field, 0) or 0 for field in COUNTER_FIELDS}
+
+
+async def active_customers(db, start: datetime, end: Optional[datetime] = None) -> Set[str]:
+    """Customers with an earned transaction in the days in [start, end)"""
+    match: Dict[str, Any] = {"day": {"$gte": day_start(start)}}
+    if end is not None:
+        match["day"]["$lt"] = day_start(end)
+
+    rows = await db.daily_stats.aggregate([
+        {"$match": match},
+        {"$unwind": "$active_customer_ids"},
+        {"$group": {"_id": "$active_customer_ids"}}
+    ]).to_list(None)
+    return {row["_id"] for row in rows}
+
+
+def _day_group(date_field: str) -> Dict[str, Any]:
+    return {"$dateTrunc": {"date": f"${date_field}", "unit": "day", "timezone": "UTC"}}
+
+
+async def rebuild_daily_stats(db, since: Optional[datetime] = None) -> int:
+    """
+    Recompute the rollup from the ledger, invoices and customers
+    Days from `since` (or all days) are replaced; returns the number of days written
+    """
+    def match(field: str) -> List[Dict[str, Any]]:
+        if since is None:
+            return [{"$match": {field: {"$type": "date"}}}]
+        return [{"$match": {field: {"$gte": day_start(since)}}}]
+
+    def is_type(*types: str) -> Dict[str, Any]:
+        return {"$in": ["$transaction_type", list(types)]}
+
+    days: Dict[datetime, Dict[str, Any]] = {}
+
+    def day_doc(day: datetime) -> Dict[str, Any]:
+        return days.setdefault(day, {field: 0 for field in COUNTER_FIELDS})
+
+    transactions = db.points_transactions.aggregate(match("created_at") + [
+        {
+            "$group": {
+                "_id": _day_group("created_at"),
+                "earned": {"$sum": {"$cond": [is_type("earned", "manual_add"), "$points", 0]}},
+                "redeemed": {"$sum": {"$cond": [is_type("redeemed"), {"$abs": "$points"}, 0]}},
+                "expired": {"$sum": {"$cond": [is_type("expired"), {"$abs": "$points"}, 0]}},
+                "returned": {"$sum": {"$cond": [is_type("returned"), {"$abs": "$points"}, 0]}},
+                "active_customer_ids": {"$addToSet": {"$cond": [is_type("earned"), "$customer_id", "$$REMOVE"]}}
+            }
+        }
+    ])
+    async for row in transactions:
+        doc = day_doc(row["_id"])
+        for field in ("earned", "redeemed", "expired", "returned"):
+            doc[field] = row[field]
+        doc["active_customer_ids"] = sorted(row["active_customer_ids"])
+
+    invoices = db.invoices.aggregate(match("invoice_date") + [
+        {"$group": {"_id": _day_group("invoice_date"), "sales": {"$sum": "$total_amount"}, "invoice_count": {"$sum": 1}}}
+    ])
+    async for row in invoices:
+        doc = day_doc(row["_id"])
+        doc["sales"] = row["sales"]
+        doc["invoice_count"] = row["invoice_count"]
+
+    customers = db.customers.aggregate(match("created_at") + [
+        {"$group": {"_id": _day_group("created_at"), "new_customers": {"$sum": 1}}}
+    ])
+    async for row in customers:
+        day_doc(row["_id"])["new_customers"] = row["new_customers"]
+
+    await db.daily_stats.delete_many({} if since is None else {"day": {"$gte": day_start(since)}})
+    if days:
+        now = datetime.now(timezone.utc)
+        await db.daily_stats.insert_many([
+            {"day": day, "active_customer_ids": [], **doc, "updated_at": now}
+            for day, doc in sorted(days.items())
+        ])
+    return len(days)
+
+
+async def unmigrated_date_fields(db) -> List[str]:
+    """Rollup date fields still holding ISO strings that migrate_dates.py has not converted"""
+    fields = []
+    for collection_name, field in ROLLUP_DATE_FIELDS:
+        if await db.migrations.find_one({"key": f"dates:{collection_name}.{field}", "done": True}):
+            continue  # migrated; values it could not parse are left for manual review
+        if await db[collection_name].find_one({field: {"$type": "string"}}, {"_id": 1}):
+            fields.append(f"{collection_name}.{field}")
+    return fields
+
+
+async def ensure_daily_stats_built(db) -> Optional[int]:
+    """
+    Build the rollup once per database; returns the days written when it ran
+    Every worker calls this at startup: the first one claims REBUILD_KEY in
+    system_settings (unique key) and builds, the others see the claim and
+    skip, so no worker deletes days another one just wrote. A claim left
+    running by a worker that died is cleared by the CLI rebuild below.
+
+    Nothing is claimed while migrate_dates.py still has string dates to
+    convert: the rollup would miss that history for good. The migration
+    rebuilds the rollup itself once it has converted them.
+    """
+    if await db.system_settings.find_one({"key": REBUILD_KEY}, {"_id": 1}):
+        return None
+    unmigrated = await unmigrated_date_fields(db)
+    if unmigrated:
+        logger.warning(f"daily_stats not built: run migrate_dates.py first ({', '.join(unmigrated)} hold string dates)")
+        return None
+
+    now = datetime.now(timezone.utc)
+    try:
+        claimed = await db.system_settings.find_one_and_update(
+            {"key": REBUILD_KEY},
+            {"$setOnInsert": {"value": {"state": "running", "started_at": now}, "updated_at": now}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        return None  # another worker claimed it at the same moment
+    if claimed is not None:
+        return None
+
+    try:
+        if await db.daily_stats.estimated_document_count() > 0:
+            # Rollup kept up by the write paths since before the claim existed
+            days = 0
+        else:
+            days = await rebuild_daily_stats(db)
+    except Exception:
+        # Release the claim so the next start tries again
+        await db.system_settings.delete_one({"key": REBUILD_KEY})
+        raise
+
+    await _mark_rebuilt(db, days, now)
+    return days
+
+
+async def rebuild_and_mark(db, since: Optional[datetime] = None) -> int:
+    """Rebuild (see rebuild_daily_stats) and record it under REBUILD_KEY"""
+    started_at = datetime.now(timezone.utc)
+    written = await rebuild_daily_stats(db, since)
+    await _mark_rebuilt(db, written, started_at)
+    return written
+
+
+async def _mark_rebuilt(db, days: int, started_at: datetime):
+    await db.system_settings.update_one(
+        {"key": REBUILD_KEY},
+        {"$set": {"value": {"state": "done", "days": days, "started_at": started_at}, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+
+async def main():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Rebuild the daily_stats rollup")
+    parser.add_argument("--since", help="Only rebuild days from this date (YYYY-MM-DD)")
+    args = parser.parse_args()
+    since = datetime.strptime(args.since, "%Y-%m-%d").replace(tzinfo=timezone.utc) if args.since else None
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+
+    print("🔄 Rebuilding daily stats" + (f" since {args.since}" if args.since else ""))
+    print("   (disable the sync while rebuilding so no increments are lost)")
+    written = await rebuild_and_mark(db, since)
+    print(f"✅ Wrote {written} days")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
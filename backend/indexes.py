@@ -0,0 +1,228 @@
+"""
+MongoDB index management
+Declares the indexes every collection needs, creates them idempotently at
+startup and reports declared indexes that are missing or never used
+"""
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from audit_archive import AUDIT_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Required indexes per collection. Names are fixed so create_indexes is a
+# no-op when an index already exists and reports can refer to them.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "customers": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("phone", ASCENDING)], name="phone_unique", unique=True),
+        # Keyset pagination of the admin customer list: (created_at, id)
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("total_points", DESCENDING)], name="total_points"),
+        # Admin customer search (customer_search.py)
+        IndexModel([("phone_digits", ASCENDING)], name="phone_digits"),
+        IndexModel([("phone_digits_rev", ASCENDING)], name="phone_digits_rev"),
+        IndexModel([("search_tokens", ASCENDING)], name="search_tokens"),
+        IndexModel([("name_key", ASCENDING)], name="name_key"),
+        # Redemption outbox entries not yet drained (ledger_outbox.py)
+        IndexModel([("pending_ledger.id", ASCENDING)], name="pending_ledger_id", sparse=True),
+    ],
+    "invoices": [
+        # Unique: a re-fetched invoice is rejected and resumed by the sync commit stage
+        IndexModel([("invoice_number", ASCENDING)], name="invoice_number_unique", unique=True),
+        IndexModel([("customer_phone", ASCENDING), ("invoice_date", DESCENDING), ("id", DESCENDING)], name="customer_phone_invoice_date_id"),
+        IndexModel([("customer_id", ASCENDING)], name="customer_id"),
+        IndexModel([("invoice_date", ASCENDING)], name="invoice_date"),
+    ],
+    "points_transactions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("customer_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="customer_id_created_at_id"),
+        IndexModel([("transaction_type", ASCENDING), ("created_at", ASCENDING)], name="transaction_type_created_at"),
+        IndexModel([("transaction_type", ASCENDING), ("expires_at", ASCENDING)], name="transaction_type_expires_at"),
+        # Open points lots (points_lots.py): consumption order per customer, expiry walk
+        IndexModel(
+            [("customer_id", ASCENDING), ("expires_at", ASCENDING), ("_id", ASCENDING)],
+            name="customer_id_open_lots",
+            partialFilterExpression={"remaining_points": {"$gt": 0}}
+        ),
+        IndexModel(
+            [("expires_at", ASCENDING)],
+            name="open_lots_expires_at",
+            partialFilterExpression={"remaining_points": {"$gt": 0}}
+        ),
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+        # Unique: one points transaction per synced invoice (ids derived from the invoice number)
+        IndexModel(
+            [("invoice_id", ASCENDING)],
+            name="invoice_id_unique",
+            unique=True,
+            partialFilterExpression={"invoice_id": {"$type": "string"}}
+        ),
+    ],
+    "admins": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("phone", ASCENDING)], name="phone"),
+        IndexModel([("email", ASCENDING)], name="email"),
+    ],
+    "settings": [
+        IndexModel([("key", ASCENDING)], name="key_unique", unique=True),
+    ],
+    "system_settings": [
+        # Unique: one-time jobs and leases claim their key with an upsert
+        # (daily_stats.ensure_daily_stats_built, sync_commit.InvoiceCommitBuffer.acquire_lease)
+        IndexModel([("key", ASCENDING)], name="key_unique", unique=True),
+    ],
+    "trusted_devices": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("phone", ASCENDING), ("device_token", ASCENDING), ("expires_at", ASCENDING)], name="phone_device_token_expires_at"),
+    ],
+    "otp_codes": [
+        IndexModel([("phone", ASCENDING), ("created_at", DESCENDING)], name="phone_created_at"),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at"),
+    ],
+    "daily_stats": [
+        IndexModel([("day", ASCENDING)], name="day_unique", unique=True),
+    ],
+    "expiry_batches": [
+        # Pending journal entries replayed by points_expiry.py, pruning of done ones
+        IndexModel([("state", ASCENDING), ("created_at", ASCENDING)], name="state_created_at"),
+    ],
+    "rate_limits": [
+        # TTL: counters of idle clients (mongo rate limit backend)
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "audit_logs": [
+        # AuditLogger.get_logs filters, each followed by the keyset sort (timestamp, id)
+        IndexModel([("timestamp", DESCENDING), ("id", DESCENDING)], name="timestamp_id"),
+        IndexModel([("actor.id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="actor_id_timestamp_id"),
+        IndexModel([("target.id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="target_id_timestamp_id"),
+        IndexModel([("action", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="action_timestamp_id"),
+        IndexModel([("severity", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="severity_timestamp_id"),
+        # Retention backstop: audit_archive.py archives and deletes old months
+        # first, the TTL only removes what it missed (see AUDIT_TTL_GRACE_DAYS)
+        IndexModel([("timestamp", ASCENDING)], name="timestamp_ttl", expireAfterSeconds=AUDIT_TTL_SECONDS),
+    ],
+}
+
+# Indexes replaced by one declared above; dropped by ensure_indexes
+SUPERSEDED_INDEXES: Dict[str, List[str]] = {
+    "audit_logs": ["actor_id_timestamp"],
+}
+
+
+async def ensure_indexes(db) -> Dict[str, List[str]]:
+    """
+    Create all declared indexes (existing ones are left as they are)
+    Returns {collection: [index names that could not be created]}
+    """
+    failed: Dict[str, List[str]] = {}
+
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        try:
+            await collection.create_indexes(models)
+            continue
+        except OperationFailure as e:
+            logger.warning(f"Bulk index creation failed on {collection_name}: {e}. Creating one by one")
+
+        # One bad index (e.g. duplicates under a unique key) must not block the rest
+        for model in models:
+            try:
+                await collection.create_indexes([model])
+            except OperationFailure as e:
+                name = model.document["name"]
+                if "expireAfterSeconds" in model.document and await _update_ttl(db, collection_name, model.document):
+                    continue
+                failed.setdefault(collection_name, []).append(name)
+                logger.error(f"Could not create index {collection_name}.{name}: {e}")
+
+    for collection_name, names in SUPERSEDED_INDEXES.items():
+        existing = await db[collection_name].index_information()
+        for name in names:
+            if name in existing:
+                await db[collection_name].drop_index(name)
+                logger.info(f"Dropped superseded index {collection_name}.{name}")
+
+    return failed
+
+
+async def _update_ttl(db, collection_name: str, index: Dict[str, Any]) -> bool:
+    """Apply a changed TTL to an existing index (create_indexes refuses to)"""
+    try:
+        await db.command(
+            "collMod", collection_name,
+            index={"name": index["name"], "expireAfterSeconds": index["expireAfterSeconds"]}
+        )
+        logger.info(f"Updated TTL of {collection_name}.{index['name']} to {index['expireAfterSeconds']}s")
+        return True
+    except OperationFailure as e:
+        logger.error(f"Could not update TTL of {collection_name}.{index['name']}: {e}")
+        return False
+
+
+async def report_indexes(db) -> Dict[str, Any]:
+    """
+    Compare declared indexes with the database
+
+    missing: declared but not present
+    unused:  present but with no recorded use since the server started ($indexStats)
+    """
+    report: Dict[str, Any] = {"missing": {}, "unused": {}}
+
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+
+        missing = [model.document["name"] for model in models if model.document["name"] not in existing]
+        if missing:
+            report["missing"][collection_name] = missing
+
+        try:
+            stats = await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+        except OperationFailure as e:
+            logger.warning(f"$indexStats not available on {collection_name}: {e}")
+            continue
+
+        unused = [
+            stat["name"] for stat in stats
+            if stat["name"] != "_id_" and stat.get("accesses", {}).get("ops", 0) == 0
+        ]
+        if unused:
+            report["unused"][collection_name] = sorted(unused)
+
+    return report
+
+
+async def main():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+
+    failed = await ensure_indexes(db)
+    report = await report_indexes(db)
+
+    print("🔄 Index check")
+    print("=" * 50)
+    for collection_name, names in failed.items():
+        print(f"❌ Failed on {collection_name}: {', '.join(names)}")
+    for collection_name, names in report["missing"].items():
+        print(f"⚠️  Missing on {collection_name}: {', '.join(names)}")
+    for collection_name, names in report["unused"].items():
+        print(f"ℹ️  Unused on {collection_name}: {', '.join(names)}")
+    if not failed and not report["missing"]:
+        print("✅ All declared indexes are present")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
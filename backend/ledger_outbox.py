@@ -0,0 +1,117 @@
+"""
+Ledger outbox
+Redemption is one guarded find_one_and_update on the customer: it only
+matches while active_points covers the amount, and in the same atomic
+document write it pushes the redemption transaction onto the customer's
+`pending_ledger` array. Two terminals redeeming at once can therefore never
+overdraw a balance, and the POS waits for a single round trip.
+
+drain_customer moves pending entries to points_transactions, the points
+lots and the daily_stats rollup after the response has been sent;
+drain_pending_ledger (run by the cron loop) sweeps up entries left behind by
+a process that stopped before draining. The transaction is written with the
+steps still to do in `pending_steps`, so a drain that stopped after the
+insert finishes the remaining steps the next time instead of skipping them.
+"""
+import logging
+from typing import Any, Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from daily_stats import StatsDelta, apply_delta
+from points_lots import consume_lots
+from report_cache import bump_report_generation
+
+logger = logging.getLogger(__name__)
+
+# Customers drained per sweep
+LEDGER_DRAIN_LIMIT = 1000
+
+
+async def redeem_points(db, phone: str, points: float, transaction_doc: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Deduct `points` if the balance covers them and queue the ledger entry
+    (customer_id is filled in when it is drained). Returns the customer after
+    the update, or None when the customer does not exist or the balance is
+    insufficient.
+    """
+    return await db.customers.find_one_and_update(
+        {"phone": phone, "active_points": {"$gte": points}},
+        {
+            "$inc": {"active_points": -points, "redeemed_points": points},
+            "$set": {"updated_at": transaction_doc["created_at"]},
+            "$push": {"pending_ledger": transaction_doc}
+        },
+        projection={"_id": 0, "id": 1, "active_points": 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def _finish_step(db, transaction_id: str, step: str):
+    """Mark a step done; stats is always the last one and drops the field"""
+    if step == "stats":
+        update = {"$unset": {"pending_steps": ""}}
+    else:
+        update = {"$pull": {"pending_steps": step}}
+    await db.points_transactions.update_one({"id": transaction_id}, update)
+
+
+async def _write_entry(db, customer_id: str, entry: Dict[str, Any]):
+    """Write one outbox entry, or finish the steps a previous drain left undone"""
+    steps = (["lots"] if entry["transaction_type"] == "redeemed" else []) + ["stats"]
+    transaction = {**entry, "customer_id": customer_id, "pending_steps": steps}
+    try:
+        await db.points_transactions.insert_one(transaction)
+    except DuplicateKeyError:
+        stored = await db.points_transactions.find_one({"id": entry["id"]}, {"_id": 0, "pending_steps": 1})
+        steps = (stored or {}).get("pending_steps") or []
+
+    if "lots" in steps:
+        # Idempotent per transaction id: only what is still missing is taken
+        _, shortfall = await consume_lots(db, customer_id, abs(entry["points"]), transaction_id=entry["id"])
+        if shortfall > 0:
+            logger.warning(f"Redemption for customer {customer_id}: {shortfall:.2f} points not covered by open lots")
+        await _finish_step(db, entry["id"], "lots")
+    if "stats" in steps:
+        # Not record_transaction: a failed rollup write must leave the step pending
+        delta = StatsDelta()
+        delta.add_transaction(transaction)
+        await apply_delta(db, delta)
+        await _finish_step(db, entry["id"], "stats")
+
+
+async def drain_customer(db, customer_id: str) -> int:
+    """Move a customer's pending ledger entries to points_transactions"""
+    customer = await db.customers.find_one({"id": customer_id}, {"_id": 0, "pending_ledger": 1})
+    entries = (customer or {}).get("pending_ledger") or []
+    for entry in entries:
+        await _write_entry(db, customer_id, entry)
+        await db.customers.update_one({"id": customer_id}, {"$pull": {"pending_ledger": {"id": entry["id"]}}})
+    if entries:
+        await bump_report_generation(db)
+    return len(entries)
+
+
+async def drain_customer_safely(db, customer_id: str):
+    """Background task after a redemption; the cron sweep retries on failure"""
+    try:
+        await drain_customer(db, customer_id)
+    except Exception as e:
+        logger.error(f"Failed to drain ledger of customer {customer_id}: {e}")
+
+
+async def drain_pending_ledger(db, limit: int = LEDGER_DRAIN_LIMIT) -> Dict[str, Any]:
+    """Drain every customer that still has pending entries (pending_ledger_id index)"""
+    stats = {"customers": 0, "entries": 0, "errors": 0}
+    customers = await db.customers.find(
+        {"pending_ledger.id": {"$exists": True}}, {"_id": 0, "id": 1}
+    ).to_list(limit)
+    for customer in customers:
+        try:
+            stats["entries"] += await drain_customer(db, customer["id"])
+            stats["customers"] += 1
+        except Exception as e:
+            logger.error(f"Failed to drain ledger of customer {customer['id']}: {e}")
+            stats["errors"] += 1
+    return stats
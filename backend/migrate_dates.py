@@ -0,0 +1,149 @@
+"""
+Script to migrate timestamp fields from ISO strings to native BSON dates
+
+Resumable and batched: every (collection, field) pair is walked in _id order
+and its progress is stored in the `migrations` collection, so an interrupted
+run continues where it stopped. Already converted documents no longer match
+the {"$type": "string"} filter and are never rewritten.
+
+The daily_stats rollup only counts BSON dates, and the server does not build
+it while these strings remain. When a run converts any of the dates the
+rollup is keyed on, it rebuilds the rollup at the end (stop the sync first).
+
+Usage: python migrate_dates.py [--batch-size 500] [--dry-run]
+"""
+import argparse
+import asyncio
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+from daily_stats import ROLLUP_DATE_FIELDS, rebuild_and_mark
+from models import parse_datetime
+
+# Timestamp fields stored as isoformat() strings before the migration
+DATE_FIELDS = {
+    "customers": ["created_at", "updated_at", "suspended_at"],
+    "invoices": ["invoice_date", "synced_at"],
+    "points_transactions": ["created_at", "expires_at"],
+    "admins": ["created_at", "updated_at"],
+    "settings": ["updated_at"],
+    "system_settings": ["updated_at"],
+    "trusted_devices": ["created_at", "expires_at", "last_used_at"],
+    "otp_codes": ["created_at", "expires_at"],
+    "audit_logs": ["timestamp"],
+}
+
+
+def migrate_field(db, collection_name: str, field: str, batch_size: int, dry_run: bool = False):
+    """
+    Convert one field of one collection in batches
+    Returns (converted, unparseable)
+    """
+    collection = db[collection_name]
+    checkpoint_key = f"dates:{collection_name}.{field}"
+    checkpoint = db.migrations.find_one({"key": checkpoint_key}) or {}
+    if checkpoint.get("done"):
+        return 0, 0
+
+    last_id = checkpoint.get("last_id")
+    converted = 0
+    unparseable = 0
+
+    while True:
+        query = {field: {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+
+        batch = list(collection.find(query, {"_id": 1, field: 1}).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        operations = []
+        for doc in batch:
+            value = parse_datetime(doc[field])
+            if value is None:
+                # Empty strings become null; anything else is left for manual review
+                if doc[field] == "":
+                    operations.append(UpdateOne({"_id": doc["_id"], field: ""}, {"$set": {field: None}}))
+                else:
+                    unparseable += 1
+                    print(f"   ⚠️  {collection_name}.{field} {doc['_id']}: cannot parse {doc[field]!r}")
+                continue
+            # Guard on the original value so concurrent writes are not overwritten
+            operations.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: value}}))
+
+        if operations and not dry_run:
+            result = collection.bulk_write(operations, ordered=False)
+            converted += result.modified_count
+        else:
+            converted += len(operations)
+
+        last_id = batch[-1]["_id"]
+        if not dry_run:
+            db.migrations.update_one(
+                {"key": checkpoint_key},
+                {"$set": {"last_id": last_id, "done": False}},
+                upsert=True
+            )
+
+    if not dry_run:
+        db.migrations.update_one({"key": checkpoint_key}, {"$set": {"done": True}}, upsert=True)
+
+    return converted, unparseable
+
+
+async def _rebuild_daily_stats(mongo_url: str, db_name: str) -> int:
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(mongo_url, tz_aware=True)
+    try:
+        return await rebuild_and_mark(client[db_name])
+    finally:
+        client.close()
+
+
+def migrate_dates(batch_size: int = 500, dry_run: bool = False):
+    load_dotenv(Path(__file__).parent / '.env')
+    mongo_url = os.getenv('MONGO_URL', 'mongodb://localhost:27017')
+    client = MongoClient(mongo_url, tz_aware=True)
+    db_name = os.getenv('DB_NAME', 'alreef_loyalty')
+    db = client[db_name]
+
+    print("🔄 Migrating timestamps to native dates" + (" (dry run)" if dry_run else ""))
+    print("=" * 50)
+
+    total_converted = 0
+    total_unparseable = 0
+    rollup_converted = 0
+    for collection_name, fields in DATE_FIELDS.items():
+        for field in fields:
+            converted, unparseable = migrate_field(db, collection_name, field, batch_size, dry_run)
+            total_converted += converted
+            total_unparseable += unparseable
+            if (collection_name, field) in ROLLUP_DATE_FIELDS:
+                rollup_converted += converted
+            if converted or unparseable:
+                print(f"✓ {collection_name}.{field}: {converted} converted, {unparseable} skipped")
+
+    print("\n" + "=" * 50)
+    print(f"✅ Converted {total_converted} values")
+    if total_unparseable:
+        print(f"⚠️  {total_unparseable} values could not be parsed and were left as strings")
+
+    client.close()
+
+    if rollup_converted and not dry_run:
+        print("🔄 Rebuilding daily stats with the converted dates...")
+        days = asyncio.run(_rebuild_daily_stats(mongo_url, db_name))
+        print(f"✅ Wrote {days} days")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate ISO string timestamps to BSON dates")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    migrate_dates(batch_size=args.batch_size, dry_run=args.dry_run)
@@ -4,6 +4,30 @@ from datetime import datetime, timezone
 import uuid
 import re
 
+def parse_datetime(value) -> Optional[datetime]:
+    """
+    Convert a stored or external timestamp to an aware UTC datetime
+    Accepts datetimes and ISO strings ("Z" suffix, offsets or no timezone,
+    which is treated as UTC). Returns None for empty or unparseable values.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        dt = value
+    elif isinstance(value, str):
+        text = value.strip()
+        if text.endswith("Z") or text.endswith("z"):
+            text = text[:-1] + "+00:00"
+        try:
+            dt = datetime.fromisoformat(text)
+        except ValueError:
+            return None
+    else:
+        return None
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
 class Customer(BaseModel):
     model_config = ConfigDict(extra="ignore")
     
@@ -18,7 +42,7 @@ class Customer(BaseModel):
     redeemed_points: float = 0.0
     is_active: bool = True  # Account status
     suspension_reason: Optional[str] = None  # Reason for suspension
-    suspended_at: Optional[str] = None  # When account was suspended
+    suspended_at: Optional[datetime] = None  # When account was suspended
     suspended_by: Optional[str] = None  # Who suspended the account
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -126,6 +150,7 @@ class PointsTransaction(BaseModel):
     invoice_id: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     expires_at: Optional[datetime] = None
+    remaining_points: Optional[float] = None  # unspent part of an earned/manual_add lot
 
 class Settings(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -0,0 +1,119 @@
+"""
+Keyset (cursor) pagination helpers
+A cursor is an opaque token holding the (sort key, id) of the last item of a
+page; the next page starts strictly after it, so every page costs one index
+range scan however deep it is. Offset pagination stays available for old
+clients.
+"""
+import base64
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import json_util
+from bson.json_util import JSONOptions
+
+# Largest page the list endpoints accept (validated there with Query(le=...))
+MAX_PAGE_SIZE = 500
+# Seconds a filtered count_documents result is reused for list totals
+COUNT_CACHE_TTL = float(os.getenv('COUNT_CACHE_TTL', 30))
+COUNT_CACHE_MAX_ENTRIES = 256
+
+_JSON_OPTIONS = JSONOptions(tz_aware=True)
+
+# (collection name, query) -> (stored_at monotonic, count)
+_count_cache: Dict[Tuple[str, str], Tuple[float, int]] = {}
+
+
+class InvalidCursor(ValueError):
+    """Raised for cursors that were not produced by encode_cursor"""
+
+
+def encode_cursor(sort_value: Any, item_id: str) -> str:
+    """Opaque token for the position after (sort_value, item_id)"""
+    raw = json_util.dumps({"v": sort_value, "id": item_id}, json_options=_JSON_OPTIONS)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, str]:
+    """
+    (sort_value, item_id) of a cursor
+    Only plain values are accepted: they go straight into the query, where a
+    crafted document could carry operators.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json_util.loads(base64.urlsafe_b64decode(padded.encode("ascii")), json_options=_JSON_OPTIONS)
+        sort_value, item_id = data["v"], data["id"]
+    except Exception:
+        raise InvalidCursor("Invalid cursor")
+    if isinstance(sort_value, bool) or not isinstance(sort_value, (datetime, str, int, float)):
+        raise InvalidCursor("Invalid cursor")
+    if not isinstance(item_id, str):
+        raise InvalidCursor("Invalid cursor")
+    return sort_value, item_id
+
+
+def keyset_query(query: Dict[str, Any], sort_field: str, cursor: Optional[str]) -> Dict[str, Any]:
+    """Restrict `query` to items after the cursor in (sort_field desc, id desc) order"""
+    if not cursor:
+        return query
+    sort_value, item_id = decode_cursor(cursor)
+    after = {
+        "$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "id": {"$lt": item_id}}
+        ]
+    }
+    return {"$and": [query, after]} if query else after
+
+
+async def fetch_page(
+    collection,
+    query: Dict[str, Any],
+    sort_field: str,
+    limit: int,
+    cursor: Optional[str] = None,
+    offset: int = 0,
+    projection: Optional[Dict[str, Any]] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    One page sorted newest first by (sort_field, id)
+    Uses the cursor when given, otherwise the legacy offset.
+    Returns (items, next_cursor); next_cursor is None on the last page.
+    """
+    find = collection.find(keyset_query(query, sort_field, cursor), projection or {"_id": 0})
+    find = find.sort([(sort_field, -1), ("id", -1)])
+    if offset and not cursor:
+        find = find.skip(offset)
+    # One extra item tells whether there is a next page
+    items = await find.limit(limit + 1).to_list(limit + 1)
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(last.get(sort_field), last["id"])
+    return items, next_cursor
+
+
+async def cached_count(collection, query: Dict[str, Any]) -> int:
+    """
+    Total for a list endpoint without counting on every page
+    Unfiltered totals use the collection metadata; filtered ones are counted
+    and reused for COUNT_CACHE_TTL seconds.
+    """
+    if not query:
+        return await collection.estimated_document_count()
+
+    key = (collection.name, json_util.dumps(query, sort_keys=True))
+    cached = _count_cache.get(key)
+    if cached and time.monotonic() - cached[0] < COUNT_CACHE_TTL:
+        return cached[1]
+
+    count = await collection.count_documents(query)
+    if len(_count_cache) >= COUNT_CACHE_MAX_ENTRIES:
+        _count_cache.pop(next(iter(_count_cache)))
+    _count_cache[key] = (time.monotonic(), count)
+    return count
@@ -0,0 +1,244 @@
+"""
+Points expiry engine
+Expires what is left of points lots (see points_lots.py) whose expires_at has
+passed, in batches walked through the open_lots_expires_at index:
+
+1. read up to EXPIRY_BATCH_SIZE due open lots, oldest expiry first
+2. journal the batch in `expiry_batches` (lot ids and remaining points)
+3. apply it with bulk operations:
+   - the lots are closed: remaining_points moves to expired_points (bulk_write)
+   - one `expired` transaction per customer (insert_many)
+   - one $inc per customer (bulk_write)
+4. mark the journal entry done and add the batch to daily_stats
+
+Lots are closed with a guard on the remaining_points that was read, so a lot
+a redemption consumed in between is skipped and picked up again with its new
+balance. The customer amounts are read back from the lots this batch closed,
+and every step is idempotent (deterministic transaction ids, a per-customer
+last_expiry_batch guard), so a run that dies mid-batch replays the pending
+journal entry on the next run and never deducts twice. Only one run should
+be active at a time (the daily cron job).
+
+Usage: python points_expiry.py [--batch-size 1000] [--dry-run]
+"""
+import argparse
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from daily_stats import StatsDelta, apply_delta
+from points_lots import open_lots_query
+from report_cache import bump_report_generation
+
+EXPIRY_BATCH_SIZE = int(os.getenv('EXPIRY_BATCH_SIZE', 1000))
+# Finished journal entries are kept this long for inspection
+EXPIRY_JOURNAL_DAYS = 30
+
+LAST_RUN_KEY = "points_expiry_last_run"
+DUPLICATE_KEY_ERROR = 11000
+
+_TRANSACTION_NAMESPACE = uuid.UUID("8f0d54a2-5b7e-4a53-9d61-2f1f3c6e7a10")
+
+
+def due_lots_query(now: datetime) -> Dict[str, Any]:
+    return {**open_lots_query(), "expires_at": {"$lte": now}}
+
+
+def expiry_transaction_id(batch_id: str, customer_id: str) -> str:
+    """Same id on every replay of a batch, so the insert is idempotent"""
+    return str(uuid.uuid5(_TRANSACTION_NAMESPACE, f"{batch_id}:{customer_id}"))
+
+
+def build_batch(lots: List[Dict[str, Any]], now: datetime) -> Dict[str, Any]:
+    """Journal entry for a batch of due lots"""
+    return {
+        "_id": str(uuid.uuid4()),
+        "state": "pending",
+        "lots": [{"_id": lot["_id"], "points": lot["remaining_points"]} for lot in lots],
+        "created_at": now,
+    }
+
+
+def customer_decrements(closed_lots: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Expired points and lots per customer, as a list: customer ids are not safe as field names"""
+    decrements: Dict[str, Dict[str, Any]] = {}
+    for lot in closed_lots:
+        item = decrements.setdefault(lot["customer_id"], {"customer_id": lot["customer_id"], "points": 0, "lots": 0})
+        item["points"] += lot.get("expired_points", 0)
+        item["lots"] += 1
+    return list(decrements.values())
+
+
+async def apply_batch(db, batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Write a journalled batch; safe to call again after a partial failure
+    Returns the points expired per customer.
+    """
+    batch_id = batch["_id"]
+    now = batch["created_at"]
+
+    await db.points_transactions.bulk_write([
+        UpdateOne(
+            {"_id": lot["_id"], "remaining_points": lot["points"]},
+            {"$set": {"remaining_points": 0, "expired_points": lot["points"], "expiry_batch": batch_id}}
+        )
+        for lot in batch["lots"]
+    ], ordered=False)
+
+    closed_lots = await db.points_transactions.find(
+        {"_id": {"$in": [lot["_id"] for lot in batch["lots"]]}, "expiry_batch": batch_id},
+        {"_id": 0, "customer_id": 1, "expired_points": 1}
+    ).to_list(None)
+    decrements = customer_decrements(closed_lots)
+
+    if decrements:
+        transactions = [
+            {
+                "id": expiry_transaction_id(batch_id, item["customer_id"]),
+                "customer_id": item["customer_id"],
+                "transaction_type": "expired",
+                "points": -item["points"],
+                "description": "نقاط منتهية الصلاحية | Expired points",
+                "expiry_batch": batch_id,
+                "created_at": now,
+            }
+            for item in decrements
+        ]
+        try:
+            await db.points_transactions.insert_many(transactions, ordered=False)
+        except BulkWriteError as e:
+            # On replay the transactions already written are rejected by id_unique
+            if any(err.get("code") != DUPLICATE_KEY_ERROR for err in e.details.get("writeErrors", [])):
+                raise
+
+        await db.customers.bulk_write([
+            UpdateOne(
+                {"id": item["customer_id"], "last_expiry_batch": {"$ne": batch_id}},
+                {
+                    "$inc": {"active_points": -item["points"], "expired_points": item["points"]},
+                    "$set": {"last_expiry_batch": batch_id, "updated_at": now}
+                }
+            )
+            for item in decrements
+        ], ordered=False)
+
+    # Count the batch in the rollup once: only the call that closes the journal does it
+    closed = await db.expiry_batches.find_one_and_update(
+        {"_id": batch_id, "state": "pending"},
+        {"$set": {"state": "done", "completed_at": datetime.now(timezone.utc)}}
+    )
+    if closed is not None:
+        delta = StatsDelta()
+        delta.add(now, expired=sum(item["points"] for item in decrements))
+        await apply_delta(db, delta)
+    return decrements
+
+
+async def expire_points(
+    db,
+    now: Optional[datetime] = None,
+    batch_size: int = EXPIRY_BATCH_SIZE,
+    dry_run: bool = False
+) -> Dict[str, Any]:
+    """Expire every lot due at `now`; returns run statistics"""
+    now = now or datetime.now(timezone.utc)
+    started_at = time.monotonic()
+    stats = {"lots": 0, "customer_updates": 0, "points": 0.0, "batches": 0, "replayed": 0}
+    query = due_lots_query(now)
+
+    if dry_run:
+        return await _count_due(db, query, stats, started_at)
+
+    # Batches interrupted by a previous run
+    async for pending in db.expiry_batches.find({"state": "pending"}).sort("created_at", 1):
+        await apply_batch(db, pending)
+        stats["replayed"] += 1
+
+    # Closed lots leave the query, so every batch starts from the front again
+    while True:
+        lots = await db.points_transactions.find(
+            query, {"_id": 1, "remaining_points": 1}
+        ).sort("expires_at", 1).limit(max(1, batch_size)).to_list(None)
+        if not lots:
+            break
+
+        batch = build_batch(lots, now)
+        await db.expiry_batches.insert_one(batch)
+        decrements = await apply_batch(db, batch)
+
+        stats["lots"] += sum(item["lots"] for item in decrements)
+        stats["customer_updates"] += len(decrements)
+        stats["points"] += sum(item["points"] for item in decrements)
+        stats["batches"] += 1
+
+    elapsed = time.monotonic() - started_at
+    stats["points"] = round(stats["points"], 2)
+    stats["seconds"] = round(elapsed, 2)
+    stats["lots_per_second"] = round(stats["lots"] / elapsed, 1) if elapsed > 0 else 0.0
+
+    if stats["lots"] or stats["replayed"]:
+        await bump_report_generation(db)
+    await db.expiry_batches.delete_many({
+        "state": "done", "completed_at": {"$lt": now - timedelta(days=EXPIRY_JOURNAL_DAYS)}
+    })
+    await db.system_settings.update_one(
+        {"key": LAST_RUN_KEY},
+        {"$set": {"value": {**stats, "ran_at": now}, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return stats
+
+
+async def _count_due(db, query: Dict[str, Any], stats: Dict[str, Any], started_at: float) -> Dict[str, Any]:
+    """Dry run: what a run would expire, without writing"""
+    rows = await db.points_transactions.aggregate([
+        {"$match": query},
+        {"$group": {"_id": "$customer_id", "lots": {"$sum": 1}, "points": {"$sum": "$remaining_points"}}},
+        {"$group": {"_id": None, "customers": {"$sum": 1}, "lots": {"$sum": "$lots"}, "points": {"$sum": "$points"}}}
+    ]).to_list(1)
+    row = rows[0] if rows else {"customers": 0, "lots": 0, "points": 0}
+    elapsed = time.monotonic() - started_at
+    return {
+        **stats,
+        "lots": row["lots"],
+        "customer_updates": row["customers"],
+        "points": round(row["points"], 2),
+        "seconds": round(elapsed, 2),
+        "lots_per_second": 0.0,
+        "dry_run": True,
+    }
+
+
+async def main():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Expire due points lots")
+    parser.add_argument("--batch-size", type=int, default=EXPIRY_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="Only count what would expire")
+    args = parser.parse_args()
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+
+    print("🔄 Expiring points" + (" (dry run)" if args.dry_run else ""))
+    print("=" * 50)
+    stats = await expire_points(db, batch_size=args.batch_size, dry_run=args.dry_run)
+    print(f"✓ Lots: {stats['lots']} in {stats['batches']} batches ({stats['lots_per_second']} lots/s)")
+    print(f"✓ Customer updates: {stats['customer_updates']}, points: {stats['points']}")
+    if stats["replayed"]:
+        print(f"✓ Interrupted batches replayed: {stats['replayed']}")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,223 @@
+"""
+Points lots
+Every earned and manual_add transaction is a lot: it carries a
+`remaining_points` balance next to its `points`. Deductions (redemptions,
+return invoices) consume the open lots of a customer oldest expiry first, so
+expiry and the "expiring soon" numbers only count points that are still
+unspent. Open lots (remaining_points > 0) are served by two partial indexes
+declared in indexes.py: per customer in consumption order, and by expiry date.
+
+Lots written before remaining_points existed are initialised once by the
+backfill: each customer's active_points is assigned to their newest lots,
+which is what consuming oldest first would have left.
+
+Rebuild: python points_lots.py [--batch-size 1000]
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+# Transaction types that create a lot
+LOT_TYPES = ["earned", "manual_add"]
+# Guarded updates that lose a race are retried with a fresh read this often
+CONSUME_ATTEMPTS = 3
+# Window of the "expiring soon" numbers
+EXPIRING_SOON_DAYS = 30
+
+BACKFILL_KEY = "points_lots_backfill"
+
+
+def open_lots_query(customer_id: Optional[str] = None) -> Dict[str, Any]:
+    """Lots with points left; matches the partial indexes on remaining_points"""
+    query: Dict[str, Any] = {"remaining_points": {"$gt": 0}}
+    if customer_id is not None:
+        query["customer_id"] = customer_id
+    return query
+
+
+async def expiring_soon(db, customer_id: str, now: Optional[datetime] = None, days: int = EXPIRING_SOON_DAYS) -> float:
+    """Points of the customer that expire within `days`, summed by the server on customer_id_open_lots"""
+    now = now or datetime.now(timezone.utc)
+    rows = await db.points_transactions.aggregate([
+        {"$match": {**open_lots_query(customer_id), "expires_at": {"$gte": now, "$lte": now + timedelta(days=days)}}},
+        {"$group": {"_id": None, "points": {"$sum": "$remaining_points"}}}
+    ]).to_list(1)
+    return rows[0]["points"] if rows else 0
+
+
+def plan_consumption(lots: List[Dict[str, Any]], points: float) -> List[Tuple[Dict[str, Any], float]]:
+    """(lot, amount) pairs taking `points` from lots in the given order"""
+    plan = []
+    left = points
+    for lot in lots:
+        if left <= 0:
+            break
+        take = min(lot["remaining_points"], left)
+        plan.append((lot, take))
+        left -= take
+    return plan
+
+
+async def consumed_by(db, customer_id: str, transaction_id: str) -> float:
+    """Points a deduction already took from the customer's lots (see consume_lots)"""
+    rows = await db.points_transactions.aggregate([
+        {"$match": {"customer_id": customer_id, "consumed_by.id": transaction_id}},
+        {"$unwind": "$consumed_by"},
+        {"$match": {"consumed_by.id": transaction_id}},
+        {"$group": {"_id": None, "points": {"$sum": "$consumed_by.points"}}}
+    ]).to_list(1)
+    return rows[0]["points"] if rows else 0
+
+
+async def consume_lots(
+    db,
+    customer_id: str,
+    points: float,
+    transaction_id: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], float]:
+    """
+    Deduct `points` from the customer's open lots, oldest expiry first
+    Each lot is updated with a guard on the balance that was read, so
+    concurrent deductions never take the same points twice. Returns the
+    consumed amounts per lot and the shortfall (points no open lot covered).
+
+    With a transaction_id every lot records the running total the deduction
+    took from it in one `consumed_by` entry, and a repeated call only takes
+    what is still missing, so a drain or sync that stopped half way can simply
+    call it again. The update is also guarded on the total that was read, so
+    a lot partly taken by an earlier attempt can still give the rest while an
+    update repeated with the same read is a no-op.
+    """
+    consumed: List[Dict[str, Any]] = []
+    left = points
+    projection: Dict[str, Any] = {"_id": 1, "id": 1, "remaining_points": 1}
+    if transaction_id is not None:
+        left -= await consumed_by(db, customer_id, transaction_id)
+        projection["consumed_by"] = {"$elemMatch": {"id": transaction_id}}
+    for _ in range(CONSUME_ATTEMPTS):
+        if left <= 0:
+            break
+        lots = await db.points_transactions.find(
+            open_lots_query(customer_id), projection
+        ).sort([("expires_at", 1), ("_id", 1)]).to_list(None)
+        if not lots:
+            break
+
+        for lot, take in plan_consumption(lots, left):
+            if take >= lot["remaining_points"]:
+                # Whole lot: set to exactly 0 so no float residue keeps it open
+                update: Dict[str, Any] = {"$set": {"remaining_points": 0}}
+                guard = lot["remaining_points"]
+            else:
+                update = {"$inc": {"remaining_points": -take}}
+                guard = {"$gte": take}
+            lot_filter = {"_id": lot["_id"], "remaining_points": guard}
+            if transaction_id is not None:
+                recorded = lot.get("consumed_by") or []
+                if recorded:
+                    lot_filter["consumed_by"] = {"$elemMatch": {"id": transaction_id, "points": recorded[0]["points"]}}
+                    update.setdefault("$inc", {})["consumed_by.$.points"] = take
+                else:
+                    lot_filter["consumed_by.id"] = {"$ne": transaction_id}
+                    update["$push"] = {"consumed_by": {"id": transaction_id, "points": take}}
+            result = await db.points_transactions.update_one(lot_filter, update)
+            if result.modified_count:
+                consumed.append({"lot_id": lot.get("id"), "points": take})
+                left -= take
+
+    return consumed, max(left, 0)
+
+
+def allocate_remaining(lots: List[Dict[str, Any]], balance: float) -> Tuple[List[Tuple[Dict[str, Any], float]], float]:
+    """
+    Split a balance over lots ordered newest expiry first
+    Returns (lot, remaining_points) for every lot and the part of the balance
+    no lot covers.
+    """
+    allocation = []
+    left = max(balance, 0)
+    for lot in lots:
+        remaining = min(lot.get("points", 0), left)
+        allocation.append((lot, remaining))
+        left -= remaining
+    return allocation, left
+
+
+async def backfill_lots(db, batch_size: int = 1000) -> Dict[str, Any]:
+    """Set remaining_points on every unexpired lot from the owner's active_points"""
+    started_at = time.monotonic()
+    stats = {"customers": 0, "lots": 0, "open_lots": 0, "unbacked_points": 0.0, "unbacked_customers": 0}
+    operations: List[UpdateOne] = []
+
+    async for customer in db.customers.find({}, {"_id": 0, "id": 1, "active_points": 1}):
+        lots = await db.points_transactions.find(
+            {"customer_id": customer["id"], "transaction_type": {"$in": LOT_TYPES}, "expires_at": {"$exists": True}},
+            {"_id": 1, "points": 1}
+        ).sort([("expires_at", -1), ("_id", -1)]).to_list(None)
+
+        allocation, unbacked = allocate_remaining(lots, customer.get("active_points", 0))
+        for lot, remaining in allocation:
+            operations.append(UpdateOne({"_id": lot["_id"]}, {"$set": {"remaining_points": remaining}}))
+            if remaining > 0:
+                stats["open_lots"] += 1
+        stats["customers"] += 1
+        stats["lots"] += len(lots)
+        if unbacked > 0:
+            # Balance without lots behind it (legacy data); reported by the reconciliation
+            stats["unbacked_points"] += unbacked
+            stats["unbacked_customers"] += 1
+
+        if len(operations) >= batch_size:
+            await db.points_transactions.bulk_write(operations, ordered=False)
+            operations = []
+
+    if operations:
+        await db.points_transactions.bulk_write(operations, ordered=False)
+
+    stats["unbacked_points"] = round(stats["unbacked_points"], 2)
+    stats["seconds"] = round(time.monotonic() - started_at, 2)
+    await db.system_settings.update_one(
+        {"key": BACKFILL_KEY},
+        {"$set": {"value": stats, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return stats
+
+
+async def ensure_lots_backfilled(db) -> Optional[Dict[str, Any]]:
+    """Run the backfill once per database; returns its stats when it ran"""
+    if await db.system_settings.find_one({"key": BACKFILL_KEY}, {"_id": 1}):
+        return None
+    return await backfill_lots(db)
+
+
+async def main():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Rebuild remaining_points of points lots")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+
+    print("🔄 Rebuilding points lots")
+    print("=" * 50)
+    stats = await backfill_lots(db, batch_size=args.batch_size)
+    print(f"✓ Customers: {stats['customers']}, lots: {stats['lots']}, open: {stats['open_lots']} ({stats['seconds']}s)")
+    if stats["unbacked_customers"]:
+        print(f"⚠️  {stats['unbacked_customers']} customers hold {stats['unbacked_points']} points not backed by lots")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+"""
+Rate limiting for every route
+Pure ASGI middleware in front of the API. The app's routes are compiled once
+(on lifespan startup, or on the first request) into a table mapping request
+paths to route templates: static paths are a dict lookup, paths with
+parameters are matched against the routes' own regexes. Each request then
+costs one table lookup and one limiter hit.
+
+Limits come from rate_limiter.limits, keyed by route template; routes not
+listed there share the "default" limit per template, so /admin/customers/{id}
+is one bucket, not one per customer. Unknown paths (404s, scanners) all fall
+into a single "default" bucket per client.
+
+Every response carries the RateLimit-* headers; denied requests get a 429
+with Retry-After and the usual {"detail": ...} body.
+"""
+import json
+import re
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+
+from starlette.requests import Request
+
+from rate_limiter import RateLimiter, rate_limit_message, rate_limiter as default_rate_limiter
+
+# CORS preflights carry no credentials and must not use up a client's quota
+EXEMPT_METHODS = {"OPTIONS"}
+
+
+class RouteTable:
+    """Request path -> route template, built once from the app's routes"""
+
+    def __init__(self, routes: Iterable, limits: Dict[str, Tuple[int, int]]):
+        self.exact: Dict[str, str] = {}
+        self.patterns: List[Tuple[Pattern, str]] = []
+        for route in routes:
+            path = getattr(route, "path", None)
+            if not path:
+                continue
+            if "{" in path:
+                self.patterns.append((getattr(route, "path_regex", None) or re.compile(f"^{path}$"), path))
+            else:
+                self.exact[path] = path
+
+        known = set(self.exact) | {template for _, template in self.patterns}
+        self.unrouted_limits = sorted(set(limits) - known - {"default"})
+        if self.unrouted_limits:
+            print(f"⚠️ Rate limits configured for unknown routes: {self.unrouted_limits}")
+
+    def match(self, path: str) -> str:
+        template = self.exact.get(path)
+        if template is not None:
+            return template
+        for regex, template in self.patterns:
+            if regex.match(path):
+                return template
+        return "default"
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, limiter: Optional[RateLimiter] = None):
+        self.app = app
+        self.limiter = limiter or default_rate_limiter
+        self.table: Optional[RouteTable] = None
+
+    def compile(self, routes: Iterable):
+        self.table = RouteTable(routes, self.limiter.limits)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan" and self.table is None and "app" in scope:
+            self.compile(scope["app"].routes)
+        if scope["type"] != "http" or scope["method"] in EXEMPT_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        if self.table is None:
+            self.compile(scope["app"].routes)
+
+        endpoint = self.table.match(scope["path"])
+        ip = self.limiter._get_client_ip(Request(scope))
+        result = await self.limiter.hit(ip, endpoint)
+        headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in result.headers().items()]
+
+        if not result.allowed:
+            body = json.dumps({"detail": rate_limit_message(result.retry_after)}, ensure_ascii=False).encode("utf-8")
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("latin-1")),
+                ] + headers,
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
@@ -0,0 +1,296 @@
+"""
+Storage backends for the rate limiter
+Every backend keeps, per key, the request count of the current and previous
+fixed window and offers one atomic operation: roll the window forward, then
+count the request if the sliding estimate leaves room for it.
+
+RATE_LIMIT_BACKEND selects the backend:
+- memory: counters in this process (default, development / single worker)
+- mongo:  one document per key in `rate_limits`, updated with a single
+          find_one_and_update pipeline; a TTL index removes idle keys
+- shm:    a fixed-size table in POSIX shared memory guarded by an flock, for
+          several workers on one host
+"""
+import asyncio
+import hashlib
+import os
+import struct
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+# Maximum keys kept by the memory backend; least recently seen are evicted
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100_000))
+# Shared memory table: segment name and number of slots (32 bytes each)
+RATE_LIMIT_SHM_NAME = os.getenv('RATE_LIMIT_SHM_NAME', 'walreef_rate_limits')
+RATE_LIMIT_SHM_SLOTS = int(os.getenv('RATE_LIMIT_SHM_SLOTS', 65_536))
+# Wait between attempts at the shared memory lock (seconds, doubled up to the max)
+SHM_LOCK_RETRY = 0.0005
+SHM_LOCK_RETRY_MAX = 0.01
+
+
+class WindowCounts(NamedTuple):
+    allowed: bool
+    previous: int  # requests counted in the previous window
+    current: int   # requests counted in the current window, including this one if allowed
+
+
+def roll_window(start: Optional[int], previous: int, current: int,
+                window_start: int, window_seconds: int) -> Tuple[int, int]:
+    """(previous, current) counts as seen from the window starting at window_start"""
+    if start == window_start:
+        return previous, current
+    # The stored current window becomes the previous one only if they are adjacent
+    return (current if start == window_start - window_seconds else 0), 0
+
+
+def _fits(previous: int, current: int, previous_weight: float, max_requests: int) -> bool:
+    return previous * previous_weight + current + 1 <= max_requests
+
+
+class MemoryStore:
+    """Counters in process memory, in an LRU map capped at max_keys"""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        # key -> [window_start, previous_count, current_count]
+        self.windows: "OrderedDict[str, list]" = OrderedDict()
+        self.max_keys = max(1, max_keys)
+        self.evicted = 0
+
+    async def hit(self, key: str, window_start: int, window_seconds: int,
+                  previous_weight: float, max_requests: int) -> WindowCounts:
+        # No await before the update, so it is atomic on the event loop
+        entry = self.windows.get(key)
+        if entry is None:
+            entry = [window_start, 0, 0]
+            self.windows[key] = entry
+            if len(self.windows) > self.max_keys:
+                self.windows.popitem(last=False)
+                self.evicted += 1
+        else:
+            self.windows.move_to_end(key)
+            if entry[0] != window_start:
+                entry[1], entry[2] = roll_window(entry[0], entry[1], entry[2], window_start, window_seconds)
+                entry[0] = window_start
+
+        allowed = _fits(entry[1], entry[2], previous_weight, max_requests)
+        if allowed:
+            entry[2] += 1
+        return WindowCounts(allowed, entry[1], entry[2])
+
+    async def peek(self, key: str, window_start: int, window_seconds: int) -> Tuple[int, int]:
+        entry = self.windows.get(key)
+        if entry is None:
+            return 0, 0
+        return roll_window(entry[0], entry[1], entry[2], window_start, window_seconds)
+
+    async def reset(self, key: str):
+        self.windows.pop(key, None)
+
+
+class MongoStore:
+    """
+    One document per key: {_id, start, prev, cur, allowed, expires_at}
+    The roll, the check and the increment run in one update pipeline, so
+    concurrent workers never lose or double-count a request.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def hit(self, key: str, window_start: int, window_seconds: int,
+                  previous_weight: float, max_requests: int) -> WindowCounts:
+        same_window = {"$eq": ["$start", window_start]}
+        previous_window = {"$eq": ["$start", window_start - window_seconds]}
+        pipeline = [
+            {"$set": {
+                "prev": {"$cond": [same_window, "$prev", {"$cond": [previous_window, "$cur", 0]}]},
+                "cur": {"$cond": [same_window, "$cur", 0]},
+                "start": window_start,
+                # Idle keys are useless once they no longer weigh on the sliding window
+                "expires_at": datetime.fromtimestamp(window_start + 2 * window_seconds, timezone.utc),
+            }},
+            {"$set": {
+                "allowed": {"$lte": [
+                    {"$add": [{"$multiply": ["$prev", previous_weight]}, "$cur", 1]},
+                    max_requests
+                ]}
+            }},
+            {"$set": {"cur": {"$cond": ["$allowed", {"$add": ["$cur", 1]}, "$cur"]}}},
+        ]
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            pipeline,
+            projection={"prev": 1, "cur": 1, "allowed": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return WindowCounts(bool(doc["allowed"]), int(doc["prev"]), int(doc["cur"]))
+
+    async def peek(self, key: str, window_start: int, window_seconds: int) -> Tuple[int, int]:
+        doc = await self.collection.find_one({"_id": key}, {"start": 1, "prev": 1, "cur": 1})
+        if doc is None:
+            return 0, 0
+        return roll_window(doc.get("start"), doc.get("prev", 0), doc.get("cur", 0), window_start, window_seconds)
+
+    async def reset(self, key: str):
+        await self.collection.delete_one({"_id": key})
+
+
+class SharedMemoryStore:
+    """
+    Open-addressing table in a named shared memory segment, shared by all
+    worker processes on the host. Slots hold a 64-bit key hash, the window
+    start, an expiry and both counts; when all probed slots are live the one
+    expiring first is reused, so memory stays fixed. Every access holds an
+    exclusive flock on a lock file next to the segment. The lock is taken
+    without blocking and retried after a short sleep, so a worker waiting for
+    another one keeps serving its other requests; the critical section has no
+    await, so it also excludes the other coroutines of this worker.
+    """
+
+    SLOT = struct.Struct("<QqqII")  # key hash, window_start, expires_at, previous, current
+    PROBES = 8
+
+    def __init__(self, name: str = RATE_LIMIT_SHM_NAME, slots: int = RATE_LIMIT_SHM_SLOTS,
+                 lock_path: Optional[str] = None):
+        self.name = name
+        self.slots = max(self.PROBES, slots)
+        self.lock_path = lock_path or os.path.join("/tmp", f"{name}.lock")
+        self._shm = None
+        self._lock_fd: Optional[int] = None
+        self._pid: Optional[int] = None
+
+    def _attach(self):
+        # Re-open after a fork: a shared flock descriptor would not exclude the parent
+        if self._shm is not None and self._pid == os.getpid():
+            return
+        from multiprocessing import shared_memory
+
+        size = self.slots * self.SLOT.size
+        try:
+            shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        except FileExistsError:
+            shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            # The segment outlives any one worker: keep the resource tracker
+            # from unlinking it when this process exits
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        self._shm = shm
+        self.slots = min(self.slots, shm.size // self.SLOT.size)
+        self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._pid = os.getpid()
+
+    @asynccontextmanager
+    async def _locked(self):
+        import fcntl
+
+        self._attach()
+        delay = SHM_LOCK_RETRY
+        while True:
+            try:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, SHM_LOCK_RETRY_MAX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # Stable across processes, unlike hash(); 0 marks an empty slot
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+    def _find_slot(self, key_hash: int, now: int, create: bool) -> Optional[int]:
+        buf = self._shm.buf
+        free = victim = None
+        victim_expiry = None
+        for probe in range(self.PROBES):
+            slot = (key_hash + probe) % self.slots
+            stored_hash, _, expires_at, _, _ = self.SLOT.unpack_from(buf, slot * self.SLOT.size)
+            if stored_hash == key_hash:
+                return slot
+            if free is None and (stored_hash == 0 or expires_at <= now):
+                free = slot
+            if victim_expiry is None or expires_at < victim_expiry:
+                victim, victim_expiry = slot, expires_at
+        if not create:
+            return None
+        slot = free if free is not None else victim
+        self.SLOT.pack_into(buf, slot * self.SLOT.size, key_hash, 0, 0, 0, 0)
+        return slot
+
+    async def hit(self, key: str, window_start: int, window_seconds: int,
+                  previous_weight: float, max_requests: int) -> WindowCounts:
+        key_hash = self._hash(key)
+        async with self._locked():
+            slot = self._find_slot(key_hash, window_start, create=True)
+            offset = slot * self.SLOT.size
+            _, start, _, previous, current = self.SLOT.unpack_from(self._shm.buf, offset)
+            previous, current = roll_window(start or None, previous, current, window_start, window_seconds)
+            allowed = _fits(previous, current, previous_weight, max_requests)
+            if allowed:
+                current += 1
+            self.SLOT.pack_into(
+                self._shm.buf, offset,
+                key_hash, window_start, window_start + 2 * window_seconds, previous, current
+            )
+        return WindowCounts(allowed, previous, current)
+
+    async def peek(self, key: str, window_start: int, window_seconds: int) -> Tuple[int, int]:
+        key_hash = self._hash(key)
+        async with self._locked():
+            slot = self._find_slot(key_hash, window_start, create=False)
+            if slot is None:
+                return 0, 0
+            _, start, _, previous, current = self.SLOT.unpack_from(self._shm.buf, slot * self.SLOT.size)
+        return roll_window(start or None, previous, current, window_start, window_seconds)
+
+    async def reset(self, key: str):
+        key_hash = self._hash(key)
+        async with self._locked():
+            slot = self._find_slot(key_hash, 0, create=False)
+            if slot is not None:
+                self.SLOT.pack_into(self._shm.buf, slot * self.SLOT.size, 0, 0, 0, 0, 0)
+
+    def close(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def unlink(self):
+        """Remove the segment (tests, or a deploy that wants a clean table)"""
+        from multiprocessing import shared_memory
+
+        self.close()
+        try:
+            shared_memory.SharedMemory(name=self.name).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def create_store(backend: str = RATE_LIMIT_BACKEND, db=None):
+    """Store for RATE_LIMIT_BACKEND; the mongo backend needs the database"""
+    backend = (backend or "memory").lower()
+    if backend == "mongo":
+        if db is None:
+            raise ValueError("The mongo rate limit backend needs a database")
+        return MongoStore(db.rate_limits)
+    if backend == "shm":
+        return SharedMemoryStore()
+    if backend == "memory":
+        return MemoryStore()
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
@@ -1,20 +1,53 @@
 """
 Rate Limiting Middleware for FastAPI
 Protects against brute force and DDoS attacks
+
+Sliding window counter: each (ip, endpoint) keeps the request count of the
+current and previous fixed window, and the previous one is weighted by how
+much of it still overlaps the sliding window. Every check is O(1).
+The counters live in a store (see rate_limit_store.py): process memory by
+default, or MongoDB / shared memory so that all workers enforce one limit.
 """
 
 from fastapi import Request, HTTPException
-from collections import defaultdict
-from datetime import datetime, timedelta
-import asyncio
-from typing import Dict, Tuple
+from typing import Dict, NamedTuple, Optional, Tuple
+import math
+import time
+
+from rate_limit_store import MemoryStore
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_after: int   # seconds until the current window ends
+    retry_after: int   # seconds until a denied request would be allowed (0 if allowed)
+    window: int = 0    # window length in seconds
+
+    def headers(self) -> Dict[str, str]:
+        """RateLimit-* response headers (IETF draft), plus Retry-After when denied"""
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(self.reset_after),
+            "RateLimit-Policy": f"{self.limit};w={self.window}",
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+def rate_limit_message(wait_seconds: int) -> str:
+    return f"تم تجاوز الحد المسموح. حاول مرة أخرى بعد {wait_seconds} ثانية | Rate limit exceeded. Try again in {wait_seconds} seconds"
+
 
 class RateLimiter:
-    def __init__(self):
-        # Store: {ip_address: {endpoint: [(timestamp, count)]}}
-        self.requests: Dict[str, Dict[str, list]] = defaultdict(lambda: defaultdict(list))
-        self.lock = asyncio.Lock()
-        
+    def __init__(self, store=None):
+        self.store = store if store is not None else MemoryStore()
+        # Requests let through because the store failed
+        self.store_errors = 0
+
         # Rate limits per endpoint (requests, time_window_seconds)
         self.limits = {
             "/api/auth/customer/send-otp": (5, 900),  # 5 requests per 15 minutes
@@ -25,81 +58,99 @@ class RateLimiter:
             "/api/redeem/verify-and-redeem": (3, 300), # 3 redemptions per 5 minutes
             "default": (100, 60)                        # 100 requests per minute for other endpoints
         }
-    
+
     def _get_client_ip(self, request: Request) -> str:
         """Get client IP from request, considering proxy headers"""
         forwarded = request.headers.get("X-Forwarded-For")
         if forwarded:
             return forwarded.split(",")[0].strip()
         return request.client.host if request.client else "unknown"
-    
-    def _clean_old_requests(self, ip: str, endpoint: str, window_seconds: int):
-        """Remove requests older than the time window"""
-        cutoff = datetime.now() - timedelta(seconds=window_seconds)
-        self.requests[ip][endpoint] = [
-            req for req in self.requests[ip][endpoint]
-            if req[0] > cutoff
-        ]
-    
+
+    @staticmethod
+    def _key(ip: str, endpoint: str) -> str:
+        return f"{ip}|{endpoint}"
+
+    async def hit(self, ip: str, endpoint: str, now: Optional[float] = None) -> RateLimitResult:
+        """Count one request for (ip, endpoint) unless it exceeds the limit"""
+        max_requests, window_seconds = self.limits.get(endpoint, self.limits["default"])
+        now = time.time() if now is None else now
+        window_start = int(now // window_seconds) * window_seconds
+        elapsed = now - window_start
+        previous_weight = 1 - elapsed / window_seconds
+        reset_after = math.ceil(window_seconds - elapsed)
+
+        try:
+            counts = await self.store.hit(
+                self._key(ip, endpoint), window_start, window_seconds, previous_weight, max_requests
+            )
+        except Exception as e:
+            # Fail open: an unavailable store must not lock everyone out
+            self.store_errors += 1
+            print(f"Rate limit store error: {e}")
+            return RateLimitResult(True, max_requests, max_requests - 1, reset_after, 0, window_seconds)
+
+        if not counts.allowed:
+            return RateLimitResult(
+                allowed=False,
+                limit=max_requests,
+                remaining=0,
+                reset_after=reset_after,
+                retry_after=self._retry_after(counts.previous, counts.current, max_requests, window_seconds, elapsed),
+                window=window_seconds
+            )
+
+        estimated = counts.previous * previous_weight + counts.current
+        remaining = max(0, math.floor(max_requests - estimated))
+        return RateLimitResult(True, max_requests, remaining, reset_after, 0, window_seconds)
+
+    @staticmethod
+    def _retry_after(previous: int, current: int, max_requests: int, window_seconds: int, elapsed: float) -> int:
+        """Seconds until the sliding estimate leaves room for one more request"""
+        if current + 1 > max_requests:
+            # Only the next window has room: by then this window is the previous
+            # one and has to decay as well
+            needed_elapsed = window_seconds * (1 - (max_requests - 1) / current)
+            return max(1, math.ceil(window_seconds - elapsed + needed_elapsed))
+        needed_elapsed = window_seconds * (1 - (max_requests - 1 - current) / previous)
+        return max(1, math.ceil(needed_elapsed - elapsed))
+
     async def check_rate_limit(self, request: Request) -> bool:
         """
         Check if request exceeds rate limit
         Returns True if allowed, raises HTTPException if rate limited
         """
-        async with self.lock:
-            ip = self._get_client_ip(request)
-            endpoint = request.url.path
-            
-            # Get rate limit for this endpoint
-            max_requests, window_seconds = self.limits.get(
-                endpoint, 
-                self.limits["default"]
+        result = await self.hit(self._get_client_ip(request), request.url.path)
+
+        if not result.allowed:
+            wait_seconds = result.retry_after
+            raise HTTPException(
+                status_code=429,
+                detail=rate_limit_message(wait_seconds),
+                headers={"Retry-After": str(wait_seconds)}
             )
-            
-            # Clean old requests
-            self._clean_old_requests(ip, endpoint, window_seconds)
-            
-            # Get current request count
-            current_requests = self.requests[ip][endpoint]
-            request_count = len(current_requests)
-            
-            # Check if rate limit exceeded
-            if request_count >= max_requests:
-                # Calculate reset time
-                oldest_request = current_requests[0][0]
-                reset_time = oldest_request + timedelta(seconds=window_seconds)
-                wait_seconds = int((reset_time - datetime.now()).total_seconds())
-                
-                raise HTTPException(
-                    status_code=429,
-                    detail=f"تم تجاوز الحد المسموح. حاول مرة أخرى بعد {wait_seconds} ثانية | Rate limit exceeded. Try again in {wait_seconds} seconds",
-                    headers={"Retry-After": str(wait_seconds)}
-                )
-            
-            # Add current request
-            self.requests[ip][endpoint].append((datetime.now(), 1))
-            return True
-    
+
+        return True
+
     async def reset_rate_limit(self, ip: str, endpoint: str):
         """Reset rate limit for specific IP and endpoint (useful after successful auth)"""
-        async with self.lock:
-            if ip in self.requests and endpoint in self.requests[ip]:
-                self.requests[ip][endpoint] = []
-    
-    def get_remaining_attempts(self, request: Request) -> Tuple[int, int]:
+        await self.store.reset(self._key(ip, endpoint))
+
+    async def get_remaining_attempts(self, request: Request) -> Tuple[int, int]:
         """Get remaining attempts for current request"""
         ip = self._get_client_ip(request)
         endpoint = request.url.path
-        
+
         max_requests, window_seconds = self.limits.get(
             endpoint,
             self.limits["default"]
         )
-        
-        self._clean_old_requests(ip, endpoint, window_seconds)
-        current_count = len(self.requests[ip][endpoint])
-        remaining = max(0, max_requests - current_count)
-        
+
+        now = time.time()
+        window_start = int(now // window_seconds) * window_seconds
+        previous, current = await self.store.peek(self._key(ip, endpoint), window_start, window_seconds)
+        estimated = previous * (1 - (now - window_start) / window_seconds) + current
+        remaining = max(0, math.floor(max_requests - estimated))
+
         return remaining, max_requests
 
 
@@ -0,0 +1,282 @@
+"""
+Points ledger reconciliation
+Checks the balances kept on each customer (total_points, active_points,
+expired_points, redeemed_points) against the sums of their points_transactions:
+
+1. stream the customers' stored balances into a NumPy array, adding their
+   pending_ledger entries (redemptions not yet drained to the ledger)
+2. stream the ledger grouped by (customer, transaction type) on the server
+3. expected balances = one np.add.at of the per-type sums through the
+   CONTRIBUTIONS matrix; drifts = one vectorised comparison
+
+With --repair the drifted balances are overwritten with the ledger values in
+bulk. Each update is guarded on the updated_at that was read, so a customer
+whose balance changed during the run is skipped instead of being clobbered.
+Two kinds of customers are never repaired, because their ledger and balance
+legitimately disagree for a while without updated_at moving:
+
+- customers with outbox entries: a drain during the run moves an entry to
+  the ledger without touching the balance
+- customers with unsettled ledger rows: the sync and the manual add insert
+  the transaction before the balance $inc and keep a pending "balance" step
+  on it until then, and an expiry batch does the same while its journal
+  entry is pending. Such a row can be in the ledger read but not in the
+  balances read; repairing would credit it now and again when the $inc lands.
+
+Run it again (ideally while the sync is idle) to pick up skipped customers.
+
+Usage: python reconcile_points.py [--repair] [--tolerance 0.01] [--top 20]
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+# Absolute difference in points tolerated as float rounding
+RECONCILE_TOLERANCE = float(os.getenv('RECONCILE_TOLERANCE', 0.01))
+RECONCILE_BATCH_SIZE = 1000
+
+LAST_RUN_KEY = "points_reconcile_last_run"
+
+FIELDS = ["total_points", "active_points", "expired_points", "redeemed_points"]
+
+# How the summed points of each transaction type move each balance (FIELDS order)
+CONTRIBUTIONS: Dict[str, List[int]] = {
+    "earned": [1, 1, 0, 0],
+    "earned_expired": [1, 1, 0, 0],  # lots retagged by the old expiry job, offset by `expired`
+    "manual_add": [1, 1, 0, 0],
+    "returned": [1, 1, 0, 0],        # negative points
+    "redeemed": [0, 1, 0, -1],       # negative points
+    "expired": [0, 1, -1, 0],        # negative points
+}
+# Any other type only moves the active balance
+DEFAULT_CONTRIBUTION = [0, 1, 0, 0]
+
+
+def contribution_matrix(types: List[str]) -> np.ndarray:
+    rows = [CONTRIBUTIONS.get(t, DEFAULT_CONTRIBUTION) for t in types]
+    return np.array(rows, dtype=np.float64).reshape(len(types), len(FIELDS))
+
+
+def expected_balances(
+    customers: int,
+    customer_idx: np.ndarray,
+    type_idx: np.ndarray,
+    sums: np.ndarray,
+    types: List[str]
+) -> np.ndarray:
+    """(customers x FIELDS) balances implied by per (customer, type) ledger sums"""
+    expected = np.zeros((customers, len(FIELDS)), dtype=np.float64)
+    np.add.at(expected, customer_idx, sums[:, None] * contribution_matrix(types)[type_idx])
+    return expected
+
+
+def find_drifts(stored: np.ndarray, expected: np.ndarray, tolerance: float = RECONCILE_TOLERANCE) -> np.ndarray:
+    """Boolean (customers x FIELDS) mask of balances off by more than `tolerance`"""
+    return np.abs(stored - expected) > tolerance
+
+
+async def load_balances(db) -> Dict[str, Any]:
+    """Stored balances of every customer, with undrained outbox entries as ledger rows"""
+    ids: List[str] = []
+    rows: List[List[float]] = []
+    updated_at: List[Optional[datetime]] = []
+    pending: List[Dict[str, Any]] = []
+    has_pending: List[bool] = []
+    projection = {"_id": 0, "id": 1, "updated_at": 1, "pending_ledger": 1, **{field: 1 for field in FIELDS}}
+    async for customer in db.customers.find({}, projection):
+        ids.append(customer["id"])
+        rows.append([customer.get(field) or 0 for field in FIELDS])
+        updated_at.append(customer.get("updated_at"))
+        has_pending.append(bool(customer.get("pending_ledger")))
+        for entry in customer.get("pending_ledger") or []:
+            pending.append({"customer_id": customer["id"], "transaction_type": entry["transaction_type"], "points": entry["points"]})
+    stored = np.array(rows, dtype=np.float64).reshape(len(ids), len(FIELDS))
+    return {
+        "ids": ids,
+        "stored": stored,
+        "updated_at": updated_at,
+        "pending": pending,
+        "has_pending": np.array(has_pending, dtype=bool),
+    }
+
+
+async def load_ledger(db) -> List[Dict[str, Any]]:
+    """Ledger sums per (customer, transaction type), grouped by the server"""
+    rows = []
+    cursor = db.points_transactions.aggregate([
+        {"$group": {
+            "_id": {"customer_id": "$customer_id", "transaction_type": "$transaction_type"},
+            "points": {"$sum": "$points"},
+            "count": {"$sum": 1}
+        }}
+    ], allowDiskUse=True)
+    async for row in cursor:
+        rows.append({**row["_id"], "points": row["points"], "count": row["count"]})
+    return rows
+
+
+def compare(balances: Dict[str, Any], ledger: List[Dict[str, Any]], tolerance: float = RECONCILE_TOLERANCE) -> Dict[str, Any]:
+    """Expected balances and drift mask for loaded balances and ledger rows"""
+    index = {customer_id: i for i, customer_id in enumerate(balances["ids"])}
+    rows = ledger + [dict(entry, count=0) for entry in balances["pending"]]
+    known = [row for row in rows if row["customer_id"] in index]
+
+    types = sorted({row["transaction_type"] for row in known})
+    type_index = {t: i for i, t in enumerate(types)}
+    customer_idx = np.fromiter((index[row["customer_id"]] for row in known), dtype=np.int64, count=len(known))
+    type_idx = np.fromiter((type_index[row["transaction_type"]] for row in known), dtype=np.int64, count=len(known))
+    sums = np.fromiter((row["points"] or 0 for row in known), dtype=np.float64, count=len(known))
+
+    expected = expected_balances(len(index), customer_idx, type_idx, sums, types)
+    drifts = find_drifts(balances["stored"], expected, tolerance)
+    return {
+        "expected": expected,
+        "drifts": drifts,
+        "transactions": sum(row["count"] for row in rows),
+        "orphan_customers": len({row["customer_id"] for row in rows if row["customer_id"] not in index}),
+        "unknown_types": sorted(t for t in types if t not in CONTRIBUTIONS),
+    }
+
+
+def drift_report(balances: Dict[str, Any], result: Dict[str, Any], top: int = 20) -> Dict[str, Any]:
+    stored, expected, drifts = balances["stored"], result["expected"], result["drifts"]
+    difference = np.where(drifts, stored - expected, 0.0)
+    drifted = np.flatnonzero(drifts.any(axis=1))
+    worst = drifted[np.argsort(-np.abs(difference[drifted]).max(axis=1))][:top]
+    return {
+        "customers": len(balances["ids"]),
+        "transactions": result["transactions"],
+        "drifted_customers": int(len(drifted)),
+        "fields": {
+            field: {"customers": int(drifts[:, i].sum()), "points": round(float(difference[:, i].sum()), 2)}
+            for i, field in enumerate(FIELDS)
+        },
+        "orphan_customers": result["orphan_customers"],
+        "unknown_types": result["unknown_types"],
+        "worst": [
+            {
+                "customer_id": balances["ids"][i],
+                **{field: {"stored": round(float(stored[i, j]), 2), "ledger": round(float(expected[i, j]), 2)}
+                   for j, field in enumerate(FIELDS) if drifts[i, j]}
+            }
+            for i in worst
+        ],
+    }
+
+
+async def unsettled_customers(db, customer_ids: List[str]) -> Set[str]:
+    """Customers among `customer_ids` with ledger rows whose balance write has not landed yet"""
+    pending_batches = await db.expiry_batches.distinct("_id", {"state": "pending"})
+    unsettled = await db.points_transactions.distinct("customer_id", {
+        "customer_id": {"$in": customer_ids},
+        "$or": [{"pending_steps": "balance"}, {"expiry_batch": {"$in": pending_batches}}]
+    })
+    return set(unsettled)
+
+
+async def repair_drifts(db, balances: Dict[str, Any], result: Dict[str, Any], batch_size: int = RECONCILE_BATCH_SIZE) -> Dict[str, int]:
+    """Overwrite drifted balances with the ledger values, guarded on updated_at"""
+    now = datetime.now(timezone.utc)
+    stats = {"repaired": 0, "skipped": 0}
+    drifted = np.flatnonzero(result["drifts"].any(axis=1) & ~balances["has_pending"])
+    stats["skipped"] = int(result["drifts"].any(axis=1).sum()) - len(drifted)
+    for start in range(0, len(drifted), batch_size):
+        # Checked after the ledger read: a row settled since then has moved updated_at
+        chunk = drifted[start:start + batch_size]
+        unsettled = await unsettled_customers(db, [balances["ids"][i] for i in chunk])
+        stats["skipped"] += len(unsettled)
+        chunk = [i for i in chunk if balances["ids"][i] not in unsettled]
+        if not chunk:
+            continue
+        operations = [
+            UpdateOne(
+                {"id": balances["ids"][i], "updated_at": balances["updated_at"][i]},
+                {"$set": {
+                    **{field: round(float(result["expected"][i, j]), 6) for j, field in enumerate(FIELDS)},
+                    "updated_at": now
+                }}
+            )
+            for i in chunk
+        ]
+        outcome = await db.customers.bulk_write(operations, ordered=False)
+        stats["repaired"] += outcome.modified_count
+        stats["skipped"] += len(operations) - outcome.matched_count
+    return stats
+
+
+async def reconcile_points(
+    db,
+    repair: bool = False,
+    tolerance: float = RECONCILE_TOLERANCE,
+    top: int = 20
+) -> Dict[str, Any]:
+    """Compare every customer's balances with the ledger; returns the drift report"""
+    started_at = time.monotonic()
+    # Balances first: a ledger row written after the balances read is either
+    # still unsettled when the repair runs (skipped) or its balance write has
+    # landed and moved updated_at (rejected by the repair guard)
+    balances = await load_balances(db)
+    ledger = await load_ledger(db)
+    result = compare(balances, ledger, tolerance)
+
+    report = drift_report(balances, result, top)
+    if repair and report["drifted_customers"]:
+        report["repair"] = await repair_drifts(db, balances, result)
+    report["seconds"] = round(time.monotonic() - started_at, 2)
+
+    await db.system_settings.update_one(
+        {"key": LAST_RUN_KEY},
+        {"$set": {
+            "value": {key: value for key, value in report.items() if key != "worst"},
+            "updated_at": datetime.now(timezone.utc)
+        }},
+        upsert=True
+    )
+    return report
+
+
+async def main():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Check customer balances against the points ledger")
+    parser.add_argument("--repair", action="store_true", help="Overwrite drifted balances with the ledger values")
+    parser.add_argument("--tolerance", type=float, default=RECONCILE_TOLERANCE)
+    parser.add_argument("--top", type=int, default=20, help="Number of largest drifts to list")
+    args = parser.parse_args()
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+
+    print("🔄 Reconciling points balances" + (" (repair)" if args.repair else ""))
+    print("=" * 50)
+    report = await reconcile_points(db, repair=args.repair, tolerance=args.tolerance, top=args.top)
+    print(f"✓ Customers: {report['customers']}, transactions: {report['transactions']} ({report['seconds']}s)")
+    print(f"✓ Drifted customers: {report['drifted_customers']}")
+    for field, drift in report["fields"].items():
+        if drift["customers"]:
+            print(f"   {field}: {drift['customers']} customers, {drift['points']:+.2f} points stored over ledger")
+    for item in report["worst"]:
+        print(f"   - {item['customer_id']}: " + ", ".join(
+            f"{field} {values['stored']} != {values['ledger']}" for field, values in item.items() if field != "customer_id"
+        ))
+    if report["orphan_customers"]:
+        print(f"⚠️  Transactions of {report['orphan_customers']} unknown customers")
+    if report["unknown_types"]:
+        print(f"⚠️  Unknown transaction types (counted in active_points only): {report['unknown_types']}")
+    if "repair" in report:
+        print(f"✅ Repaired: {report['repair']['repaired']}, changed during the run (skipped): {report['repair']['skipped']}")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
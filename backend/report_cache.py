@@ -0,0 +1,145 @@
+"""
+Report cache for the admin dashboard
+TTL cache keyed by (endpoint, period). Concurrent identical requests share one
+computation, run as its own task so a cancelled request (client disconnect)
+does not cancel it for the others, and writes to the ledger bump a cache generation that drops every
+cached report, in this process and (via system_settings) in the others.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from fastapi import Response
+
+logger = logging.getLogger(__name__)
+
+# Seconds a computed report is served from the cache
+REPORT_CACHE_TTL = float(os.getenv('REPORT_CACHE_TTL', 60))
+# Seconds between reads of the shared generation written by other processes
+REPORT_CACHE_GENERATION_POLL = float(os.getenv('REPORT_CACHE_GENERATION_POLL', 5))
+# Upper bound on cached reports (period is a free-form query parameter)
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv('REPORT_CACHE_MAX_ENTRIES', 64))
+
+GENERATION_KEY = "report_cache_generation"
+
+
+class ReportCache:
+    def __init__(
+        self,
+        ttl: float = REPORT_CACHE_TTL,
+        generation_poll: float = REPORT_CACHE_GENERATION_POLL,
+        max_entries: int = REPORT_CACHE_MAX_ENTRIES
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.generation_poll = generation_poll
+        # key -> (generation, stored_at monotonic, computed_at, value)
+        self._entries: Dict[Hashable, Tuple[int, float, datetime, Dict[str, Any]]] = {}
+        # key -> task of the computation in flight
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.generation = 0
+        self._shared_generation: Optional[int] = None
+        self._generation_checked_at = 0.0
+
+    async def _refresh_generation(self, db):
+        """Pick up generation bumps made by other processes (sync job, workers)"""
+        now = time.monotonic()
+        if now - self._generation_checked_at < self.generation_poll:
+            return
+        self._generation_checked_at = now
+        try:
+            doc = await db.system_settings.find_one({"key": GENERATION_KEY}, {"_id": 0, "value": 1})
+        except Exception as e:
+            logger.warning(f"Could not read report cache generation: {e}")
+            return
+        shared = int(doc.get("value", 0)) if doc else 0
+        if self._shared_generation is not None and shared != self._shared_generation:
+            self.generation += 1
+        self._shared_generation = shared
+
+    def invalidate(self):
+        """Drop every cached report in this process"""
+        self.generation += 1
+        self._entries.clear()
+
+    async def get(
+        self,
+        db,
+        key: Hashable,
+        compute: Callable[[], Awaitable[Dict[str, Any]]],
+        response: Optional[Response] = None
+    ) -> Dict[str, Any]:
+        """
+        Return the cached report for `key`, computing it when missing or stale
+        The result carries `computed_at`; `response` gets an X-Cache HIT/MISS header
+        """
+        await self._refresh_generation(db)
+
+        entry = self._entries.get(key)
+        if entry and entry[0] == self.generation and time.monotonic() - entry[1] < self.ttl:
+            return self._result(entry, "HIT", response)
+
+        task = self._inflight.get(key)
+        status = "HIT"  # same report already being computed: wait for it instead of recomputing
+        if task is None:
+            task = asyncio.create_task(self._compute(key, compute, self.generation))
+            task.add_done_callback(self._computation_done)
+            self._inflight[key] = task
+            status = "MISS"
+
+        # Shielded: cancelling this request leaves the computation running for the others
+        entry = await asyncio.shield(task)
+        return self._result(entry, status, response)
+
+    async def _compute(self, key: Hashable, compute: Callable[[], Awaitable[Dict[str, Any]]], generation: int):
+        try:
+            value = await compute()
+            entry = (generation, time.monotonic(), datetime.now(timezone.utc), value)
+            # A bump during the computation means the value may already be stale
+            if generation == self.generation:
+                self._store(key, entry)
+            return entry
+        finally:
+            self._inflight.pop(key, None)
+
+    @staticmethod
+    def _computation_done(task: asyncio.Task):
+        # Mark a failure as retrieved even when every waiting request was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def _store(self, key: Hashable, entry):
+        self._entries.pop(key, None)
+        while len(self._entries) >= self.max_entries:
+            # Dicts keep insertion order: the first entry is the oldest
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = entry
+
+    @staticmethod
+    def _result(entry, status: str, response: Optional[Response]) -> Dict[str, Any]:
+        if response is not None:
+            response.headers["X-Cache"] = status
+        return {**entry[3], "computed_at": entry[2].isoformat()}
+
+
+async def bump_report_generation(db):
+    """
+    Invalidate cached reports after a ledger write
+    Clears this process immediately and bumps the shared generation so other
+    processes drop theirs on their next poll. Failures are logged, not raised.
+    """
+    report_cache.invalidate()
+    try:
+        await db.system_settings.update_one(
+            {"key": GENERATION_KEY},
+            {"$inc": {"value": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    except Exception as e:
+        logger.warning(f"Could not bump report cache generation: {e}")
+
+
+report_cache = ReportCache()
@@ -10,6 +10,29 @@ from dotenv import load_dotenv
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# HTTP client settings - one pooled keep-alive client is shared by every call
+REWAA_HTTP2 = os.getenv('REWAA_HTTP2', 'true').lower() == 'true'
+REWAA_MAX_CONNECTIONS = int(os.getenv('REWAA_MAX_CONNECTIONS', 20))
+REWAA_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('REWAA_MAX_KEEPALIVE_CONNECTIONS', 10))
+REWAA_KEEPALIVE_EXPIRY = float(os.getenv('REWAA_KEEPALIVE_EXPIRY', 60))
+REWAA_TIMEOUT = float(os.getenv('REWAA_TIMEOUT', 30))
+REWAA_CONNECT_TIMEOUT = float(os.getenv('REWAA_CONNECT_TIMEOUT', 10))
+# Invoice fetches that fail for a reason other than 404 are retried this many
+# times, waiting REWAA_RETRY_BACKOFF seconds and doubling (or Retry-After)
+REWAA_FETCH_ATTEMPTS = int(os.getenv('REWAA_FETCH_ATTEMPTS', 4))
+REWAA_RETRY_BACKOFF = float(os.getenv('REWAA_RETRY_BACKOFF', 1))
+
+class RewaaUnavailable(Exception):
+    """Rewaa gave no usable answer: auth failure, throttling, server or network error"""
+
+def retry_delay(response: Optional[httpx.Response], attempt: int) -> float:
+    """Seconds to wait before retry number `attempt` (1-based)"""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+    return REWAA_RETRY_BACKOFF * 2 ** (attempt - 1)
+
 class RewaaService:
     def __init__(self):
         self.base_url = os.getenv('REWAA_API_BASE_URL', 'https://api.platform.rewaatech.com')
@@ -17,6 +40,40 @@ class RewaaService:
         self.password = os.getenv('REWAA_PASSWORD')
         self.id_token: Optional[str] = None
         self.token_expires_at: Optional[datetime] = None
+        # Windowed sync fetches invoices concurrently; only one of them should
+        # refresh an expired token
+        self._auth_lock = asyncio.Lock()
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    async def start(self):
+        """
+        Open the shared HTTP client (called from app startup and the cron runner)
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=REWAA_HTTP2,
+                limits=httpx.Limits(
+                    max_connections=REWAA_MAX_CONNECTIONS,
+                    max_keepalive_connections=REWAA_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=REWAA_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(REWAA_TIMEOUT, connect=REWAA_CONNECT_TIMEOUT)
+            )
+        return self._client
+    
+    async def close(self):
+        """
+        Close the shared HTTP client and its pooled connections
+        """
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+    
+    async def _get_client(self) -> httpx.AsyncClient:
+        # Opened lazily as well, so one-off scripts work without calling start()
+        if self._client is None or self._client.is_closed:
+            return await self.start()
+        return self._client
     
     async def authenticate(self) -> bool:
         """
@@ -27,26 +84,25 @@ class RewaaService:
                 print("Rewaa credentials not configured")
                 return False
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/authenticate",
-                    json={
-                        "email": self.email,
-                        "password": self.password
-                    },
-                    timeout=30.0
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    self.id_token = data.get('idToken')
-                    # Token expires in 1 hour, we'll refresh at 55 minutes
-                    self.token_expires_at = datetime.now(timezone.utc) + timedelta(minutes=55)
-                    print(f"Rewaa authentication successful. Token expires at {self.token_expires_at}")
-                    return True
-                else:
-                    print(f"Rewaa authentication failed: {response.status_code}")
-                    return False
+            client = await self._get_client()
+            response = await client.post(
+                f"{self.base_url}/authenticate",
+                json={
+                    "email": self.email,
+                    "password": self.password
+                }
+            )
+
+            if response.status_code == 200:
+                data = response.json()
+                self.id_token = data.get('idToken')
+                # Token expires in 1 hour, we'll refresh at 55 minutes
+                self.token_expires_at = datetime.now(timezone.utc) + timedelta(minutes=55)
+                print(f"Rewaa authentication successful. Token expires at {self.token_expires_at}")
+                return True
+            else:
+                print(f"Rewaa authentication failed: {response.status_code}")
+                return False
         except Exception as e:
             print(f"Error authenticating with Rewaa: {e}")
             return False
@@ -63,9 +119,13 @@ class RewaaService:
         """
         Ensure we have a valid token, refresh if needed
         """
-        if not await self.is_token_valid():
+        if await self.is_token_valid():
+            return True
+        async with self._auth_lock:
+            # Another request may have refreshed the token while we waited
+            if await self.is_token_valid():
+                return True
             return await self.authenticate()
-        return True
     
     async def get_next_customer_code(self) -> Optional[str]:
         """
@@ -75,19 +135,18 @@ class RewaaService:
             if not await self.ensure_authenticated():
                 return None
             
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/customers/nextCode",
-                    headers={"Authorization": f"Bearer {self.id_token}"},
-                    timeout=30.0
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    return data.get('code')  # The response has 'code' not 'nextCode'
-                else:
-                    print(f"Failed to get next customer code: {response.status_code}")
-                    return None
+            client = await self._get_client()
+            response = await client.get(
+                f"{self.base_url}/customers/nextCode",
+                headers={"Authorization": f"Bearer {self.id_token}"}
+            )
+
+            if response.status_code == 200:
+                data = response.json()
+                return data.get('code')  # The response has 'code' not 'nextCode'
+            else:
+                print(f"Failed to get next customer code: {response.status_code}")
+                return None
         except Exception as e:
             print(f"Error getting next customer code from Rewaa: {e}")
             return None
@@ -106,31 +165,30 @@ class RewaaService:
                 print("Failed to get next customer code")
                 return None
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/customers",
-                    json={
-                        "code": customer_code,
-                        "name": name,
-                        "mobileNumber": mobile,
-                        "email": email
-                    },
-                    headers={"Authorization": f"Bearer {self.id_token}"},
-                    timeout=30.0
-                )
-                
-                if response.status_code in [200, 201]:
-                    print(f"✓ Customer created in Rewaa: {name} ({mobile})")
-                    return response.json()
-                else:
-                    error_msg = f"Failed to create customer in Rewaa: {response.status_code}"
-                    try:
-                        error_data = response.json()
-                        error_msg = f"{error_msg} - {error_data}"
-                    except:
-                        error_msg = f"{error_msg} - {response.text}"
-                    print(error_msg)
-                    return None
+            client = await self._get_client()
+            response = await client.post(
+                f"{self.base_url}/customers",
+                json={
+                    "code": customer_code,
+                    "name": name,
+                    "mobileNumber": mobile,
+                    "email": email
+                },
+                headers={"Authorization": f"Bearer {self.id_token}"}
+            )
+
+            if response.status_code in [200, 201]:
+                print(f"✓ Customer created in Rewaa: {name} ({mobile})")
+                return response.json()
+            else:
+                error_msg = f"Failed to create customer in Rewaa: {response.status_code}"
+                try:
+                    error_data = response.json()
+                    error_msg = f"{error_msg} - {error_data}"
+                except:
+                    error_msg = f"{error_msg} - {response.text}"
+                print(error_msg)
+                return None
         except Exception as e:
             print(f"Error creating customer in Rewaa: {e}")
             return None
@@ -146,20 +204,19 @@ class RewaaService:
             # Remove + from mobile if present
             mobile_clean = mobile.replace('+', '')
             
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/customers/getByMobile/{mobile_clean}",
-                    headers={"Authorization": f"Bearer {self.id_token}"},
-                    timeout=30.0
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                elif response.status_code == 404:
-                    return None  # Customer not found
-                else:
-                    print(f"Failed to get customer by mobile {mobile}: {response.status_code}")
-                    return None
+            client = await self._get_client()
+            response = await client.get(
+                f"{self.base_url}/customers/getByMobile/{mobile_clean}",
+                headers={"Authorization": f"Bearer {self.id_token}"}
+            )
+
+            if response.status_code == 200:
+                return response.json()
+            elif response.status_code == 404:
+                return None  # Customer not found
+            else:
+                print(f"Failed to get customer by mobile {mobile}: {response.status_code}")
+                return None
         except Exception as e:
             print(f"Error getting customer from Rewaa: {e}")
             return None
@@ -167,28 +224,44 @@ class RewaaService:
     async def get_invoice_by_number(self, invoice_number: int) -> Optional[Dict[str, Any]]:
         """
         Get invoice by invoice number from Rewaa
+        Returns None only when Rewaa answers 404. Throttling (429), server and
+        network errors are retried with backoff and then raised as
+        RewaaUnavailable, so the sync stops instead of skipping the invoice.
         """
-        try:
+        last_error = None
+        response = None
+        for attempt in range(REWAA_FETCH_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(retry_delay(response, attempt))
+            response = None
+            
             if not await self.ensure_authenticated():
-                return None
+                last_error = "authentication failed"
+                continue
             
-            async with httpx.AsyncClient() as client:
+            try:
+                client = await self._get_client()
                 response = await client.get(
                     f"{self.base_url}/pos/invoices/{invoice_number}",
-                    headers={"Authorization": f"Bearer {self.id_token}"},
-                    timeout=30.0
+                    headers={"Authorization": f"Bearer {self.id_token}"}
                 )
+            except httpx.HTTPError as e:
+                last_error = f"{type(e).__name__}: {e}"
+                print(f"Error getting invoice {invoice_number} from Rewaa (attempt {attempt + 1}/{REWAA_FETCH_ATTEMPTS}): {last_error}")
+                continue
                 
-                if response.status_code == 200:
-                    return response.json()
-                elif response.status_code == 404:
-                    return None  # Invoice not found
-                else:
-                    print(f"Failed to get invoice {invoice_number}: {response.status_code}")
-                    return None
-        except Exception as e:
-            print(f"Error getting invoice from Rewaa: {e}")
-            return None
+            if response.status_code == 200:
+                return response.json()
+            elif response.status_code == 404:
+                return None  # Invoice not found
+            elif response.status_code == 401:
+                # Token rejected before its expiry: authenticate again on the next attempt
+                self.id_token = None
+            
+            last_error = f"HTTP {response.status_code}"
+            print(f"Failed to get invoice {invoice_number} (attempt {attempt + 1}/{REWAA_FETCH_ATTEMPTS}): {response.status_code}")
+        
+        raise RewaaUnavailable(f"Invoice {invoice_number}: {last_error}")
 
 # Global instance
 rewaa_service = RewaaService()
\ No newline at end of file
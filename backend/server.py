@@ -1,14 +1,14 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks, status, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks, Query, status, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+import asyncio
 import os
 import logging
 from pathlib import Path
 from typing import List, Optional
 from datetime import datetime, timezone, timedelta
-import bcrypt
 import jwt
 import uuid
 import secrets
@@ -16,10 +16,29 @@ import secrets
 from models import *
 from services import send_otp_sms, send_welcome_email, send_notification_email, generate_otp_code, verify_otp_twilio
 from rewaa import rewaa_service
+from otp_provider import otp_provider
+from cpu_pool import cpu_pool, hash_password, verify_password, CPUPoolBusy
 from utils import format_phone_for_twilio, format_phone_for_display
 from rate_limiter import rate_limiter
-from audit_log import AuditLogger, AuditActions
+from rate_limit_store import RATE_LIMIT_BACKEND, create_store
+from rate_limit_middleware import RateLimitMiddleware
+from audit_log import AuditLogger, AuditActions, audit_sink
 from email_service import send_sync_failure_notification, send_test_email, get_notification_email
+from indexes import ensure_indexes, report_indexes
+from report_cache import report_cache, bump_report_generation
+from settings_cache import settings_cache, bump_settings_version
+from points_lots import expiring_soon, open_lots_query
+from ledger_outbox import redeem_points, drain_customer_safely
+from pagination import fetch_page, cached_count, InvalidCursor, MAX_PAGE_SIZE
+from customer_search import search_fields, build_search_query, exact_phone, SEARCH_FIELDS
+from daily_stats import (
+    record_stats,
+    record_transaction,
+    record_customer_deleted,
+    ensure_daily_stats_built,
+    sum_stats,
+    active_customers
+)
 from security_utils import (
     validate_password_strength, 
     validate_points_amount, 
@@ -32,7 +51,8 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware: stored BSON dates come back as aware UTC datetimes
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # Security
@@ -49,6 +69,29 @@ if len(JWT_SECRET) < 32:
 JWT_ALGORITHM = 'HS256'
 MAX_POINTS_PER_OPERATION = float(os.getenv('MAX_POINTS_PER_OPERATION', 10000))
 
+# Customer documents as returned by the API: without the redemption outbox,
+# the search fields and the batch guards of the sync and expiry jobs
+CUSTOMER_PROJECTION = {
+    "_id": 0,
+    "pending_ledger": 0,
+    "recent_sync_batches": 0,
+    "last_expiry_batch": 0,
+    **{field: 0 for field in SEARCH_FIELDS}
+}
+
+# Ledger rows as returned by the API: without the commit steps of the sync,
+# the lot bookkeeping (who consumed a lot, how much is left or expired) and
+# the expiry batch guard
+TRANSACTION_PROJECTION = {
+    "_id": 0,
+    "pending_steps": 0,
+    "sync_batch": 0,
+    "consumed_by": 0,
+    "remaining_points": 0,
+    "expired_points": 0,
+    "expiry_batch": 0
+}
+
 # Create the main app
 app = FastAPI(title="Al-Reef Loyalty API")
 api_router = APIRouter(prefix="/api")
@@ -102,8 +145,7 @@ async def get_staff_or_admin(credentials: HTTPAuthorizationCredentials = Depends
 
 async def calculate_points(amount: float) -> float:
     """Calculate points based on amount. Default: 10 SAR = 1 point"""
-    setting = await db.settings.find_one({"key": "points_multiplier"}, {"_id": 0})
-    multiplier = float(setting.get("value", 10)) if setting else 10
+    multiplier = await settings_cache.get(db, "points_multiplier")
     return amount / multiplier
 
 # API Routes
@@ -117,9 +159,6 @@ async def root():
 @api_router.post("/auth/customer/send-otp")
 async def send_customer_otp(request: Request, otp_request: SendOTPRequest):
     """Send OTP to customer phone - Rate limited"""
-    # Rate limiting check
-    await rate_limiter.check_rate_limit(request)
-    
     try:
         international_phone = format_phone_for_twilio(otp_request.phone)
         
@@ -134,9 +173,9 @@ async def send_customer_otp(request: Request, otp_request: SendOTPRequest):
                 email=None
             )
             customer_dict = new_customer.model_dump()
-            customer_dict['created_at'] = customer_dict['created_at'].isoformat()
-            customer_dict['updated_at'] = customer_dict['updated_at'].isoformat()
+            customer_dict.update(search_fields(new_customer.name, new_customer.email, new_customer.phone))
             await db.customers.insert_one(customer_dict)
+            await record_stats(db, new_customer.created_at, new_customers=1)
             
             # Audit log
             await AuditLogger.log(
@@ -153,7 +192,7 @@ async def send_customer_otp(request: Request, otp_request: SendOTPRequest):
         
         # Send OTP
         code = generate_otp_code()
-        success = send_otp_sms(international_phone, code)
+        success = await send_otp_sms(international_phone, code)
         
         if not success:
             # Audit log failed attempt
@@ -191,28 +230,15 @@ async def send_customer_otp(request: Request, otp_request: SendOTPRequest):
 @api_router.post("/auth/customer/verify-otp", response_model=TokenResponse)
 async def verify_customer_otp(request: Request, verify_request: VerifyOTPRequest):
     """Verify OTP - Rate limited"""
-    # Rate limiting check
-    await rate_limiter.check_rate_limit(request)
-    
     try:
-        from twilio.rest import Client
-        
         # Convert to international format
         international_phone = format_phone_for_twilio(verify_request.phone)
         
-        account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-        auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-        verify_service = os.getenv('TWILIO_VERIFY_SERVICE')
-        
-        if account_sid and auth_token and verify_service:
-            # Verify with Twilio
-            client = Client(account_sid, auth_token)
-            verification_check = client.verify.v2.services(verify_service).verification_checks.create(
-                to=international_phone,
-                code=verify_request.code
-            )
+        if otp_provider.is_configured:
+            # Verify with Twilio (non-blocking, shared client)
+            is_valid = await otp_provider.check_otp(international_phone, verify_request.code)
             
-            if verification_check.status != 'approved':
+            if not is_valid:
                 # Audit log failed attempt
                 await AuditLogger.log(
                     db=db,
@@ -293,10 +319,10 @@ async def register_customer(customer: CustomerCreate, background_tasks: Backgrou
         )
         
         doc = customer_doc.model_dump()
-        doc['created_at'] = doc['created_at'].isoformat()
-        doc['updated_at'] = doc['updated_at'].isoformat()
+        doc.update(search_fields(customer_doc.name, customer_doc.email, customer_doc.phone))
         
         await db.customers.insert_one(doc)
+        await record_stats(db, customer_doc.created_at, new_customers=1)
         logger.info(f"✓ Customer registered in loyalty program: {customer.name}")
         
         # Send welcome email
@@ -325,27 +351,18 @@ async def register_customer(customer: CustomerCreate, background_tasks: Backgrou
 async def get_customer_profile(current_customer: dict = Depends(get_current_customer)):
     """Get current customer profile"""
     try:
-        customer = await db.customers.find_one({"id": current_customer["customer_id"]}, {"_id": 0})
+        # Customer and expiring points (< 30 days, summed by the server) in parallel
+        customer, expiring_points = await asyncio.gather(
+            db.customers.find_one({"id": current_customer["customer_id"]}, CUSTOMER_PROJECTION),
+            expiring_soon(db, current_customer["customer_id"])
+        )
         if not customer:
             raise HTTPException(status_code=404, detail="Customer not found")
         
-        # Calculate expiring points (< 30 days)
-        thirty_days = datetime.now(timezone.utc) + timedelta(days=30)
-        expiring_points_cursor = db.points_transactions.find({
-            "customer_id": customer["id"],
-            "transaction_type": "earned",
-            "expires_at": {"$lte": thirty_days.isoformat(), "$gte": datetime.now(timezone.utc).isoformat()}
-        }, {"_id": 0})
-        
-        expiring_points = 0
-        async for trans in expiring_points_cursor:
-            expiring_points += trans.get("points", 0)
-        
         customer["expiring_points"] = expiring_points
         
-        # Calculate points value in SAR (every 10 points = 1 SAR)
-        reward_setting = await db.settings.find_one({"key": "points_reward_multiplier"}, {"_id": 0})
-        reward_multiplier = float(reward_setting.get("value", 10)) if reward_setting else 10
+        # Calculate points value in SAR (every 10 points = 1 SAR), from the settings cache
+        reward_multiplier = await settings_cache.get(db, "points_reward_multiplier")
         customer["points_value_sar"] = customer.get("active_points", 0) / reward_multiplier
         
         # Convert phone to display format (05xxxxxxxx)
@@ -361,17 +378,25 @@ async def get_customer_profile(current_customer: dict = Depends(get_current_cust
 @api_router.get("/customer/transactions")
 async def get_customer_transactions(
     current_customer: dict = Depends(get_current_customer),
-    limit: int = 50,
-    offset: int = 0
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = 0,
+    cursor: Optional[str] = None
 ):
-    """Get customer points transactions"""
+    """Get customer points transactions (pass next_cursor back as cursor for the next page)"""
     try:
-        transactions = await db.points_transactions.find(
+        transactions, next_cursor = await fetch_page(
+            db.points_transactions,
             {"customer_id": current_customer["customer_id"]},
-            {"_id": 0}
-        ).sort("created_at", -1).skip(offset).limit(limit).to_list(limit)
+            "created_at",
+            limit,
+            cursor=cursor,
+            offset=offset,
+            projection=TRANSACTION_PROJECTION
+        )
         
-        return {"transactions": transactions, "count": len(transactions)}
+        return {"transactions": transactions, "count": len(transactions), "next_cursor": next_cursor}
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="مؤشر الصفحة غير صالح | Invalid cursor")
     except Exception as e:
         logger.error(f"Error getting transactions: {e}")
         raise HTTPException(status_code=500, detail="Failed to get transactions")
@@ -379,21 +404,30 @@ async def get_customer_transactions(
 @api_router.get("/customer/invoices")
 async def get_customer_invoices(
     current_customer: dict = Depends(get_current_customer),
-    limit: int = 50,
-    offset: int = 0
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = 0,
+    cursor: Optional[str] = None
 ):
-    """Get customer invoices"""
+    """Get customer invoices (pass next_cursor back as cursor for the next page)"""
     try:
         customer = await db.customers.find_one({"id": current_customer["customer_id"]}, {"_id": 0})
         if not customer:
             raise HTTPException(status_code=404, detail="Customer not found")
         
-        invoices = await db.invoices.find(
+        invoices, next_cursor = await fetch_page(
+            db.invoices,
             {"customer_phone": customer["phone"]},
-            {"_id": 0}
-        ).sort("invoice_date", -1).skip(offset).limit(limit).to_list(limit)
+            "invoice_date",
+            limit,
+            cursor=cursor,
+            offset=offset
+        )
         
-        return {"invoices": invoices, "count": len(invoices)}
+        return {"invoices": invoices, "count": len(invoices), "next_cursor": next_cursor}
+    except HTTPException:
+        raise
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="مؤشر الصفحة غير صالح | Invalid cursor")
     except Exception as e:
         logger.error(f"Error getting invoices: {e}")
         raise HTTPException(status_code=500, detail="Failed to get invoices")
@@ -419,14 +453,14 @@ async def check_trusted_device(request: CheckTrustedDeviceRequest):
         trusted_device = await db.trusted_devices.find_one({
             "phone": international_phone,
             "device_token": request.device_token,
-            "expires_at": {"$gt": datetime.now(timezone.utc).isoformat()}
+            "expires_at": {"$gt": datetime.now(timezone.utc)}
         }, {"_id": 0})
         
         if trusted_device:
             # Update last used
             await db.trusted_devices.update_one(
                 {"id": trusted_device["id"]},
-                {"$set": {"last_used_at": datetime.now(timezone.utc).isoformat()}}
+                {"$set": {"last_used_at": datetime.now(timezone.utc)}}
             )
             
             # Check if also customer
@@ -462,7 +496,7 @@ async def login_with_trusted_device(request: CheckTrustedDeviceRequest):
         trusted_device = await db.trusted_devices.find_one({
             "phone": international_phone,
             "device_token": request.device_token,
-            "expires_at": {"$gt": datetime.now(timezone.utc).isoformat()}
+            "expires_at": {"$gt": datetime.now(timezone.utc)}
         }, {"_id": 0})
         
         if not trusted_device:
@@ -471,7 +505,7 @@ async def login_with_trusted_device(request: CheckTrustedDeviceRequest):
         # Update last used
         await db.trusted_devices.update_one(
             {"id": trusted_device["id"]},
-            {"$set": {"last_used_at": datetime.now(timezone.utc).isoformat()}}
+            {"$set": {"last_used_at": datetime.now(timezone.utc)}}
         )
         
         # Get role
@@ -509,7 +543,7 @@ async def check_admin_phone(request: SendOTPRequest):
         if admin:
             # Send OTP via Twilio
             code = generate_otp_code()
-            success = send_otp_sms(international_phone, code)
+            success = await send_otp_sms(international_phone, code)
             
             if not success:
                 raise HTTPException(status_code=500, detail="فشل إرسال رمز التحقق | Failed to send OTP")
@@ -543,7 +577,7 @@ async def admin_verify_otp(request: VerifyOTPRequest):
             raise HTTPException(status_code=401, detail="غير مصرح | Unauthorized")
         
         # Verify OTP using Twilio
-        is_valid = verify_otp_twilio(international_phone, request.code)
+        is_valid = await verify_otp_twilio(international_phone, request.code)
         
         if not is_valid:
             raise HTTPException(status_code=400, detail="رمز التحقق غير صحيح | Invalid OTP code")
@@ -575,9 +609,9 @@ async def admin_verify_otp(request: VerifyOTPRequest):
                 "phone": international_phone,
                 "device_token": device_token,
                 "device_info": None,  # Could add user agent info here
-                "created_at": datetime.now(timezone.utc).isoformat(),
-                "expires_at": expires_at.isoformat(),
-                "last_used_at": datetime.now(timezone.utc).isoformat()
+                "created_at": datetime.now(timezone.utc),
+                "expires_at": expires_at,
+                "last_used_at": datetime.now(timezone.utc)
             }
             
             await db.trusted_devices.insert_one(trusted_device_data)
@@ -606,7 +640,8 @@ async def admin_login(credentials: AdminLogin):
         
         # Verify password if hashed_password exists
         if admin.get("hashed_password") and credentials.password:
-            if not bcrypt.checkpw(credentials.password.encode('utf-8'), admin["hashed_password"].encode('utf-8')):
+            # bcrypt runs in the CPU pool so logins do not block other requests
+            if not await verify_password(credentials.password, admin["hashed_password"]):
                 raise HTTPException(status_code=401, detail="Invalid credentials")
         else:
             raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -627,6 +662,8 @@ async def admin_login(credentials: AdminLogin):
         return TokenResponse(access_token=token)
     except HTTPException:
         raise
+    except CPUPoolBusy:
+        raise HTTPException(status_code=503, detail="الخادم مشغول، حاول مرة أخرى | Server busy, please try again")
     except Exception as e:
         logger.error(f"Error admin login: {e}")
         raise HTTPException(status_code=500, detail="Failed to login")
@@ -634,8 +671,12 @@ async def admin_login(credentials: AdminLogin):
 # ================ Admin - Dashboard Stats ================
 
 @api_router.get("/admin/stats")
-async def get_admin_stats(current_admin: dict = Depends(get_current_admin)):
-    """Get dashboard statistics"""
+async def get_admin_stats(response: Response, current_admin: dict = Depends(get_current_admin)):
+    """Get dashboard statistics (cached, see report_cache.py)"""
+    return await report_cache.get(db, ("stats",), compute_admin_stats, response)
+
+async def compute_admin_stats():
+    """Compute dashboard statistics"""
     try:
         # Total customers
         total_customers = await db.customers.count_documents({})
@@ -655,8 +696,7 @@ async def get_admin_stats(current_admin: dict = Depends(get_current_admin)):
         total_expired_points = result[0]["total_expired"] if result else 0
         
         # Get reward multiplier to calculate SAR value
-        reward_setting = await db.settings.find_one({"key": "points_reward_multiplier"}, {"_id": 0})
-        reward_multiplier = float(reward_setting.get("value", 10)) if reward_setting else 10
+        reward_multiplier = await settings_cache.get(db, "points_reward_multiplier")
         
         # Total points value in SAR (active_points / reward_multiplier)
         # e.g., 500 points / 10 = 50 SAR
@@ -665,7 +705,7 @@ async def get_admin_stats(current_admin: dict = Depends(get_current_admin)):
         # New customers this month
         first_day_month = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
         new_customers_month = await db.customers.count_documents({
-            "created_at": {"$gte": first_day_month.isoformat()}
+            "created_at": {"$gte": first_day_month}
         })
         
         # Total invoices
@@ -690,7 +730,7 @@ async def get_recent_transactions(current_admin: dict = Depends(get_current_admi
         # Get recent transactions
         transactions = await db.points_transactions.find(
             {},
-            {"_id": 0}
+            TRANSACTION_PROJECTION
         ).sort("created_at", -1).limit(limit).to_list(limit)
         
         # Enrich with customer info
@@ -715,25 +755,44 @@ async def get_recent_transactions(current_admin: dict = Depends(get_current_admi
 async def get_all_customers(
     current_admin: dict = Depends(get_current_admin),
     search: Optional[str] = None,
-    limit: int = 50,
-    offset: int = 0
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    include_total: bool = True
 ):
-    """Get all customers with search"""
+    """
+    Get all customers with search (indexed, see customer_search.py)
+    Pages by cursor (next_cursor) or offset; total is estimated or cached, include_total=false skips it
+    An exact phone match is listed first on the first page
+    """
     try:
         query = {}
-        if search:
-            query = {
-                "$or": [
-                    {"name": {"$regex": search, "$options": "i"}},
-                    {"phone": {"$regex": search, "$options": "i"}},
-                    {"email": {"$regex": search, "$options": "i"}}
-                ]
-            }
+        exact_match = None
+        if search and search.strip():
+            query = build_search_query(search)
+            phone = exact_phone(search)
+            if phone:
+                exact_match = await db.customers.find_one({"phone": phone}, CUSTOMER_PROJECTION)
+        
+        page_query = query
+        page_limit = limit
+        if exact_match:
+            page_query = {"$and": [query, {"id": {"$ne": exact_match["id"]}}]}
+            if not cursor and not offset:
+                page_limit = max(1, limit - 1)
+        
+        customers, next_cursor = await fetch_page(
+            db.customers, page_query, "created_at", page_limit,
+            cursor=cursor, offset=offset, projection=CUSTOMER_PROJECTION
+        )
+        if exact_match and not cursor and not offset:
+            customers = [exact_match] + customers
         
-        customers = await db.customers.find(query, {"_id": 0}).sort("created_at", -1).skip(offset).limit(limit).to_list(limit)
-        total = await db.customers.count_documents(query)
+        total = await cached_count(db.customers, query) if include_total else None
         
-        return {"customers": customers, "total": total}
+        return {"customers": customers, "total": total, "next_cursor": next_cursor}
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="مؤشر الصفحة غير صالح | Invalid cursor")
     except Exception as e:
         logger.error(f"Error getting customers: {e}")
         raise HTTPException(status_code=500, detail="Failed to get customers")
@@ -742,7 +801,7 @@ async def get_all_customers(
 async def get_customer_details(customer_id: str, current_admin: dict = Depends(get_current_admin)):
     """Get customer details by ID"""
     try:
-        customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
+        customer = await db.customers.find_one({"id": customer_id}, CUSTOMER_PROJECTION)
         if not customer:
             raise HTTPException(status_code=404, detail="العميل غير موجود | Customer not found")
         return customer
@@ -760,7 +819,7 @@ async def update_customer(customer_id: str, update_data: CustomerUpdate, current
         if not customer:
             raise HTTPException(status_code=404, detail="العميل غير موجود | Customer not found")
         
-        update_fields = {"updated_at": datetime.now(timezone.utc).isoformat()}
+        update_fields = {"updated_at": datetime.now(timezone.utc)}
         
         if update_data.name:
             update_fields["name"] = update_data.name
@@ -776,6 +835,9 @@ async def update_customer(customer_id: str, update_data: CustomerUpdate, current
         if update_data.email is not None:
             update_fields["email"] = update_data.email if update_data.email else None
         
+        merged = {**customer, **update_fields}
+        update_fields.update(search_fields(merged.get("name"), merged.get("email"), merged.get("phone")))
+        
         await db.customers.update_one({"id": customer_id}, {"$set": update_fields})
         logger.info(f"Customer {customer_id} updated by {current_admin.get('name', current_admin.get('email', 'admin'))}")
         
@@ -794,6 +856,9 @@ async def delete_customer(customer_id: str, current_admin: dict = Depends(get_cu
         if not customer:
             raise HTTPException(status_code=404, detail="العميل غير موجود | Customer not found")
         
+        # Take the customer's activity out of the daily rollup
+        await record_customer_deleted(db, customer)
+        
         # Delete customer
         await db.customers.delete_one({"id": customer_id})
         
@@ -802,6 +867,7 @@ async def delete_customer(customer_id: str, current_admin: dict = Depends(get_cu
         
         # Delete related invoices
         await db.invoices.delete_many({"customer_id": customer_id})
+        await bump_report_generation(db)
         
         logger.info(f"Customer {customer['name']} ({customer_id}) deleted by {current_admin.get('name', 'admin')}")
         
@@ -826,9 +892,9 @@ async def suspend_customer(customer_id: str, suspend_data: CustomerSuspend, curr
                 "$set": {
                     "is_active": False,
                     "suspension_reason": suspend_data.reason,
-                    "suspended_at": datetime.now(timezone.utc).isoformat(),
+                    "suspended_at": datetime.now(timezone.utc),
                     "suspended_by": current_admin.get("name", current_admin.get("email", "admin")),
-                    "updated_at": datetime.now(timezone.utc).isoformat()
+                    "updated_at": datetime.now(timezone.utc)
                 }
             }
         )
@@ -858,7 +924,7 @@ async def activate_customer(customer_id: str, current_admin: dict = Depends(get_
                     "suspension_reason": None,
                     "suspended_at": None,
                     "suspended_by": None,
-                    "updated_at": datetime.now(timezone.utc).isoformat()
+                    "updated_at": datetime.now(timezone.utc)
                 }
             }
         )
@@ -884,7 +950,13 @@ async def update_customer(
         if not update_data:
             raise HTTPException(status_code=400, detail="No data to update")
         
-        update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+        customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
+        if not customer:
+            raise HTTPException(status_code=404, detail="Customer not found")
+        
+        update_data["updated_at"] = datetime.now(timezone.utc)
+        merged = {**customer, **update_data}
+        update_data.update(search_fields(merged.get("name"), merged.get("email"), merged.get("phone")))
         
         result = await db.customers.update_one(
             {"id": customer_id},
@@ -908,6 +980,11 @@ async def delete_customer(
 ):
     """Delete customer"""
     try:
+        customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
+        if customer:
+            # Invoices are kept by this endpoint, so only the ledger leaves the rollup
+            await record_customer_deleted(db, customer, invoices_deleted=False)
+        
         result = await db.customers.delete_one({"id": customer_id})
         
         if result.deleted_count == 0:
@@ -915,6 +992,7 @@ async def delete_customer(
         
         # Delete related transactions
         await db.points_transactions.delete_many({"customer_id": customer_id})
+        await bump_report_generation(db)
         
         return {"message": "Customer deleted successfully"}
     except HTTPException:
@@ -942,14 +1020,17 @@ async def add_points_manually(
             transaction_type="manual_add",
             points=points,
             description=description,
-            expires_at=datetime.now(timezone.utc) + timedelta(days=365)
+            expires_at=datetime.now(timezone.utc) + timedelta(days=365),
+            remaining_points=points
         )
         
         trans_doc = transaction.model_dump()
-        trans_doc['created_at'] = trans_doc['created_at'].isoformat()
-        trans_doc['expires_at'] = trans_doc['expires_at'].isoformat()
+        # Marks the row as not yet in the balance for reconcile_points.py
+        trans_doc["pending_steps"] = ["balance"]
         
         await db.points_transactions.insert_one(trans_doc)
+        await record_transaction(db, trans_doc)
+        await bump_report_generation(db)
         
         # Update customer points
         await db.customers.update_one(
@@ -959,9 +1040,10 @@ async def add_points_manually(
                     "total_points": points,
                     "active_points": points
                 },
-                "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+                "$set": {"updated_at": datetime.now(timezone.utc)}
             }
         )
+        await db.points_transactions.update_one({"id": trans_doc["id"]}, {"$unset": {"pending_steps": ""}})
         
         return {"message": "Points added successfully"}
     except HTTPException:
@@ -1021,11 +1103,12 @@ async def update_setting(
             {
                 "$set": {
                     "value": value,
-                    "updated_at": datetime.now(timezone.utc).isoformat()
+                    "updated_at": datetime.now(timezone.utc)
                 }
             },
             upsert=True
         )
+        await bump_settings_version(db)
         
         # Audit log
         await AuditLogger.log(
@@ -1072,8 +1155,7 @@ async def trigger_manual_sync(current_admin: dict = Depends(get_current_admin)):
     """Trigger manual invoice sync"""
     try:
         # Check if sync is enabled
-        sync_enabled = await db.settings.find_one({"key": "sync_enabled"}, {"_id": 0})
-        if not sync_enabled or sync_enabled.get("value") != "true":
+        if not await settings_cache.get(db, "sync_enabled"):
             raise HTTPException(status_code=400, detail="Sync is disabled")
         
         # Import sync function
@@ -1081,6 +1163,8 @@ async def trigger_manual_sync(current_admin: dict = Depends(get_current_admin)):
         
         # Run sync
         result = await sync_invoices_once(db)
+        if result.get("status") == "busy":
+            raise HTTPException(status_code=409, detail="المزامنة قيد التشغيل بالفعل | A sync is already running")
         
         # Check if sync failed and send notification
         if result.get("status") == "error" or result.get("error"):
@@ -1101,6 +1185,7 @@ async def trigger_manual_sync(current_admin: dict = Depends(get_current_admin)):
             "message": "Sync completed",
             "synced_count": result.get("synced_count", 0),
             "last_invoice": result.get("last_invoice", 0),
+            "invoices_per_second": result.get("invoices_per_second", 0),
             "status": result.get("status", "success")
         }
     except HTTPException:
@@ -1129,6 +1214,7 @@ async def get_sync_status(current_admin: dict = Depends(get_current_admin)):
             "last_sync_count",
             "last_sync_status",
             "last_sync_error",
+            "last_sync_rate",
             "last_synced_invoice"
         ]
         
@@ -1148,9 +1234,10 @@ async def toggle_sync(enabled: bool, current_admin: dict = Depends(get_current_a
     try:
         await db.settings.update_one(
             {"key": "sync_enabled"},
-            {"$set": {"value": "true" if enabled else "false", "updated_at": datetime.now(timezone.utc).isoformat()}},
+            {"$set": {"value": "true" if enabled else "false", "updated_at": datetime.now(timezone.utc)}},
             upsert=True
         )
+        await bump_settings_version(db)
         
         return {"message": f"Sync {'enabled' if enabled else 'disabled'}", "enabled": enabled}
     except Exception as e:
@@ -1181,7 +1268,7 @@ async def update_notification_email_setting(email: str, current_admin: dict = De
         
         await db.system_settings.update_one(
             {"key": "notification_email"},
-            {"$set": {"value": email, "updated_at": datetime.now(timezone.utc).isoformat()}},
+            {"$set": {"value": email, "updated_at": datetime.now(timezone.utc)}},
             upsert=True
         )
         
@@ -1231,7 +1318,7 @@ async def create_staff(staff: StaffCreate, current_admin: dict = Depends(get_cur
             "name": staff.name,
             "phone": international_phone,
             "role": staff.role,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         }
         
         await db.admins.insert_one(staff_doc)
@@ -1288,8 +1375,7 @@ async def get_customer_for_redemption(phone: str, current_user: dict = Depends(g
             raise HTTPException(status_code=404, detail="العميل غير موجود | Customer not found")
         
         # Get points value in SAR
-        reward_setting = await db.settings.find_one({"key": "points_reward_multiplier"}, {"_id": 0})
-        reward_multiplier = float(reward_setting.get("value", 10)) if reward_setting else 10
+        reward_multiplier = await settings_cache.get(db, "points_reward_multiplier")
         points_value_sar = customer.get("active_points", 0) / reward_multiplier
         
         return {
@@ -1327,14 +1413,14 @@ async def send_redemption_otp(request: SendOTPRequest, current_user: dict = Depe
             "code": code,
             "purpose": "redemption",
             "verified": False,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "expires_at": (datetime.now(timezone.utc) + timedelta(minutes=10)).isoformat()
+            "created_at": datetime.now(timezone.utc),
+            "expires_at": datetime.now(timezone.utc) + timedelta(minutes=10)
         }
         
         await db.otp_codes.insert_one(otp_doc)
         
         # Send OTP via Twilio
-        success = send_otp_sms(international_phone, code)
+        success = await send_otp_sms(international_phone, code)
         if not success:
             raise HTTPException(status_code=500, detail="فشل إرسال رمز التحقق | Failed to send OTP")
         
@@ -1347,55 +1433,45 @@ async def send_redemption_otp(request: SendOTPRequest, current_user: dict = Depe
         raise HTTPException(status_code=500, detail="Failed to send OTP")
 
 @api_router.post("/redeem/verify-and-redeem")
-async def verify_and_redeem_points(request: RedeemPointsRequest, current_user: dict = Depends(get_staff_or_admin)):
+async def verify_and_redeem_points(
+    request: RedeemPointsRequest,
+    background_tasks: BackgroundTasks,
+    current_user: dict = Depends(get_staff_or_admin)
+):
     """Verify OTP and redeem points"""
     try:
         international_phone = format_phone_for_twilio(request.customer_phone)
         
         # Verify OTP using Twilio Verify API
-        is_valid = verify_otp_twilio(international_phone, request.otp_code)
+        is_valid = await verify_otp_twilio(international_phone, request.otp_code)
         
         if not is_valid:
             raise HTTPException(status_code=400, detail="رمز التحقق غير صحيح | Invalid OTP code")
         
-        # Get customer
-        customer = await db.customers.find_one({"phone": international_phone}, {"_id": 0})
-        if not customer:
-            raise HTTPException(status_code=404, detail="العميل غير موجود | Customer not found")
-        
-        # Check if customer has enough points
-        if customer.get("active_points", 0) < request.points_to_redeem:
-            raise HTTPException(status_code=400, detail="رصيد النقاط غير كافي | Insufficient points balance")
-        
         # Calculate SAR value
-        reward_setting = await db.settings.find_one({"key": "points_reward_multiplier"}, {"_id": 0})
-        reward_multiplier = float(reward_setting.get("value", 10)) if reward_setting else 10
+        reward_multiplier = await settings_cache.get(db, "points_reward_multiplier")
         sar_value = request.points_to_redeem / reward_multiplier
         
-        # Create redemption transaction
+        # Redemption transaction, written to the ledger through the customer's outbox
         transaction_doc = {
             "id": str(uuid.uuid4()),
-            "customer_id": customer["id"],
             "transaction_type": "redeemed",
             "points": -request.points_to_redeem,
             "description": f"استبدال {request.points_to_redeem:.0f} نقطة بقيمة {sar_value:.2f} ريال | Redeemed {request.points_to_redeem:.0f} points worth {sar_value:.2f} SAR",
             "redeemed_by": current_user.get("email", ""),
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         }
         
-        await db.points_transactions.insert_one(transaction_doc)
+        # One guarded update: only succeeds if the balance covers the redemption
+        customer = await redeem_points(db, international_phone, request.points_to_redeem, transaction_doc)
+        if not customer:
+            # Cold path: tell a missing customer from an insufficient balance
+            if not await db.customers.find_one({"phone": international_phone}, {"_id": 1}):
+                raise HTTPException(status_code=404, detail="العميل غير موجود | Customer not found")
+            raise HTTPException(status_code=400, detail="رصيد النقاط غير كافي | Insufficient points balance")
         
-        # Update customer points
-        await db.customers.update_one(
-            {"id": customer["id"]},
-            {
-                "$inc": {
-                    "active_points": -request.points_to_redeem,
-                    "redeemed_points": request.points_to_redeem
-                },
-                "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
-            }
-        )
+        # Ledger, daily stats and points lots after the response
+        background_tasks.add_task(drain_customer_safely, db, customer["id"])
         
         logger.info(f"Points redeemed: {request.points_to_redeem} points for customer {international_phone} by {current_user.get('email')}")
         
@@ -1403,7 +1479,7 @@ async def verify_and_redeem_points(request: RedeemPointsRequest, current_user: d
             "message": "تم استبدال النقاط بنجاح | Points redeemed successfully",
             "points_redeemed": request.points_to_redeem,
             "sar_value": sar_value,
-            "remaining_points": customer.get("active_points", 0) - request.points_to_redeem
+            "remaining_points": customer.get("active_points", 0)
         }
     except HTTPException:
         raise
@@ -1411,6 +1487,25 @@ async def verify_and_redeem_points(request: RedeemPointsRequest, current_user: d
         logger.error(f"Error redeeming points: {e}")
         raise HTTPException(status_code=500, detail="Failed to redeem points")
 
+@api_router.get("/admin/system/indexes")
+async def get_index_report(current_admin: dict = Depends(get_current_admin_only)):
+    """Report declared indexes that are missing or unused (admin only)"""
+    try:
+        return await report_indexes(db)
+    except Exception as e:
+        logger.error(f"Error getting index report: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get index report")
+
+@api_router.get("/admin/system/cpu-pool")
+async def get_cpu_pool_stats(current_admin: dict = Depends(get_current_admin_only)):
+    """Queue depth and timings of the CPU worker pool (admin only)"""
+    return cpu_pool.stats()
+
+@api_router.get("/admin/system/audit-sink")
+async def get_audit_sink_stats(current_admin: dict = Depends(get_current_admin_only)):
+    """Buffer depth, written and dropped audit events (admin only)"""
+    return audit_sink.stats()
+
 @api_router.get("/admin/me")
 async def get_current_user_info(current_user: dict = Depends(get_staff_or_admin)):
     """Get current logged in user info"""
@@ -1426,10 +1521,15 @@ async def get_current_user_info(current_user: dict = Depends(get_staff_or_admin)
 
 @api_router.get("/admin/reports/customers")
 async def get_customer_reports(
+    response: Response,
     current_admin: dict = Depends(get_current_admin),
     period: str = "month"  # day, week, month, year, all
 ):
-    """Get comprehensive customer reports"""
+    """Get comprehensive customer reports (cached per period, see report_cache.py)"""
+    return await report_cache.get(db, ("customers", period), lambda: compute_customer_reports(period), response)
+
+async def compute_customer_reports(period: str):
+    """Get comprehensive customer reports (period totals come from the daily_stats rollup)"""
     try:
         now = datetime.now(timezone.utc)
         
@@ -1445,8 +1545,6 @@ async def get_customer_reports(
         else:  # all
             start_date = datetime(2000, 1, 1, tzinfo=timezone.utc)
         
-        start_date_str = start_date.isoformat()
-        
         # 1. Top 10 customers by points earned
         top_customers_by_points = await db.customers.find(
             {},
@@ -1461,7 +1559,7 @@ async def get_customer_reports(
             {
                 "$match": {
                     "transaction_type": "redeemed",
-                    "created_at": {"$gte": start_date_str}
+                    "created_at": {"$gte": start_date}
                 }
             },
             {
@@ -1487,18 +1585,14 @@ async def get_customer_reports(
                 })
         
         # 3. New customers in period
-        new_customers = await db.customers.count_documents({
-            "created_at": {"$gte": start_date_str}
-        })
+        period_stats = await sum_stats(db, start_date)
+        new_customers = period_stats["new_customers"]
         
         # 4. Inactive customers (no points earned in last 30 days)
-        thirty_days_ago = (now - timedelta(days=30)).isoformat()
+        thirty_days_ago = now - timedelta(days=30)
         
-        # Get customers who have transactions
-        active_customer_ids = await db.points_transactions.distinct(
-            "customer_id",
-            {"created_at": {"$gte": thirty_days_ago}, "transaction_type": "earned"}
-        )
+        # Customers with an earned transaction, from the rollup
+        active_customer_ids = await active_customers(db, thirty_days_ago)
         
         total_customers = await db.customers.count_documents({})
         inactive_customers = total_customers - len(active_customer_ids)
@@ -1543,10 +1637,15 @@ async def get_customer_reports(
 
 @api_router.get("/admin/reports/points")
 async def get_points_reports(
+    response: Response,
     current_admin: dict = Depends(get_current_admin),
     period: str = "month"
 ):
-    """Get comprehensive points reports"""
+    """Get comprehensive points reports (cached per period, see report_cache.py)"""
+    return await report_cache.get(db, ("points", period), lambda: compute_points_reports(period), response)
+
+async def compute_points_reports(period: str):
+    """Get comprehensive points reports (period totals come from the daily_stats rollup)"""
     try:
         now = datetime.now(timezone.utc)
         
@@ -1562,83 +1661,35 @@ async def get_points_reports(
         else:
             start_date = datetime(2000, 1, 1, tzinfo=timezone.utc)
         
-        start_date_str = start_date.isoformat()
-        
         # 1. Total points earned vs redeemed
-        earned_pipeline = [
-            {
-                "$match": {
-                    "transaction_type": {"$in": ["earned", "manual_add"]},
-                    "created_at": {"$gte": start_date_str}
-                }
-            },
-            {
-                "$group": {
-                    "_id": None,
-                    "total_earned": {"$sum": "$points"}
-                }
-            }
-        ]
-        
-        earned_result = await db.points_transactions.aggregate(earned_pipeline).to_list(1)
-        total_earned = earned_result[0]["total_earned"] if earned_result else 0
-        
-        redeemed_pipeline = [
-            {
-                "$match": {
-                    "transaction_type": "redeemed",
-                    "created_at": {"$gte": start_date_str}
-                }
-            },
-            {
-                "$group": {
-                    "_id": None,
-                    "total_redeemed": {"$sum": {"$abs": "$points"}}
-                }
-            }
-        ]
-        
-        redeemed_result = await db.points_transactions.aggregate(redeemed_pipeline).to_list(1)
-        total_redeemed = redeemed_result[0]["total_redeemed"] if redeemed_result else 0
+        period_stats = await sum_stats(db, start_date)
+        total_earned = period_stats["earned"]
+        total_redeemed = period_stats["redeemed"]
         
         # 2. Redemption rate
         redemption_rate = (total_redeemed / total_earned * 100) if total_earned > 0 else 0
         
-        # 3. Expired points
-        expired_pipeline = [
-            {
-                "$match": {
-                    "transaction_type": "expired"
-                }
-            },
-            {
-                "$group": {
-                    "_id": None,
-                    "total_expired": {"$sum": {"$abs": "$points"}}
-                }
-            }
-        ]
-        
-        expired_result = await db.points_transactions.aggregate(expired_pipeline).to_list(1)
-        total_expired = expired_result[0]["total_expired"] if expired_result else 0
+        # 3. Expired points (all time)
+        all_time_stats = await sum_stats(db, datetime(2000, 1, 1, tzinfo=timezone.utc))
+        total_expired = all_time_stats["expired"]
         
         # 4. Points expiring soon (next 30 days)
-        thirty_days = (now + timedelta(days=30)).isoformat()
+        thirty_days = now + timedelta(days=30)
         
         expiring_pipeline = [
             {
                 "$match": {
-                    "transaction_type": {"$in": ["earned", "manual_add"]},
+                    **open_lots_query(),
                     "expires_at": {
                         "$lte": thirty_days,
-                        "$gte": now.isoformat()
+                        "$gte": now
                     }
                 }
             },
             {
                 "$group": {
                     "_id": None,
-                    "total_expiring": {"$sum": "$points"}
+                    "total_expiring": {"$sum": "$remaining_points"}
                 }
             }
         ]
@@ -1677,10 +1728,15 @@ async def get_points_reports(
 
 @api_router.get("/admin/reports/performance")
 async def get_performance_reports(
+    response: Response,
     current_admin: dict = Depends(get_current_admin),
     period: str = "month"
 ):
-    """Get performance KPIs"""
+    """Get performance KPIs (cached per period, see report_cache.py)"""
+    return await report_cache.get(db, ("performance", period), lambda: compute_performance_reports(period), response)
+
+async def compute_performance_reports(period: str):
+    """Get performance KPIs (ledger and sales totals come from the daily_stats rollup)"""
     try:
         now = datetime.now(timezone.utc)
         
@@ -1705,78 +1761,36 @@ async def get_performance_reports(
                 previous_start = current_start - timedelta(days=1)
             previous_end = current_start
         
-        # 1. Growth Rate (new customers)
-        current_new = await db.customers.count_documents({
-            "created_at": {"$gte": current_start.isoformat()}
-        })
+        current_stats = await sum_stats(db, current_start)
+        previous_stats = await sum_stats(db, previous_start, previous_end)
         
-        previous_new = await db.customers.count_documents({
-            "created_at": {"$gte": previous_start.isoformat(), "$lt": previous_end.isoformat()}
-        })
+        # 1. Growth Rate (new customers)
+        current_new = current_stats["new_customers"]
+        previous_new = previous_stats["new_customers"]
         
         growth_rate = ((current_new - previous_new) / previous_new * 100) if previous_new > 0 else 0
         
         # 2. Retention Rate (customers who earned points in both periods)
-        current_active = await db.points_transactions.distinct(
-            "customer_id",
-            {"created_at": {"$gte": current_start.isoformat()}, "transaction_type": "earned"}
-        )
+        current_active = await active_customers(db, current_start)
+        previous_active = await active_customers(db, previous_start, previous_end)
         
-        previous_active = await db.points_transactions.distinct(
-            "customer_id",
-            {"created_at": {"$gte": previous_start.isoformat(), "$lt": previous_end.isoformat()}, "transaction_type": "earned"}
-        )
-        
-        retained = len(set(current_active) & set(previous_active))
+        retained = len(current_active & previous_active)
         retention_rate = (retained / len(previous_active) * 100) if len(previous_active) > 0 else 0
         
         # 3. ROI for Points (value given vs value redeemed)
-        setting = await db.settings.find_one({"key": "points_reward_multiplier"}, {"_id": 0})
-        multiplier = float(setting.get("value", 10)) if setting else 10
-        
-        earned_pipeline = [
-            {
-                "$match": {
-                    "transaction_type": {"$in": ["earned", "manual_add"]},
-                    "created_at": {"$gte": current_start.isoformat()}
-                }
-            },
-            {"$group": {"_id": None, "total": {"$sum": "$points"}}}
-        ]
+        multiplier = await settings_cache.get(db, "points_reward_multiplier")
         
-        earned = await db.points_transactions.aggregate(earned_pipeline).to_list(1)
-        total_earned = earned[0]["total"] if earned else 0
+        total_earned = current_stats["earned"]
         value_given = total_earned / multiplier
         
-        redeemed_pipeline = [
-            {
-                "$match": {
-                    "transaction_type": "redeemed",
-                    "created_at": {"$gte": current_start.isoformat()}
-                }
-            },
-            {"$group": {"_id": None, "total": {"$sum": {"$abs": "$points"}}}}
-        ]
-        
-        redeemed = await db.points_transactions.aggregate(redeemed_pipeline).to_list(1)
-        total_redeemed = redeemed[0]["total"] if redeemed else 0
+        total_redeemed = current_stats["redeemed"]
         value_redeemed = total_redeemed / multiplier
         
         roi = ((value_given - value_redeemed) / value_redeemed * 100) if value_redeemed > 0 else 0
         
         # 4. Customer Lifetime Value (CLV)
-        invoice_pipeline = [
-            {
-                "$group": {
-                    "_id": None,
-                    "total_sales": {"$sum": "$total_amount"},
-                    "count": {"$sum": 1}
-                }
-            }
-        ]
-        
-        invoice_result = await db.invoices.aggregate(invoice_pipeline).to_list(1)
-        total_sales = invoice_result[0]["total_sales"] if invoice_result else 0
+        all_time_stats = await sum_stats(db, datetime(2000, 1, 1, tzinfo=timezone.utc))
+        total_sales = all_time_stats["sales"]
         total_customers = await db.customers.count_documents({})
         
         clv = (total_sales / total_customers) if total_customers > 0 else 0
@@ -1798,120 +1812,129 @@ async def get_performance_reports(
         logger.error(f"Error getting performance reports: {e}")
         raise HTTPException(status_code=500, detail="Failed to get performance reports")
 
+# Chart buckets per period: (number of buckets, $dateTrunc unit)
+CHART_BUCKETS = {
+    "day": (24, "hour"),    # last 24 hours by hour
+    "week": (7, "day"),     # last 7 days
+    "month": (30, "day"),   # last 30 days
+    "year": (12, "month"),  # last 12 months
+}
+
+def get_chart_buckets(period: str, now: datetime):
+    """
+    Return (window_start, unit, [(bucket_start, label), ...]) for a chart period
+    Buckets are aligned to whole UTC hours, days or months and end with the current one;
+    bucket_start matches the $dateTrunc value of the documents that fall in it
+    """
+    data_points, unit = CHART_BUCKETS.get(period, CHART_BUCKETS["month"])
+    
+    if unit == "hour":
+        current = now.replace(minute=0, second=0, microsecond=0)
+        starts = [current - timedelta(hours=i) for i in range(data_points - 1, -1, -1)]
+        label_format = "%H:00"
+    elif unit == "day":
+        current = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        starts = [current - timedelta(days=i) for i in range(data_points - 1, -1, -1)]
+        label_format = "%d/%m"
+    else:
+        current = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        starts = []
+        year, month = current.year, current.month
+        for _ in range(data_points):
+            starts.insert(0, current.replace(year=year, month=month))
+            year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+        label_format = "%b %Y"
+    
+    buckets = [(start, start.strftime(label_format)) for start in starts]
+    return starts[0], unit, buckets
+
+def date_bucket(field: str, unit: str) -> dict:
+    """$dateTrunc expression grouping a date field into UTC chart buckets"""
+    return {"$dateTrunc": {"date": f"${field}", "unit": unit, "timezone": "UTC"}}
+
 @api_router.get("/admin/reports/charts")
 async def get_chart_data(
+    response: Response,
     current_admin: dict = Depends(get_current_admin),
     period: str = "month"
 ):
-    """Get data for charts and visualizations"""
+    """Get data for charts and visualizations (cached per period, see report_cache.py)"""
+    return await report_cache.get(db, ("charts", period), lambda: compute_chart_data(period), response)
+
+async def compute_chart_data(period: str):
+    """Compute chart series (one grouped query per series)"""
     try:
         now = datetime.now(timezone.utc)
+        window_start, unit, buckets = get_chart_buckets(period, now)
+        
+        # 1. Customer growth over time: customers before the window, then a
+        # running sum over new customers grouped by bucket
+        customers_before = await db.customers.count_documents({
+            "created_at": {"$lt": window_start}
+        })
+        
+        new_customers = await db.customers.aggregate([
+            {"$match": {"created_at": {"$gte": window_start}}},
+            {"$group": {"_id": date_bucket("created_at", unit), "count": {"$sum": 1}}}
+        ]).to_list(None)
+        new_by_bucket = {row["_id"]: row["count"] for row in new_customers}
         
-        # Determine number of data points based on period
-        if period == "day":
-            # Last 24 hours by hour
-            data_points = 24
-            interval = timedelta(hours=1)
-        elif period == "week":
-            # Last 7 days
-            data_points = 7
-            interval = timedelta(days=1)
-        elif period == "year":
-            # Last 12 months
-            data_points = 12
-            interval = timedelta(days=30)
-        else:  # month
-            # Last 30 days
-            data_points = 30
-            interval = timedelta(days=1)
-        
-        # 1. Customer growth over time
         customer_growth = []
-        for i in range(data_points, 0, -1):
-            point_date = now - (interval * i)
-            count = await db.customers.count_documents({
-                "created_at": {"$lte": point_date.isoformat()}
-            })
-            
-            if period == "day":
-                label = point_date.strftime("%H:00")
-            elif period == "year":
-                label = point_date.strftime("%b %Y")
-            else:
-                label = point_date.strftime("%d/%m")
-            
+        running_total = customers_before
+        for key, label in buckets:
+            running_total += new_by_bucket.get(key, 0)
             customer_growth.append({
                 "date": label,
-                "customers": count
+                "customers": running_total
             })
         
         # 2. Points earned vs redeemed over time
+        points = await db.points_transactions.aggregate([
+            {
+                "$match": {
+                    "transaction_type": {"$in": ["earned", "manual_add", "redeemed"]},
+                    "created_at": {"$gte": window_start}
+                }
+            },
+            {
+                "$group": {
+                    "_id": date_bucket("created_at", unit),
+                    "earned": {"$sum": {"$cond": [{"$eq": ["$transaction_type", "redeemed"]}, 0, "$points"]}},
+                    "redeemed": {"$sum": {"$cond": [{"$eq": ["$transaction_type", "redeemed"]}, {"$abs": "$points"}, 0]}}
+                }
+            }
+        ]).to_list(None)
+        points_by_bucket = {row["_id"]: row for row in points}
+        
         points_comparison = []
-        for i in range(data_points, 0, -1):
-            start_point = now - (interval * i)
-            end_point = start_point + interval
-            
-            # Earned
-            earned = await db.points_transactions.aggregate([
-                {
-                    "$match": {
-                        "transaction_type": {"$in": ["earned", "manual_add"]},
-                        "created_at": {"$gte": start_point.isoformat(), "$lt": end_point.isoformat()}
-                    }
-                },
-                {"$group": {"_id": None, "total": {"$sum": "$points"}}}
-            ]).to_list(1)
-            
-            # Redeemed
-            redeemed = await db.points_transactions.aggregate([
-                {
-                    "$match": {
-                        "transaction_type": "redeemed",
-                        "created_at": {"$gte": start_point.isoformat(), "$lt": end_point.isoformat()}
-                    }
-                },
-                {"$group": {"_id": None, "total": {"$sum": {"$abs": "$points"}}}}
-            ]).to_list(1)
-            
-            if period == "day":
-                label = start_point.strftime("%H:00")
-            elif period == "year":
-                label = start_point.strftime("%b %Y")
-            else:
-                label = start_point.strftime("%d/%m")
-            
+        for key, label in buckets:
+            row = points_by_bucket.get(key)
             points_comparison.append({
                 "date": label,
-                "earned": round(earned[0]["total"], 2) if earned else 0,
-                "redeemed": round(redeemed[0]["total"], 2) if redeemed else 0
+                "earned": round(row["earned"], 2) if row else 0,
+                "redeemed": round(row["redeemed"], 2) if row else 0
             })
         
-        # 3. Monthly sales chart
+        # 3. Sales chart
+        sales = await db.invoices.aggregate([
+            {"$match": {"invoice_date": {"$gte": window_start}}},
+            {
+                "$group": {
+                    "_id": date_bucket("invoice_date", unit),
+                    "total": {"$sum": "$total_amount"},
+                    "count": {"$sum": 1}
+                }
+            }
+        ]).to_list(None)
+        sales_by_bucket = {row["_id"]: row for row in sales}
+        
         sales_data = []
-        for i in range(data_points, 0, -1):
-            start_point = now - (interval * i)
-            end_point = start_point + interval
-            
-            result = await db.invoices.aggregate([
-                {
-                    "$match": {
-                        "invoice_date": {"$gte": start_point.isoformat(), "$lt": end_point.isoformat()}
-                    }
-                },
-                {"$group": {"_id": None, "total": {"$sum": "$total_amount"}, "count": {"$sum": 1}}}
-            ]).to_list(1)
-            
-            if period == "day":
-                label = start_point.strftime("%H:00")
-            elif period == "year":
-                label = start_point.strftime("%b %Y")
-            else:
-                label = start_point.strftime("%d/%m")
-            
+        for key, label in buckets:
+            row = sales_by_bucket.get(key)
             sales_data.append({
                 "date": label,
-                "sales": round(result[0]["total"], 2) if result else 0,
-                "invoices": result[0]["count"] if result else 0
+                "sales": round(row["total"], 2) if row else 0,
+                "invoices": row["count"] if row else 0
             })
         
         # 4. Customer distribution pie chart (by points balance)
@@ -1950,6 +1973,10 @@ async def get_chart_data(
 # Include router
 app.include_router(api_router)
 
+# Rate limits for every route (see rate_limit_middleware.py); added before
+# CORS so that CORS wraps it and 429 responses carry the CORS headers too
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -1957,12 +1984,21 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset", "RateLimit-Policy", "Retry-After"],
 )
 
 # Startup event
 @app.on_event("startup")
 async def startup_event():
     """Initialize default admin and settings"""
+    # Shared keep-alive HTTP clients for all Rewaa and Twilio Verify calls
+    await rewaa_service.start()
+    await otp_provider.start()
+    # Shared counters so every worker enforces the same limits (RATE_LIMIT_BACKEND)
+    rate_limiter.store = create_store(RATE_LIMIT_BACKEND, db)
+    # Audit events are buffered and written in batches off the request path
+    audit_sink.start(db)
+    
     try:
         # Update or create admin with phone number
         admin_phone = "+966550755465"  # مصطفى الحسين
@@ -1972,7 +2008,7 @@ async def startup_event():
         
         if not admin_exists:
             admin_password = os.getenv('ADMIN_DEFAULT_PASSWORD', 'Admin@123')
-            hashed = bcrypt.hashpw(admin_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+            hashed = await hash_password(admin_password)
             
             admin_doc = {
                 "id": str(uuid.uuid4()),
@@ -1981,7 +2017,7 @@ async def startup_event():
                 "email": admin_email,
                 "hashed_password": hashed,
                 "role": "admin",
-                "created_at": datetime.now(timezone.utc).isoformat()
+                "created_at": datetime.now(timezone.utc)
             }
             
             await db.admins.insert_one(admin_doc)
@@ -2020,13 +2056,35 @@ async def startup_event():
             exists = await db.settings.find_one({"key": setting["key"]})
             if not exists:
                 setting["id"] = str(uuid.uuid4())
-                setting["updated_at"] = datetime.now(timezone.utc).isoformat()
+                setting["updated_at"] = datetime.now(timezone.utc)
                 await db.settings.insert_one(setting)
         
+        # Parsed settings for the hot paths (see settings_cache.py)
+        await settings_cache.load(db)
+        
+        # Create declared indexes and report gaps
+        failed_indexes = await ensure_indexes(db)
+        if failed_indexes:
+            logger.error(f"Indexes that could not be created: {failed_indexes}")
+        index_report = await report_indexes(db)
+        if index_report["missing"]:
+            logger.warning(f"Missing indexes: {index_report['missing']}")
+        if index_report["unused"]:
+            logger.info(f"Unused indexes since server start: {index_report['unused']}")
+        
+        # First start with the rollup: build it from the ledger once
+        days = await ensure_daily_stats_built(db)
+        if days:
+            logger.info(f"Daily stats rollup built: {days} days")
+        
         logger.info("Startup initialization completed")
     except Exception as e:
         logger.error(f"Error during startup: {e}")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await rewaa_service.close()
+    await otp_provider.close()
+    await audit_sink.stop()
+    cpu_pool.shutdown()
     client.close()
@@ -1,4 +1,3 @@
-from twilio.rest import Client
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 import os
@@ -7,39 +6,16 @@ from datetime import datetime, timezone, timedelta
 import random
 import string
 
+from otp_provider import otp_provider
+
 load_dotenv()
 
-# Twilio SMS Service using Verify API
-def send_otp_sms(phone: str, code: str) -> bool:
+# Twilio SMS Service using Verify API (async, see otp_provider.py)
+async def send_otp_sms(phone: str, code: str) -> bool:
     """
     Send OTP code via Twilio Verify API
     """
-    try:
-        account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-        auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-        verify_service = os.getenv('TWILIO_VERIFY_SERVICE')
-        
-        if not account_sid or not auth_token or not verify_service:
-            print("Twilio credentials not configured. Using mock mode.")
-            print(f"✅ Mock OTP for {phone}: 1234 (Development Mode - Fixed Code)")
-            return True
-        
-        client = Client(account_sid, auth_token)
-        
-        # Use Twilio Verify API
-        verification = client.verify.v2.services(verify_service).verifications.create(
-            to=phone,
-            channel='sms'
-        )
-        
-        print(f"OTP sent via Twilio Verify: {verification.status}")
-        return verification.status in ['pending', 'approved']
-        
-    except Exception as e:
-        print(f"Error sending SMS via Twilio Verify: {e}")
-        # Fallback to mock mode
-        print(f"✅ Mock OTP for {phone}: 1234 (Development Mode - Fixed Code)")
-        return True
+    return await otp_provider.send_otp(phone)
 
 # SendGrid Email Service
 def send_welcome_email(email: str, name: str) -> bool:
@@ -114,35 +90,8 @@ def generate_otp_code() -> str:
     """
     return ''.join(random.choices(string.digits, k=6))
 
-def verify_otp_twilio(phone: str, code: str) -> bool:
+async def verify_otp_twilio(phone: str, code: str) -> bool:
     """
     Verify OTP code via Twilio Verify API
     """
-    try:
-        account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-        auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-        verify_service = os.getenv('TWILIO_VERIFY_SERVICE')
-        
-        if not account_sid or not auth_token or not verify_service:
-            # Development Mode: Only accept fixed code "1234"
-            if code == "1234":
-                print(f"✅ Mock verification success for {phone}: Code 1234 accepted (Development Mode)")
-                return True
-            else:
-                print(f"❌ Mock verification failed for {phone}: Invalid code '{code}' (Expected: 1234)")
-                return False
-        
-        client = Client(account_sid, auth_token)
-        
-        # Use Twilio Verify API to check the code
-        verification_check = client.verify.v2.services(verify_service).verification_checks.create(
-            to=phone,
-            code=code
-        )
-        
-        print(f"Twilio Verify check status: {verification_check.status}")
-        return verification_check.status == 'approved'
-        
-    except Exception as e:
-        print(f"Error verifying OTP via Twilio: {e}")
-        return False
\ No newline at end of file
+    return await otp_provider.verify_otp(phone, code)
@@ -0,0 +1,131 @@
+"""
+Settings cache
+The admin-editable settings are read from `settings` once and kept parsed in
+process memory, so hot paths (points calculation, profile, redemption, sync)
+no longer query MongoDB for them.
+
+Every write of a cached setting must call bump_settings_version: it drops the
+cache in this process immediately and increments a shared version stamp in
+system_settings, which every process polls at most once per
+SETTINGS_VERSION_POLL seconds and reloads on change.
+
+Sync progress keys (last_synced_invoice, last_sync_*) change on every run and
+are not cached.
+
+Usage:
+    multiplier = await settings_cache.get(db, "points_multiplier")   # float
+"""
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds between reads of the shared version written by other processes
+SETTINGS_VERSION_POLL = float(os.getenv('SETTINGS_VERSION_POLL', 1))
+
+VERSION_KEY = "settings_version"
+
+
+def _parse_bool(value: str) -> bool:
+    return str(value).strip().lower() == "true"
+
+
+# Cached settings: key -> (parser, default)
+SETTINGS: Dict[str, Tuple[Callable[[str], Any], Any]] = {
+    "points_multiplier": (float, 10.0),
+    "points_reward_multiplier": (float, 10.0),
+    "points_expiry_days": (int, 365),
+    "sync_enabled": (_parse_bool, False),
+    "store_name": (str, ""),
+    "store_logo": (str, ""),
+    "logo_url": (str, ""),
+}
+
+
+class SettingsCache:
+    def __init__(self, version_poll: float = SETTINGS_VERSION_POLL):
+        self.version_poll = version_poll
+        self._values: Optional[Dict[str, Any]] = None
+        self._version: Optional[int] = None
+        self._version_checked_at = 0.0
+        # Bumped by invalidate(), so a load that raced with a write is not kept
+        self._generation = 0
+        self.loads = 0
+
+    @staticmethod
+    def parse(key: str, value: Any) -> Any:
+        """Typed value of a setting; its default when missing or invalid"""
+        parser, default = SETTINGS[key]
+        if value is None or value == "":
+            return default
+        try:
+            return parser(value)
+        except (TypeError, ValueError):
+            logger.warning(f"Invalid value for setting {key}: {value!r}, using {default!r}")
+            return default
+
+    async def load(self, db) -> Dict[str, Any]:
+        """(Re)read every cached setting (called from app startup and on change)"""
+        generation = self._generation
+        docs = await db.settings.find({"key": {"$in": list(SETTINGS)}}, {"_id": 0, "key": 1, "value": 1}).to_list(None)
+        raw = {doc["key"]: doc.get("value") for doc in docs}
+        values = {key: self.parse(key, raw.get(key)) for key in SETTINGS}
+        self.loads += 1
+        if generation == self._generation:
+            self._values = values
+        return values
+
+    def invalidate(self):
+        """Drop the cached values in this process"""
+        self._generation += 1
+        self._values = None
+
+    async def _refresh_version(self, db):
+        """Pick up setting changes made by other processes"""
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_poll:
+            return
+        self._version_checked_at = now
+        try:
+            doc = await db.system_settings.find_one({"key": VERSION_KEY}, {"_id": 0, "value": 1})
+        except Exception as e:
+            logger.warning(f"Could not read settings version: {e}")
+            return
+        version = int(doc.get("value", 0)) if doc else 0
+        if self._version is not None and version != self._version:
+            self.invalidate()
+        self._version = version
+
+    async def get(self, db, key: str) -> Any:
+        """Parsed value of a cached setting"""
+        return (await self.get_all(db))[key]
+
+    async def get_all(self, db) -> Dict[str, Any]:
+        await self._refresh_version(db)
+        values = self._values
+        if values is None:
+            values = await self.load(db)
+        return values
+
+
+async def bump_settings_version(db):
+    """
+    Invalidate cached settings after a write to `settings`
+    Clears this process immediately and bumps the shared version so other
+    processes reload on their next poll. Failures are logged, not raised.
+    """
+    settings_cache.invalidate()
+    try:
+        await db.system_settings.update_one(
+            {"key": VERSION_KEY},
+            {"$inc": {"value": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    except Exception as e:
+        logger.warning(f"Could not bump settings version: {e}")
+
+
+settings_cache = SettingsCache()
@@ -0,0 +1,368 @@
+"""
+Batched commit stage for the Rewaa invoice sync
+Buffers processed invoices and writes them with a handful of bulk operations
+instead of several round trips per invoice
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from daily_stats import StatsDelta, apply_delta
+from points_lots import consume_lots
+from report_cache import bump_report_generation
+
+# Number of processed invoices buffered before a flush
+SYNC_COMMIT_BATCH_SIZE = int(os.getenv('SYNC_COMMIT_BATCH_SIZE', 50))
+# Attempts per flush; a retried flush resumes at the stage that failed
+SYNC_COMMIT_RETRIES = int(os.getenv('SYNC_COMMIT_RETRIES', 3))
+
+DUPLICATE_KEY_ERROR = 11000
+# Sync batch ids kept on each customer to guard the balance $inc
+SYNC_BATCH_MEMORY = 20
+# A sync run holds this lease in system_settings; it is renewed on every flush
+# and lapses after this many seconds if the run died
+SYNC_LEASE_KEY = "invoice_sync_lease"
+SYNC_LEASE_SECONDS = int(os.getenv('SYNC_LEASE_SECONDS', 600))
+
+_SYNC_NAMESPACE = uuid.UUID("3c1f6b8e-0d2a-4e57-9b64-71a5c2d8f903")
+
+
+class SyncLeaseHeld(RuntimeError):
+    """Raised when another sync run holds the lease"""
+
+
+def invoice_id(invoice_number: int) -> str:
+    """Same id for an invoice on every run, so a re-run finds what it wrote"""
+    return str(uuid.uuid5(_SYNC_NAMESPACE, f"invoice:{invoice_number}"))
+
+
+def invoice_transaction_id(invoice_number: int) -> str:
+    """Same id for the points transaction of an invoice on every run"""
+    return str(uuid.uuid5(_SYNC_NAMESPACE, f"transaction:{invoice_number}"))
+
+
+class InvoiceCommitBuffer:
+    """
+    Collects processed invoices and flushes them in a fixed order:
+
+    1. invoices            - one insert_many
+    2. points_transactions - one insert_many
+    3. customer balances   - one bulk_write, $inc merged per customer
+    4. points lots         - return invoices consume lots oldest first
+    5. daily_stats rollup  - one bulk_write, $inc merged per day
+    6. last_synced_invoice - one update, always last
+
+    Invoice and transaction ids are derived from the invoice number and every
+    transaction is written with the steps still to do in `pending_steps`
+    (balance, lots, stats), which each stage clears once it is written.
+    Because the checkpoint is written last, a process that dies mid-flush
+    re-fetches the batch on the next run: the unique indexes reject what was
+    already written, the stored documents are read back and only their
+    pending steps are finished. Retrying flush() in the same process works
+    the same way.
+
+    The balance $inc is guarded on the server as well: it filters out and
+    records the sync batch the transaction was written in, so repeating it
+    after an error that left its outcome unknown (network error, timeout) is
+    a no-op. As the guard covers the whole (batch, customer) sum, a resumed
+    entry of an earlier batch is credited with the sum of every stored
+    transaction of that batch and customer, whichever of them this run has
+    re-fetched so far. The lots stage is idempotent per transaction
+    (consume_lots); only a process that dies between the rollup write and
+    clearing its step can count a batch in daily_stats twice.
+
+    Runs are serialized by a lease in system_settings (acquire_lease), checked
+    again before every flush: two runs resuming the same batch would each
+    credit it and count it in daily_stats.
+    """
+
+    def __init__(self, db, batch_size: int = SYNC_COMMIT_BATCH_SIZE):
+        self.db = db
+        self.batch_size = max(1, batch_size)
+        self.entries: List[Dict[str, Any]] = []
+        self.checkpoint: Optional[int] = None  # highest contiguous invoice number handled
+        self.committed_count = 0
+        self.batch_id = str(uuid.uuid4())
+        self.run_id = str(uuid.uuid4())
+
+    async def acquire_lease(self) -> bool:
+        """Take or renew the sync lease for this run; False while another run holds it"""
+        now = datetime.now(timezone.utc)
+        try:
+            await self.db.system_settings.update_one(
+                {"key": SYNC_LEASE_KEY, "$or": [{"value.owner": self.run_id}, {"value.expires_at": {"$lt": now}}]},
+                {"$set": {
+                    "value": {"owner": self.run_id, "expires_at": now + timedelta(seconds=SYNC_LEASE_SECONDS)},
+                    "updated_at": now
+                }},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False  # held by another run: the upsert hit key_unique
+        return True
+
+    async def release_lease(self):
+        await self.db.system_settings.delete_one({"key": SYNC_LEASE_KEY, "value.owner": self.run_id})
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.entries) >= self.batch_size
+
+    def advance(self, invoice_number: int):
+        """Move the checkpoint forward for an invoice that needs no writes"""
+        if self.checkpoint is None or invoice_number > self.checkpoint:
+            self.checkpoint = invoice_number
+
+    def add(self, invoice_doc: Dict[str, Any], transaction_doc: Dict[str, Any]):
+        """Queue a synced invoice together with its points transaction"""
+        steps = ["balance"] + (["lots"] if transaction_doc["transaction_type"] == "returned" else []) + ["stats"]
+        transaction_doc["pending_steps"] = steps
+        transaction_doc["sync_batch"] = self.batch_id
+        self.entries.append({
+            "invoice": invoice_doc,
+            "transaction": transaction_doc,
+            "invoice_written": False,
+            "transaction_written": False,
+            "steps": list(steps)
+        })
+        self.advance(invoice_doc["invoice_number"])
+
+    async def _insert_pending(self, collection, key: str) -> List[Dict[str, Any]]:
+        """
+        insert_many of the entries whose `key` document is not written yet
+        Returns the entries whose document was rejected as a duplicate by the
+        unique indexes declared in indexes.py, i.e. written by an earlier run;
+        they count as written once the stored document has been read back.
+        """
+        flag = f"{key}_written"
+        pending = [entry for entry in self.entries if not entry[flag]]
+        if not pending:
+            return []
+
+        write_errors = {}
+        try:
+            await collection.insert_many([entry[key] for entry in pending], ordered=False)
+        except BulkWriteError as e:
+            write_errors = {error["index"]: error for error in e.details.get("writeErrors", [])}
+
+        duplicates = []
+        other_errors = []
+        for index, entry in enumerate(pending):
+            error = write_errors.get(index)
+            if error is None:
+                entry[flag] = True
+            elif error.get("code") == DUPLICATE_KEY_ERROR:
+                duplicates.append(entry)
+            else:
+                other_errors.append(error)
+
+        if other_errors:
+            raise BulkWriteError({"writeErrors": other_errors})
+        return duplicates
+
+    async def _resume_invoices(self, duplicates: List[Dict[str, Any]]):
+        """
+        Continue with the stored invoice of a re-fetched entry
+        An invoice stored under another id was written before ids were
+        derived from the invoice number, and its points were credited then:
+        that entry is dropped.
+        """
+        if not duplicates:
+            return
+        stored = {
+            invoice["invoice_number"]: invoice
+            for invoice in await self.db.invoices.find(
+                {"invoice_number": {"$in": [entry["invoice"]["invoice_number"] for entry in duplicates]}},
+                {"_id": 0}
+            ).to_list(None)
+        }
+        dropped = []
+        for entry in duplicates:
+            invoice = stored.get(entry["invoice"]["invoice_number"])
+            if invoice is None or invoice.get("id") != entry["invoice"]["id"]:
+                dropped.append(id(entry))
+            else:
+                entry["invoice"] = invoice
+                entry["invoice_written"] = True
+        if dropped:
+            skipped = [entry["invoice"]["invoice_number"] for entry in duplicates if id(entry) in dropped]
+            print(f"   ⚠️  Already synced, skipping: {skipped}")
+            self.entries = [entry for entry in self.entries if id(entry) not in dropped]
+
+    async def _resume_transactions(self, duplicates: List[Dict[str, Any]]):
+        """Continue with the stored transaction and the steps it still has pending"""
+        if not duplicates:
+            return
+        stored = {
+            transaction["id"]: transaction
+            for transaction in await self.db.points_transactions.find(
+                {"id": {"$in": [entry["transaction"]["id"] for entry in duplicates]}},
+                {"_id": 0}
+            ).to_list(None)
+        }
+        resumed = []
+        for entry in duplicates:
+            transaction = stored.get(entry["transaction"]["id"])
+            entry["transaction_written"] = True
+            if transaction is None:
+                # Rejected by invoice_id_unique: the invoice already has a transaction under another id
+                entry["steps"] = []
+                continue
+            entry["transaction"] = transaction
+            entry["steps"] = list(transaction.get("pending_steps") or [])
+            if entry["steps"]:
+                resumed.append(entry["invoice"]["invoice_number"])
+        if resumed:
+            print(f"   ↻ Finishing interrupted commit of: {resumed}")
+
+    async def _finish_step(self, entries: List[Dict[str, Any]], step: str):
+        """Clear a step on the stored transactions; stats is always the last one"""
+        if step == "stats":
+            update = {"$unset": {"pending_steps": "", "sync_batch": ""}}
+        else:
+            update = {"$pull": {"pending_steps": step}}
+        await self.db.points_transactions.update_many(
+            {"id": {"$in": [entry["transaction"]["id"] for entry in entries]}}, update
+        )
+        for entry in entries:
+            entry["steps"].remove(step)
+
+    def _pending(self, step: str) -> List[Dict[str, Any]]:
+        return [entry for entry in self.entries if step in entry["steps"]]
+
+    async def _merged_increments(self, entries: List[Dict[str, Any]]) -> Dict[Tuple[str, str], float]:
+        """
+        Points per (sync batch, customer); resumed entries keep their original batch
+        An earlier batch is summed from its stored transactions: the run that
+        wrote it may have batched invoices this run has not re-fetched yet.
+        """
+        increments: Dict[Tuple[str, str], float] = {}
+        earlier = set()
+        for entry in entries:
+            key = (entry["transaction"].get("sync_batch", self.batch_id), entry["transaction"]["customer_id"])
+            if key[0] == self.batch_id:
+                increments[key] = increments.get(key, 0) + entry["transaction"]["points"]
+            else:
+                earlier.add(key)
+        if earlier:
+            rows = await self.db.points_transactions.aggregate([
+                {"$match": {
+                    "sync_batch": {"$in": sorted({batch_id for batch_id, _ in earlier})},
+                    "customer_id": {"$in": sorted({customer_id for _, customer_id in earlier})}
+                }},
+                {"$group": {"_id": {"batch": "$sync_batch", "customer_id": "$customer_id"}, "points": {"$sum": "$points"}}}
+            ]).to_list(None)
+            for row in rows:
+                key = (row["_id"]["batch"], row["_id"]["customer_id"])
+                if key in earlier:
+                    increments[key] = row["points"]
+        return increments
+
+    async def _apply_balances(self):
+        """One bulk_write with a single $inc per customer, guarded by the sync batch"""
+        entries = self._pending("balance")
+        if not entries:
+            return
+
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(
+                {"id": customer_id, "recent_sync_batches": {"$ne": batch_id}},
+                {
+                    "$inc": {
+                        "total_points": points,
+                        "active_points": points
+                    },
+                    "$push": {"recent_sync_batches": {"$each": [batch_id], "$slice": -SYNC_BATCH_MEMORY}},
+                    "$set": {"updated_at": now}
+                }
+            )
+            for (batch_id, customer_id), points in (await self._merged_increments(entries)).items()
+        ]
+        await self.db.customers.bulk_write(operations, ordered=False)
+        await self._finish_step(entries, "balance")
+
+    async def _consume_returned_lots(self):
+        """Take the points of return invoices out of the customers' lots"""
+        for entry in self._pending("lots"):
+            transaction = entry["transaction"]
+            _, shortfall = await consume_lots(
+                self.db, transaction["customer_id"], abs(transaction["points"]), transaction_id=transaction["id"]
+            )
+            if shortfall > 0:
+                print(f"   ⚠️  Return invoice #{entry['invoice']['invoice_number']}: {shortfall:.2f} points not covered by open lots")
+            await self._finish_step([entry], "lots")
+
+    async def _apply_stats(self):
+        """Add the batch to the daily_stats rollup"""
+        entries = self._pending("stats")
+        if not entries:
+            return
+        delta = StatsDelta()
+        for entry in entries:
+            delta.add_invoice(entry["invoice"])
+            delta.add_transaction(entry["transaction"])
+        await apply_delta(self.db, delta)
+        await self._finish_step(entries, "stats")
+
+    async def _write_checkpoint(self):
+        if self.checkpoint is None:
+            return
+        await self.db.settings.update_one(
+            {"key": "last_synced_invoice"},
+            {"$set": {"value": str(self.checkpoint), "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    async def _flush_once(self):
+        if self.entries:
+            await self._resume_invoices(await self._insert_pending(self.db.invoices, "invoice"))
+            await self._resume_transactions(await self._insert_pending(self.db.points_transactions, "transaction"))
+            await self._apply_balances()
+            await self._consume_returned_lots()
+            await self._apply_stats()
+
+        await self._write_checkpoint()
+
+    async def flush(self, retries: int = SYNC_COMMIT_RETRIES) -> int:
+        """
+        Write everything buffered so far
+        Returns the number of invoices committed by this flush
+        """
+        if not self.entries and self.checkpoint is None:
+            return 0
+        if not await self.acquire_lease():
+            raise SyncLeaseHeld("Another invoice sync run holds the sync lease")
+
+        attempt = 1
+        while True:
+            try:
+                await self._flush_once()
+                break
+            except Exception as e:
+                if attempt >= retries:
+                    raise
+                print(f"   ⚠️  Commit flush failed (attempt {attempt}/{retries}): {e}. Retrying...")
+                attempt += 1
+                await asyncio.sleep(attempt)
+
+        committed = len(self.entries)
+        if committed:
+            # New ledger data: cached dashboard reports are stale
+            await bump_report_generation(self.db)
+            customers = {entry["transaction"]["customer_id"] for entry in self.entries}
+            print(f"   💾 Committed {committed} invoices for {len(customers)} customers (up to #{self.checkpoint})")
+
+        self.committed_count += committed
+        self.entries = []
+        self.checkpoint = None
+        self.batch_id = str(uuid.uuid4())
+        return committed
@@ -0,0 +1,62 @@
+"""
+Shared helpers for the unit tests
+A fixed clock, an async cursor and a MagicMock database whose listed
+collection methods are awaitable, plus the two ways tests feed it reads:
+returns() for awaited calls at the end of a chain such as
+"customers.find.sort.to_list", iterates() for cursors read with async for.
+"""
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock
+
+NOW = datetime(2025, 6, 1, tzinfo=timezone.utc)
+
+
+class AsyncCursor:
+    """Motor cursor stand-in: iterate with async for, or read with to_list"""
+
+    def __init__(self, docs):
+        self.docs = list(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.docs:
+            raise StopAsyncIteration
+        return self.docs.pop(0)
+
+    async def to_list(self, length):
+        return self.docs if length is None else self.docs[:length]
+
+
+def mock_db(*async_methods: str) -> MagicMock:
+    """MagicMock database where each "collection.method" listed is an AsyncMock"""
+    db = MagicMock()
+    for name in async_methods:
+        collection, method = name.split(".")
+        setattr(getattr(db, collection), method, AsyncMock())
+    return db
+
+
+def _chain(db: MagicMock, chain: str):
+    """(object holding the last call, name of the last call) of a "collection.call.call" chain"""
+    collection, *calls = chain.split(".")
+    node = getattr(db, collection)
+    for call in calls[:-1]:
+        node = getattr(node, call).return_value
+    return node, calls[-1]
+
+
+def returns(db: MagicMock, chain: str, *results) -> AsyncMock:
+    """Await the last call of `chain` to `results` in turn (one result: every time)"""
+    node, name = _chain(db, chain)
+    mock = AsyncMock(return_value=results[0]) if len(results) == 1 else AsyncMock(side_effect=list(results))
+    setattr(node, name, mock)
+    return mock
+
+
+def iterates(db: MagicMock, chain: str, docs) -> MagicMock:
+    """Make the last call of `chain` return a cursor over `docs`"""
+    node, name = _chain(db, chain)
+    getattr(node, name).return_value = AsyncCursor(docs)
+    return getattr(node, name)
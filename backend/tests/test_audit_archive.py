@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for audit log retention
+Tests month selection and archive-then-delete in audit_archive.py
+"""
+
+import gzip
+import tempfile
+import unittest
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from bson import json_util
+from bson.json_util import JSONOptions
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from tests.helpers import mock_db, returns
+from audit_archive import archive_audit_logs, archive_month, months_to_archive
+
+JAN = datetime(2025, 1, 1, tzinfo=timezone.utc)
+FEB = datetime(2025, 2, 1, tzinfo=timezone.utc)
+
+
+class TestMonthsToArchive(unittest.TestCase):
+
+    def test_only_whole_months_before_cutoff(self):
+        oldest = datetime(2024, 11, 20, tzinfo=timezone.utc)
+        cutoff = datetime(2025, 1, 15, tzinfo=timezone.utc)
+        months = months_to_archive(oldest, cutoff)
+        self.assertEqual([start.month for start, _ in months], [11, 12])
+        self.assertEqual(months[-1][1], JAN)
+
+    def test_nothing_when_empty_or_recent(self):
+        self.assertEqual(months_to_archive(None, JAN), [])
+        self.assertEqual(months_to_archive(datetime(2025, 1, 3, tzinfo=timezone.utc), JAN.replace(day=20)), [])
+
+
+class TestArchiveMonth(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.archive_dir = Path(self.tmp.name)
+        self.db = mock_db()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def stored(self, events, count=None):
+        """Events of the month in one read; count is what count_documents reports"""
+        returns(self.db, "audit_logs.count_documents", len(events) if count is None else count)
+        returns(self.db, "audit_logs.find.sort.to_list", events, [])
+        returns(self.db, "audit_logs.delete_many", MagicMock(deleted_count=len(events)))
+        return returns(self.db, "audit_logs.find_one", {"timestamp": events[0]["timestamp"]})
+
+    async def test_month_is_written_then_deleted(self):
+        events = [{"id": str(i), "action": "otp_sent", "timestamp": JAN.replace(day=i + 1)} for i in range(3)]
+        self.stored(events)
+
+        result = await archive_month(self.db, JAN, FEB, self.archive_dir)
+
+        path = Path(result["file"])
+        self.assertEqual(path.name, "audit_logs-2025-01.jsonl.gz")
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            archived = [json_util.loads(line, json_options=JSONOptions(tz_aware=True)) for line in f]
+        self.assertEqual([e["id"] for e in archived], ["0", "1", "2"])
+        self.assertEqual(archived[0]["timestamp"], JAN)
+        self.db.audit_logs.delete_many.assert_awaited_once_with({"timestamp": {"$gte": JAN, "$lt": FEB}})
+        self.assertEqual(result["deleted"], 3)
+
+    async def test_incomplete_export_deletes_nothing(self):
+        events = [{"id": "1", "timestamp": JAN}]
+        self.stored(events, count=2)
+
+        with self.assertRaises(RuntimeError):
+            await archive_month(self.db, JAN, FEB, self.archive_dir)
+        self.db.audit_logs.delete_many.assert_not_awaited()
+        self.assertEqual(list(self.archive_dir.iterdir()), [])
+
+    async def test_second_archive_of_a_month_gets_a_new_part(self):
+        (self.archive_dir / "audit_logs-2025-01.jsonl.gz").write_bytes(b"")
+        self.stored([{"id": "1", "timestamp": JAN}])
+        result = await archive_month(self.db, JAN, FEB, self.archive_dir)
+        self.assertTrue(result["file"].endswith("audit_logs-2025-01.2.jsonl.gz"))
+
+    async def test_dry_run_only_counts(self):
+        self.stored([{"id": "1", "timestamp": JAN}])
+        results = await archive_audit_logs(
+            self.db, retention_days=30, archive_dir=self.archive_dir, dry_run=True,
+            now=datetime(2025, 3, 15, tzinfo=timezone.utc)
+        )
+        self.assertEqual([r["month"] for r in results], ["2025-01"])
+        self.db.audit_logs.delete_many.assert_not_awaited()
+
+    async def test_legacy_string_timestamps_are_not_the_oldest(self):
+        oldest = self.stored([{"id": "1", "timestamp": JAN}])
+
+        async def find_one(query, projection, sort):
+            # BSON orders strings before dates
+            if query.get("timestamp") != {"$type": "date"}:
+                return {"timestamp": "2024-06-01T10:00:00+00:00"}
+            return {"timestamp": JAN}
+
+        oldest.side_effect = find_one
+        results = await archive_audit_logs(
+            self.db, retention_days=30, archive_dir=self.archive_dir, dry_run=True,
+            now=datetime(2025, 3, 15, tzinfo=timezone.utc)
+        )
+        self.assertEqual([r["month"] for r in results], ["2025-01"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the buffered audit writer
+Tests AuditSink and AuditLogger.log in audit_log.py
+"""
+
+import asyncio
+import unittest
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from tests.helpers import mock_db
+import audit_log
+from audit_log import AuditLogger, AuditSink
+
+
+async def wait_until(predicate, timeout=2.0):
+    """Let the background writer run until predicate() holds"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate() and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+class TestAuditSink(unittest.IsolatedAsyncioTestCase):
+    """Batching, overflow policy and shutdown flush"""
+
+    async def test_not_started_writes_directly(self):
+        db = mock_db("audit_logs.insert_one", "audit_logs.insert_many")
+        sink = AuditSink()
+        await sink.submit(db, {"action": "x"})
+        db.audit_logs.insert_one.assert_awaited_once()
+        self.assertEqual(sink.direct, 1)
+
+    async def test_full_batch_is_flushed_without_waiting(self):
+        db = mock_db("audit_logs.insert_one", "audit_logs.insert_many")
+        sink = AuditSink(batch_size=3, flush_interval=60)
+        sink.start(db)
+        for i in range(3):
+            await sink.submit(db, {"action": str(i)})
+        db.audit_logs.insert_one.assert_not_awaited()
+
+        await wait_until(lambda: sink.written)
+        db.audit_logs.insert_many.assert_awaited_once()
+        self.assertEqual(len(db.audit_logs.insert_many.call_args[0][0]), 3)
+        self.assertEqual(sink.written, 3)
+        await sink.stop()
+
+    async def test_partial_batch_is_flushed_on_interval(self):
+        db = mock_db("audit_logs.insert_one", "audit_logs.insert_many")
+        sink = AuditSink(batch_size=100, flush_interval=0.05)
+        sink.start(db)
+        await sink.submit(db, {"action": "x"})
+        await wait_until(lambda: sink.written)
+        self.assertEqual(sink.written, 1)
+        await sink.stop()
+
+    async def test_stop_flushes_buffer(self):
+        db = mock_db("audit_logs.insert_one", "audit_logs.insert_many")
+        sink = AuditSink(batch_size=2, flush_interval=60)
+        sink.start(db)
+        await sink.submit(db, {"action": "x"})
+        await sink.stop()
+        self.assertEqual(sink.written, 1)
+        self.assertFalse(sink.running)
+
+    async def test_overflow_drops_except_critical(self):
+        db = mock_db("audit_logs.insert_one", "audit_logs.insert_many")
+        sink = AuditSink(max_queue=2, batch_size=100, flush_interval=60)
+        sink.start(db)
+        for _ in range(4):
+            await sink.submit(db, {"action": "x", "severity": "info"})
+        await sink.submit(db, {"action": "y", "severity": "critical"})
+
+        self.assertEqual(sink.dropped, 2)
+        self.assertEqual(sink.stats()["queued"], 2)
+        db.audit_logs.insert_one.assert_awaited_once()  # the critical event
+        await sink.stop()
+
+    async def test_failed_batch_is_counted(self):
+        db = mock_db("audit_logs.insert_one", "audit_logs.insert_many")
+        db.audit_logs.insert_many = AsyncMock(side_effect=RuntimeError("down"))
+        sink = AuditSink(batch_size=100, flush_interval=60)
+        sink.start(db)
+        await sink.submit(db, {"action": "x"})
+        await sink.stop()
+        self.assertEqual(sink.lost, 1)
+        self.assertEqual(sink.write_errors, 1)
+
+    async def test_logger_log_uses_the_sink(self):
+        db = mock_db("audit_logs.insert_one", "audit_logs.insert_many")
+        sink = AuditSink(batch_size=100, flush_interval=60)
+        original = audit_log.audit_sink
+        audit_log.audit_sink = sink
+        try:
+            sink.start(db)
+            await AuditLogger.log(db, "otp_sent", "system", "system", "SMS Service")
+            db.audit_logs.insert_one.assert_not_awaited()
+            await sink.stop()
+            event = db.audit_logs.insert_many.call_args[0][0][0]
+            self.assertEqual(event["action"], "otp_sent")
+        finally:
+            audit_log.audit_sink = original
+
+
+if __name__ == "__main__":
+    unittest.main()
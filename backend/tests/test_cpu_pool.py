@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the CPU worker pool
+Tests CPUPool and the password helpers in cpu_pool.py
+"""
+
+import asyncio
+import threading
+import unittest
+import sys
+from pathlib import Path
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from cpu_pool import CPUPool, CPUPoolBusy, hash_password, verify_password
+
+
+class TestCPUPool(unittest.IsolatedAsyncioTestCase):
+    """Off-loop execution, bounded queue and metrics"""
+
+    async def test_password_round_trip_off_the_loop(self):
+        hashed = await hash_password("Admin@123")
+        self.assertTrue(await verify_password("Admin@123", hashed))
+        self.assertFalse(await verify_password("wrong", hashed))
+
+    async def test_runs_on_worker_thread(self):
+        pool = CPUPool(workers=2, max_queue=2)
+        thread_name = await pool.run(lambda: threading.current_thread().name)
+        self.assertTrue(thread_name.startswith("cpu-pool"))
+        self.assertEqual(pool.stats()["completed"], 1)
+        pool.shutdown()
+
+    async def test_full_queue_is_rejected(self):
+        pool = CPUPool(workers=1, max_queue=1)
+        release = threading.Event()
+
+        first = asyncio.ensure_future(pool.run(release.wait))
+        second = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0.05)
+
+        stats = pool.stats()
+        self.assertEqual(stats["running"], 1)
+        self.assertEqual(stats["queued"], 1)
+        with self.assertRaises(CPUPoolBusy):
+            await pool.run(release.wait)
+
+        release.set()
+        await asyncio.gather(first, second)
+        stats = pool.stats()
+        self.assertEqual((stats["completed"], stats["rejected"], stats["running"], stats["queued"]), (2, 1, 0, 0))
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for customer search
+Tests search fields and query building in customer_search.py
+"""
+
+import unittest
+import sys
+from pathlib import Path
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from customer_search import SEARCH_FIELDS, build_search_query, exact_phone, normalize_arabic, search_fields
+
+
+class TestCustomerSearch(unittest.TestCase):
+    """Search fields and anchored, escaped queries"""
+
+    def test_search_fields(self):
+        fields = search_fields("Ali Hassan", "Ali.H@Example.com", "0550755465")
+        self.assertEqual(fields["name_key"], "ali hassan")
+        self.assertEqual(fields["phone_digits"], "966550755465")
+        self.assertEqual(fields["phone_digits_rev"], "564557055669")
+        self.assertEqual(
+            fields["search_tokens"],
+            ["ali", "ali.h", "ali.h@example.com", "example.com", "hassan"]
+        )
+        # SEARCH_FIELDS is what the API projections leave out
+        self.assertEqual(sorted(fields), sorted(SEARCH_FIELDS))
+
+    def test_local_phone_prefix_matches_international_digits(self):
+        query = build_search_query("0550")
+        self.assertIn({"phone_digits": {"$regex": "^9665" + "50"}}, query["$or"])
+        self.assertIn({"phone_digits_rev": {"$regex": "^0550"}}, query["$or"])
+
+    def test_words_must_all_match_and_are_escaped(self):
+        query = build_search_query("Ali (h")
+        self.assertEqual(query["$or"], [
+            {"name_key": {"$regex": "^ali\\ \\(h"}},
+            {"$and": [
+                {"search_tokens": {"$regex": "^ali"}},
+                {"search_tokens": {"$regex": "^\\(h"}}
+            ]}
+        ])
+
+    def test_arabic_spelling_variants_share_a_key(self):
+        stored = search_fields("أُسامة الشَّمري", None, "0550755465")["name_key"]
+        self.assertEqual(stored, normalize_arabic("اسامه الشمري"))
+        self.assertEqual(normalize_arabic("مُصْطَفى"), normalize_arabic("مصطفي"))
+        self.assertEqual(normalize_arabic("إيمان"), normalize_arabic("ايمان"))
+        self.assertEqual(normalize_arabic("عـــلي"), "علي")
+
+    def test_arabic_query_prefix_matches_name_key(self):
+        query = build_search_query("أسامة الش")
+        self.assertIn({"name_key": {"$regex": "^اسامه\\ الش"}}, query["$or"])
+
+    def test_exact_phone(self):
+        self.assertEqual(exact_phone("055 075 5465"), "+966550755465")
+        self.assertIsNone(exact_phone("0550"))
+
+
+if __name__ == "__main__":
+    unittest.main()
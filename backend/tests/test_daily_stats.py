@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the daily_stats rollup
+Tests StatsDelta, the rollup readers, the rebuild and the startup build guard
+in daily_stats.py. The rebuild runs its real pipelines over raw fixture
+documents (run_pipeline below) and is compared with totals computed directly
+from the same fixtures.
+"""
+
+import unittest
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+
+from pymongo.errors import DuplicateKeyError
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from tests.helpers import AsyncCursor, mock_db, returns
+from daily_stats import (
+    COUNTER_FIELDS,
+    REBUILD_KEY,
+    StatsDelta,
+    active_customers,
+    day_start,
+    ensure_daily_stats_built,
+    rebuild_daily_stats,
+    sum_stats,
+)
+
+DAY1 = datetime(2025, 3, 1, tzinfo=timezone.utc)
+DAY2 = DAY1 + timedelta(days=1)
+DAY3 = DAY1 + timedelta(days=2)
+
+
+def at(day, hours):
+    return day + timedelta(hours=hours)
+
+
+TRANSACTIONS = [
+    {"customer_id": "c1", "transaction_type": "earned", "points": 10.0, "created_at": at(DAY1, 9)},
+    {"customer_id": "c2", "transaction_type": "earned", "points": 4.5, "created_at": at(DAY1, 23)},
+    {"customer_id": "c1", "transaction_type": "manual_add", "points": 20.0, "created_at": at(DAY1, 12)},
+    {"customer_id": "c1", "transaction_type": "redeemed", "points": -15.0, "created_at": at(DAY2, 0)},
+    {"customer_id": "c2", "transaction_type": "returned", "points": -2.0, "created_at": at(DAY2, 8)},
+    {"customer_id": "c1", "transaction_type": "earned", "points": 6.0, "created_at": at(DAY2, 10)},
+    {"customer_id": "c3", "transaction_type": "expired", "points": -7.0, "created_at": at(DAY3, 1)},
+    # Legacy string date: not counted by the rebuild
+    {"customer_id": "c3", "transaction_type": "earned", "points": 99.0, "created_at": "2025-03-02T10:00:00"},
+]
+INVOICES = [
+    {"customer_id": "c1", "total_amount": 100.0, "invoice_date": at(DAY1, 9)},
+    {"customer_id": "c2", "total_amount": 45.0, "invoice_date": at(DAY1, 23)},
+    {"customer_id": "c1", "total_amount": 60.0, "invoice_date": at(DAY2, 10)},
+]
+CUSTOMERS = [
+    {"id": "c1", "created_at": at(DAY1, 8)},
+    {"id": "c2", "created_at": at(DAY1, 22)},
+    {"id": "c3", "created_at": at(DAY3, 0)},
+]
+
+
+def raw_totals():
+    """Per-day counters straight from the fixtures, without any pipeline"""
+    days = {}
+
+    def day(when):
+        return days.setdefault(day_start(when), {field: 0 for field in COUNTER_FIELDS} | {"active_customer_ids": set()})
+
+    for tx in TRANSACTIONS:
+        if not isinstance(tx["created_at"], datetime):
+            continue
+        doc = day(tx["created_at"])
+        kind = tx["transaction_type"]
+        if kind in ("earned", "manual_add"):
+            doc["earned"] += tx["points"]
+        else:
+            doc[kind] += abs(tx["points"])
+        if kind == "earned":
+            doc["active_customer_ids"].add(tx["customer_id"])
+    for invoice in INVOICES:
+        doc = day(invoice["invoice_date"])
+        doc["sales"] += invoice["total_amount"]
+        doc["invoice_count"] += 1
+    for customer in CUSTOMERS:
+        day(customer["created_at"])["new_customers"] += 1
+    return days
+
+
+REMOVE = object()
+
+
+def evaluate(expr, doc):
+    """The aggregation expressions the rollup pipelines use"""
+    if isinstance(expr, str) and expr == "$$REMOVE":
+        return REMOVE
+    if isinstance(expr, str) and expr.startswith("$"):
+        return doc.get(expr[1:])
+    if isinstance(expr, dict):
+        (op, args), = expr.items()
+        if op == "$cond":
+            return evaluate(args[1], doc) if evaluate(args[0], doc) else evaluate(args[2], doc)
+        if op == "$in":
+            return evaluate(args[0], doc) in args[1]
+        if op == "$abs":
+            return abs(evaluate(args, doc))
+        if op == "$dateTrunc":
+            assert args["unit"] == "day" and args["timezone"] == "UTC"
+            return day_start(evaluate(args["date"], doc))
+        raise NotImplementedError(op)
+    return expr
+
+
+def matches(query, doc):
+    for field, condition in query.items():
+        value = doc.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for op, arg in condition.items():
+            if op == "$type" and not (arg == "date" and isinstance(value, datetime)):
+                return False
+            if op in ("$gte", "$lt") and not isinstance(value, datetime):
+                return False
+            if op == "$gte" and not value >= arg:
+                return False
+            if op == "$lt" and not value < arg:
+                return False
+    return True
+
+
+def run_pipeline(docs, pipeline):
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            docs = [doc for doc in docs if matches(spec, doc)]
+        elif name == "$unwind":
+            field = spec[1:]
+            docs = [{**doc, field: item} for doc in docs for item in doc.get(field) or []]
+        elif name == "$group":
+            groups = {}
+            for doc in docs:
+                key = evaluate(spec["_id"], doc)
+                group = groups.setdefault(key, {"_id": key})
+                for field, accumulator in spec.items():
+                    if field == "_id":
+                        continue
+                    (op, arg), = accumulator.items()
+                    value = evaluate(arg, doc)
+                    if op == "$sum":
+                        group[field] = group.get(field, 0) + (value if isinstance(value, (int, float)) else 0)
+                    elif op == "$addToSet":
+                        items = group.setdefault(field, [])
+                        if value is not REMOVE and value not in items:
+                            items.append(value)
+            docs = list(groups.values())
+        else:
+            raise NotImplementedError(name)
+    return docs
+
+
+def fixture_db(daily_stats=()):
+    db = mock_db("daily_stats.delete_many", "daily_stats.insert_many")
+    db.points_transactions.aggregate.side_effect = lambda pipeline: AsyncCursor(run_pipeline(TRANSACTIONS, pipeline))
+    db.invoices.aggregate.side_effect = lambda pipeline: AsyncCursor(run_pipeline(INVOICES, pipeline))
+    db.customers.aggregate.side_effect = lambda pipeline: AsyncCursor(run_pipeline(CUSTOMERS, pipeline))
+    db.daily_stats.aggregate.side_effect = lambda pipeline: AsyncCursor(run_pipeline(list(daily_stats), pipeline))
+    return db
+
+
+async def rebuilt_days(since=None):
+    db = fixture_db()
+    written = await rebuild_daily_stats(db, since)
+    docs = db.daily_stats.insert_many.call_args[0][0]
+    assert written == len(docs)
+    return db, docs
+
+
+class TestStatsDelta(unittest.TestCase):
+
+    def test_fixtures_replayed_as_deltas_match_raw_totals(self):
+        """The write paths' increments add up to the same counters the rebuild writes"""
+        delta = StatsDelta()
+        for tx in TRANSACTIONS:
+            if isinstance(tx["created_at"], datetime):
+                delta.add_transaction(tx)
+        for invoice in INVOICES:
+            delta.add_invoice(invoice)
+        for customer in CUSTOMERS:
+            delta.add(customer["created_at"], new_customers=1)
+
+        expected = raw_totals()
+        self.assertEqual(set(delta.days), set(expected))
+        for day, change in delta.days.items():
+            counters = {field: value for field, value in expected[day].items() if field in COUNTER_FIELDS and value}
+            self.assertEqual(change["inc"], counters)
+            self.assertEqual(change["active"], expected[day]["active_customer_ids"])
+
+    def test_removal_and_operations(self):
+        delta = StatsDelta()
+        delta.add_transaction(TRANSACTIONS[0])
+        delta.add_transaction(TRANSACTIONS[0], sign=-1)
+        delta.add(at(DAY2, 5), sales=10.0, invoice_count=1)
+
+        operations = {op._filter["day"]: op._doc for op in delta.operations()}
+        self.assertEqual(operations[DAY1]["$inc"], {"earned": 0.0})
+        self.assertEqual(operations[DAY1]["$addToSet"]["active_customer_ids"]["$each"], ["c1"])
+        self.assertEqual(operations[DAY2]["$inc"], {"sales": 10.0, "invoice_count": 1})
+        self.assertTrue(all(op._upsert for op in delta.operations()))
+
+    def test_unknown_counter_is_rejected(self):
+        with self.assertRaises(ValueError):
+            StatsDelta().add(DAY1, refunds=1)
+
+
+class TestRebuild(unittest.IsolatedAsyncioTestCase):
+
+    async def test_rebuild_matches_raw_totals(self):
+        db, docs = await rebuilt_days()
+
+        expected = raw_totals()
+        self.assertEqual([doc["day"] for doc in docs], sorted(expected))
+        for doc in docs:
+            raw = expected[doc["day"]]
+            for field in COUNTER_FIELDS:
+                self.assertAlmostEqual(doc[field], raw[field], msg=f"{doc['day']:%Y-%m-%d} {field}")
+            self.assertEqual(set(doc["active_customer_ids"]), raw["active_customer_ids"])
+        db.daily_stats.delete_many.assert_awaited_once_with({})
+
+    async def test_rebuild_since_replaces_only_later_days(self):
+        db, docs = await rebuilt_days(since=at(DAY2, 15))
+
+        self.assertEqual([doc["day"] for doc in docs], [DAY2, DAY3])
+        self.assertEqual(docs[0]["redeemed"], 15.0)
+        db.daily_stats.delete_many.assert_awaited_once_with({"day": {"$gte": DAY2}})
+
+
+class TestReaders(unittest.IsolatedAsyncioTestCase):
+
+    async def test_sum_stats_over_rebuilt_days(self):
+        _, docs = await rebuilt_days()
+        db = fixture_db(daily_stats=docs)
+
+        totals = await sum_stats(db, DAY1, DAY3)
+
+        expected = raw_totals()
+        for field in COUNTER_FIELDS:
+            self.assertAlmostEqual(totals[field], expected[DAY1][field] + expected[DAY2][field])
+        self.assertEqual((await sum_stats(db, DAY3))["expired"], 7.0)
+
+    async def test_sum_stats_without_days_is_zero(self):
+        totals = await sum_stats(fixture_db(), DAY1)
+        self.assertEqual(totals, {field: 0 for field in COUNTER_FIELDS})
+
+    async def test_active_customers_are_distinct_per_range(self):
+        _, docs = await rebuilt_days()
+        db = fixture_db(daily_stats=docs)
+
+        self.assertEqual(await active_customers(db, DAY1), {"c1", "c2"})
+        self.assertEqual(await active_customers(db, DAY2, DAY3), {"c1"})
+        self.assertEqual(await active_customers(db, DAY3), set())
+
+
+@patch("daily_stats.rebuild_daily_stats", new_callable=AsyncMock, return_value=12)
+class TestEnsureBuilt(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.db = mock_db("system_settings.update_one", "system_settings.delete_one")
+        self.claim = returns(self.db, "system_settings.find_one", None)
+        returns(self.db, "system_settings.find_one_and_update", None)
+        self.migrated = returns(self.db, "migrations.find_one", {"done": True})
+        # db[collection].find_one({field: {"$type": "string"}})
+        self.string_date = self.db.__getitem__.return_value.find_one = AsyncMock(return_value=None)
+        self.days = returns(self.db, "daily_stats.estimated_document_count", 0)
+
+    async def test_first_worker_claims_and_builds(self, rebuild):
+        self.assertEqual(await ensure_daily_stats_built(self.db), 12)
+
+        query, update = self.db.system_settings.find_one_and_update.call_args[0]
+        self.assertEqual(query, {"key": REBUILD_KEY})
+        self.assertIn("$setOnInsert", update)
+        rebuild.assert_awaited_once_with(self.db)
+        self.assertEqual(self.db.system_settings.update_one.call_args[0][1]["$set"]["value"]["state"], "done")
+
+    async def test_claimed_rollup_is_left_alone(self, rebuild):
+        self.claim.return_value = {"key": REBUILD_KEY, "value": {"state": "running"}}
+        self.assertIsNone(await ensure_daily_stats_built(self.db))
+        rebuild.assert_not_awaited()
+
+    async def test_string_dates_block_the_build(self, rebuild):
+        self.migrated.return_value = None
+        self.string_date.return_value = {"_id": 1}
+
+        with self.assertLogs("daily_stats", "WARNING") as logs:
+            self.assertIsNone(await ensure_daily_stats_built(self.db))
+
+        self.assertIn("points_transactions.created_at", logs.output[0])
+        self.db.system_settings.find_one_and_update.assert_not_awaited()
+        rebuild.assert_not_awaited()
+
+    async def test_database_without_string_dates_needs_no_migration(self, rebuild):
+        self.migrated.return_value = None
+        self.assertEqual(await ensure_daily_stats_built(self.db), 12)
+
+    async def test_concurrent_claim_is_skipped(self, rebuild):
+        self.db.system_settings.find_one_and_update.side_effect = DuplicateKeyError("duplicate key")
+        self.assertIsNone(await ensure_daily_stats_built(self.db))
+        rebuild.assert_not_awaited()
+
+    async def test_existing_rollup_is_only_marked(self, rebuild):
+        self.days.return_value = 30
+        self.assertEqual(await ensure_daily_stats_built(self.db), 0)
+        rebuild.assert_not_awaited()
+        self.db.system_settings.update_one.assert_awaited_once()
+
+    async def test_failed_build_releases_the_claim(self, rebuild):
+        rebuild.side_effect = RuntimeError("down")
+        with self.assertRaises(RuntimeError):
+            await ensure_daily_stats_built(self.db)
+        self.db.system_settings.delete_one.assert_awaited_once_with({"key": REBUILD_KEY})
+
+
+if __name__ == "__main__":
+    unittest.main()
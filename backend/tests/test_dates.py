@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the timestamp codec
+Tests parse_datetime in models.py
+"""
+
+import unittest
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from models import parse_datetime
+
+
+class TestParseDatetime(unittest.TestCase):
+    """Stored strings and Rewaa dates normalise to aware UTC datetimes"""
+
+    def test_zulu_and_offsets_convert_to_utc(self):
+        expected = datetime(2025, 1, 31, 11, 0, tzinfo=timezone.utc)
+        self.assertEqual(parse_datetime("2025-01-31T11:00:00Z"), expected)
+        self.assertEqual(parse_datetime("2025-01-31T14:00:00+03:00"), expected)
+        self.assertEqual(parse_datetime("2025-01-31T11:00:00.000+00:00"), expected)
+
+    def test_naive_values_are_treated_as_utc(self):
+        parsed = parse_datetime("2025-01-31T11:00:00")
+        self.assertEqual(parsed.tzinfo, timezone.utc)
+        self.assertEqual(parse_datetime(datetime(2025, 1, 31, 11)), parsed)
+
+    def test_invalid_values_return_none(self):
+        self.assertIsNone(parse_datetime(None))
+        self.assertIsNone(parse_datetime(""))
+        self.assertIsNone(parse_datetime("not a date"))
+
+
+if __name__ == "__main__":
+    unittest.main()
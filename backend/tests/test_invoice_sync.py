@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the windowed invoice sync
+Tests InvoiceWindowFetcher and how sync_invoices_once handles fetch errors in cron_jobs.py
+"""
+
+import asyncio
+import unittest
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+
+from pymongo.errors import DuplicateKeyError
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from tests.helpers import mock_db, returns
+from cron_jobs import InvoiceWindowFetcher, SyncCustomerLookup, find_customer_phone, sync_invoices_once
+from sync_commit import InvoiceCommitBuffer
+from rewaa import RewaaUnavailable
+from settings_cache import settings_cache
+
+
+class TestInvoiceWindowFetcher(unittest.IsolatedAsyncioTestCase):
+
+    async def test_results_come_back_in_number_order(self):
+        """Later numbers finishing first are held back until the earlier ones are in"""
+        delays = {1: 0.03, 2: 0.01, 3: 0.0, 4: 0.02}
+        finished = []
+
+        async def get_invoice_by_number(invoice_number):
+            await asyncio.sleep(delays[invoice_number])
+            finished.append(invoice_number)
+            return {"number": invoice_number}
+
+        with patch("cron_jobs.rewaa_service") as rewaa:
+            rewaa.get_invoice_by_number = AsyncMock(side_effect=get_invoice_by_number)
+            fetcher = InvoiceWindowFetcher(1, window_size=4, concurrency=4)
+            results = [await fetcher.next() for _ in range(4)]
+            fetcher.close()
+
+        self.assertEqual([number for number, _ in results], [1, 2, 3, 4])
+        self.assertEqual([invoice["number"] for _, invoice in results], [1, 2, 3, 4])
+        self.assertNotEqual(finished, [1, 2, 3, 4])
+        self.assertEqual(fetcher.fetched_count, 4)
+
+    async def test_close_cancels_the_outstanding_window(self):
+        started = []
+        release = asyncio.Event()
+
+        async def get_invoice_by_number(invoice_number):
+            started.append(invoice_number)
+            if invoice_number > 1:
+                await release.wait()
+            return {"number": invoice_number}
+
+        with patch("cron_jobs.rewaa_service") as rewaa:
+            rewaa.get_invoice_by_number = AsyncMock(side_effect=get_invoice_by_number)
+            fetcher = InvoiceWindowFetcher(1, window_size=4, concurrency=2)
+            self.assertEqual(await fetcher.next(), (1, {"number": 1}))
+            outstanding = [task for _, task in fetcher.pending]
+            fetcher.close()
+            await asyncio.sleep(0)
+
+        self.assertEqual(len(outstanding), 3)
+        self.assertTrue(all(task.cancelled() for task in outstanding))
+        self.assertEqual(len(fetcher.pending), 0)
+        # Only two requests may be in flight, so the last number never started
+        self.assertNotIn(4, started)
+
+
+class TestSyncCustomerLookup(unittest.IsolatedAsyncioTestCase):
+
+    def test_phone_is_found_in_nested_fields(self):
+        self.assertEqual(find_customer_phone({"customer": {"phone": "0501"}}), ("0501", "customer.phone"))
+        self.assertEqual(
+            find_customer_phone({"Customer": {}, "payments": [{}, {"customerMobile": "0502"}]}),
+            ("0502", "payments[].customerMobile")
+        )
+        self.assertEqual(find_customer_phone({"total": 10}), (None, None))
+
+    async def test_lookups_run_concurrently(self):
+        in_flight = []
+        most_in_flight = 0
+
+        async def find_one(query, projection):
+            nonlocal most_in_flight
+            in_flight.append(query["phone"])
+            most_in_flight = max(most_in_flight, len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(query["phone"])
+            return {"id": query["phone"]}
+
+        db = mock_db("customers.find_one")
+        db.customers.find_one.side_effect = find_one
+        lookup = SyncCustomerLookup(db, concurrency=3)
+        for phone in ("0501111111", "0502222222", "0503333333"):
+            lookup.prefetch({"mobileNumber": phone})
+
+        customer = await lookup.get("+966503333333")
+
+        self.assertEqual(customer, {"id": "+966503333333"})
+        self.assertEqual(most_in_flight, 3)
+        lookup.close()
+
+    async def test_new_customer_is_registered_once(self):
+        db = mock_db("customers.insert_one", "daily_stats.bulk_write")
+        returns(db, "customers.find_one", None, {"id": "c1", "name": "New"})
+        lookup = SyncCustomerLookup(db)
+
+        with patch("cron_jobs.rewaa_service") as rewaa, patch("cron_jobs.record_stats", new_callable=AsyncMock):
+            rewaa.get_customer_by_mobile = AsyncMock(return_value={"id": 7, "name": "New"})
+            lookup.prefetch({"Customer": {"mobile": "0501234567"}})
+            lookup.prefetch({"payments": [{"customerPhone": "0501234567"}]})
+            customer = await lookup.get("+966501234567")
+
+        self.assertEqual(customer["id"], "c1")
+        db.customers.insert_one.assert_awaited_once()
+        self.assertEqual(db.customers.insert_one.call_args[0][0]["rewaa_customer_id"], "7")
+        rewaa.get_customer_by_mobile.assert_awaited_once_with("+966501234567")
+
+
+class TestSyncFetchErrors(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        settings_cache.invalidate()
+        self.db = mock_db("settings.update_one", "system_settings.update_one", "system_settings.delete_one")
+        returns(self.db, "settings.find.to_list", [{"key": "sync_enabled", "value": "true"}])
+        returns(self.db, "settings.find_one", {"value": "160110"})
+
+    async def test_unavailable_rewaa_stops_before_the_invoice(self):
+        """Invoices before the failed fetch are committed; the checkpoint stays before it"""
+
+        async def get_invoice_by_number(invoice_number):
+            if invoice_number == 160111:
+                return None
+            raise RewaaUnavailable(f"Invoice {invoice_number}: HTTP 429")
+
+        with patch("cron_jobs.rewaa_service") as rewaa, \
+                patch("cron_jobs.send_sync_failure_notification", new_callable=AsyncMock) as notify:
+            rewaa.get_invoice_by_number = AsyncMock(side_effect=get_invoice_by_number)
+            result = await sync_invoices_once(self.db)
+
+        self.assertEqual(result["status"], "failed")
+        self.assertIn("160112", result["error"])
+        checkpoints = [
+            call[0][1]["$set"]["value"] for call in self.db.settings.update_one.call_args_list
+            if call[0][0] == {"key": "last_synced_invoice"}
+        ]
+        self.assertEqual(checkpoints, ["160111"])
+        notify.assert_awaited_once()
+        self.db.system_settings.delete_one.assert_awaited_once()
+
+    async def test_failed_run_reports_the_committed_invoices(self):
+        returns(self.db, "customers.find_one", {"id": "c1", "name": "Customer"})
+
+        async def get_invoice_by_number(invoice_number):
+            if invoice_number == 160111:
+                return {"mobileNumber": "0501234567", "totalTaxInclusive": 200}
+            raise RewaaUnavailable(f"Invoice {invoice_number}: HTTP 429")
+
+        with patch("cron_jobs.rewaa_service") as rewaa, \
+                patch("cron_jobs.send_sync_failure_notification", new_callable=AsyncMock), \
+                patch.object(InvoiceCommitBuffer, "flush", new_callable=AsyncMock, return_value=1):
+            rewaa.get_invoice_by_number = AsyncMock(side_effect=get_invoice_by_number)
+            result = await sync_invoices_once(self.db)
+
+        self.assertEqual((result["status"], result["synced_count"]), ("failed", 1))
+        self.db.customers.find_one.assert_awaited_once_with({"phone": "+966501234567"}, {"_id": 0})
+
+    async def test_run_is_skipped_while_another_holds_the_lease(self):
+        self.db.system_settings.update_one.side_effect = DuplicateKeyError("key_unique")
+
+        with patch("cron_jobs.rewaa_service") as rewaa:
+            result = await sync_invoices_once(self.db)
+
+        self.assertEqual(result, {"status": "busy", "synced_count": 0})
+        rewaa.get_invoice_by_number.assert_not_called()
+        self.db.settings.update_one.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the redemption outbox
+Tests the guarded redemption and the ledger drain in ledger_outbox.py
+"""
+
+import unittest
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from tests.helpers import NOW, mock_db, returns
+from ledger_outbox import drain_customer, drain_pending_ledger, redeem_points
+
+
+def redemption(transaction_id="tx-1", points=50):
+    return {
+        "id": transaction_id,
+        "transaction_type": "redeemed",
+        "points": -points,
+        "description": "Redeemed",
+        "created_at": NOW
+    }
+
+
+class TestRedeemPoints(unittest.IsolatedAsyncioTestCase):
+
+    async def test_single_guarded_update(self):
+        db = mock_db()
+        returns(db, "customers.find_one_and_update", {"id": "c1", "active_points": 50})
+        entry = redemption()
+
+        customer = await redeem_points(db, "+966501234567", 50, entry)
+
+        self.assertEqual(customer["active_points"], 50)
+        db.customers.find_one_and_update.assert_awaited_once()
+        query, update = db.customers.find_one_and_update.call_args[0]
+        self.assertEqual(query, {"phone": "+966501234567", "active_points": {"$gte": 50}})
+        self.assertEqual(update["$inc"], {"active_points": -50, "redeemed_points": 50})
+        self.assertEqual(update["$push"], {"pending_ledger": entry})
+        self.assertEqual(db.customers.find_one_and_update.call_args[1]["return_document"], ReturnDocument.AFTER)
+
+    async def test_insufficient_balance_returns_none(self):
+        db = mock_db()
+        returns(db, "customers.find_one_and_update", None)
+        self.assertIsNone(await redeem_points(db, "+966501234567", 500, redemption()))
+
+
+@patch("ledger_outbox.bump_report_generation", new_callable=AsyncMock)
+@patch("ledger_outbox.consume_lots", new_callable=AsyncMock, return_value=([], 0))
+class TestDrain(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.db = mock_db(
+            "customers.update_one", "points_transactions.insert_one", "points_transactions.find_one",
+            "points_transactions.update_one", "daily_stats.bulk_write"
+        )
+        self.pending = returns(self.db, "customers.find_one", {"pending_ledger": [redemption()]})
+
+    async def test_entry_moves_to_the_ledger(self, consume, bump):
+        self.assertEqual(await drain_customer(self.db, "c1"), 1)
+
+        transaction = self.db.points_transactions.insert_one.call_args[0][0]
+        self.assertEqual((transaction["id"], transaction["customer_id"]), ("tx-1", "c1"))
+        self.assertEqual(transaction["pending_steps"], ["lots", "stats"])
+        self.db.daily_stats.bulk_write.assert_awaited_once()
+        consume.assert_awaited_once_with(self.db, "c1", 50, transaction_id="tx-1")
+        self.assertEqual(
+            [call[0] for call in self.db.points_transactions.update_one.call_args_list],
+            [({"id": "tx-1"}, {"$pull": {"pending_steps": "lots"}}), ({"id": "tx-1"}, {"$unset": {"pending_steps": ""}})]
+        )
+        self.db.customers.update_one.assert_awaited_once_with({"id": "c1"}, {"$pull": {"pending_ledger": {"id": "tx-1"}}})
+        bump.assert_awaited_once()
+
+    async def test_finished_entry_is_only_pulled(self, consume, bump):
+        self.db.points_transactions.insert_one.side_effect = DuplicateKeyError("duplicate key")
+        self.db.points_transactions.find_one.return_value = {}
+
+        await drain_customer(self.db, "c1")
+
+        self.db.daily_stats.bulk_write.assert_not_awaited()
+        consume.assert_not_awaited()
+        self.db.customers.update_one.assert_awaited_once()
+
+    async def test_interrupted_drain_finishes_pending_steps(self, consume, bump):
+        """Written by a drain that stopped before the lots and the rollup"""
+        self.db.points_transactions.insert_one.side_effect = DuplicateKeyError("duplicate key")
+        self.db.points_transactions.find_one.return_value = {"pending_steps": ["lots", "stats"]}
+
+        await drain_customer(self.db, "c1")
+
+        consume.assert_awaited_once_with(self.db, "c1", 50, transaction_id="tx-1")
+        self.db.daily_stats.bulk_write.assert_awaited_once()
+        self.db.customers.update_one.assert_awaited_once()
+
+    async def test_failed_rollup_stays_pending(self, consume, bump):
+        self.db.daily_stats.bulk_write.side_effect = RuntimeError("down")
+
+        with self.assertRaises(RuntimeError):
+            await drain_customer(self.db, "c1")
+
+        self.assertEqual(self.db.points_transactions.update_one.await_count, 1)
+        self.db.customers.update_one.assert_not_awaited()
+
+    async def test_nothing_pending(self, consume, bump):
+        self.pending.return_value = {"pending_ledger": []}
+        self.assertEqual(await drain_customer(self.db, "c1"), 0)
+        bump.assert_not_awaited()
+
+    async def test_sweep_counts_errors_and_continues(self, consume, bump):
+        returns(self.db, "customers.find.to_list", [{"id": "c1"}, {"id": "c2"}])
+        self.db.customers.update_one.side_effect = [RuntimeError("down"), None]
+
+        stats = await drain_pending_ledger(self.db)
+
+        self.assertEqual((stats["customers"], stats["entries"], stats["errors"]), (1, 1, 1))
+        self.assertEqual(self.db.customers.find.call_args[0][0], {"pending_ledger.id": {"$exists": True}})
+
+
+if __name__ == "__main__":
+    unittest.main()
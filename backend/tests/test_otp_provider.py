@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the async Twilio Verify provider
+Tests OTPProvider in otp_provider.py
+"""
+
+import unittest
+import sys
+from pathlib import Path
+
+import httpx
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from otp_provider import OTPProvider
+
+
+def configured_provider(handler):
+    provider = OTPProvider()
+    provider.account_sid = "AC123"
+    provider.auth_token = "secret"
+    provider.verify_service = "VA123"
+    provider._client = httpx.AsyncClient(
+        base_url="https://verify.twilio.com/v2/Services/VA123",
+        transport=httpx.MockTransport(handler)
+    )
+    return provider
+
+
+class TestOTPProvider(unittest.IsolatedAsyncioTestCase):
+    """Mock mode and Verify API responses"""
+
+    async def test_mock_mode_accepts_only_fixed_code(self):
+        provider = OTPProvider()
+        provider.account_sid = provider.auth_token = provider.verify_service = None
+
+        self.assertTrue(await provider.send_otp("+966550755465"))
+        self.assertTrue(await provider.verify_otp("+966550755465", "1234"))
+        self.assertFalse(await provider.verify_otp("+966550755465", "0000"))
+
+    async def test_send_posts_verification(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(201, json={"status": "pending"})
+
+        provider = configured_provider(handler)
+        self.assertTrue(await provider.send_otp("+966550755465"))
+        self.assertEqual(requests[0].url.path, "/v2/Services/VA123/Verifications")
+        self.assertIn(b"Channel=sms", requests[0].content)
+        await provider.close()
+
+    async def test_check_statuses(self):
+        statuses = iter([
+            httpx.Response(200, json={"status": "approved"}),
+            httpx.Response(200, json={"status": "pending"}),
+            httpx.Response(404, json={"code": 20404}),
+        ])
+        provider = configured_provider(lambda request: next(statuses))
+
+        self.assertTrue(await provider.verify_otp("+966550755465", "123456"))
+        self.assertFalse(await provider.verify_otp("+966550755465", "000000"))
+        self.assertFalse(await provider.verify_otp("+966550755465", "123456"))
+        await provider.close()
+
+    async def test_timeout_is_a_failed_check(self):
+        def handler(request):
+            raise httpx.ReadTimeout("timed out", request=request)
+
+        provider = configured_provider(handler)
+        self.assertFalse(await provider.check_otp("+966550755465", "123456"))
+        await provider.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
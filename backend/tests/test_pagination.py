@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for keyset pagination
+Tests cursor encoding and fetch_page in pagination.py
+"""
+
+import unittest
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from audit_log import AuditLogger
+from pagination import InvalidCursor, decode_cursor, encode_cursor, fetch_page, keyset_query
+
+
+def mock_collection(items):
+    find_cursor = MagicMock()
+    find_cursor.sort.return_value = find_cursor
+    find_cursor.skip.return_value = find_cursor
+    find_cursor.limit.return_value = find_cursor
+    find_cursor.to_list = AsyncMock(return_value=items)
+    collection = MagicMock()
+    collection.find.return_value = find_cursor
+    return collection, find_cursor
+
+
+class TestPagination(unittest.IsolatedAsyncioTestCase):
+    """Cursor round trips and page boundaries"""
+
+    def test_cursor_round_trip_keeps_dates(self):
+        created_at = datetime(2025, 1, 31, 12, 30, 15, 250000, tzinfo=timezone.utc)
+        value, item_id = decode_cursor(encode_cursor(created_at, "tx-1"))
+        self.assertEqual(value, created_at)
+        self.assertEqual(item_id, "tx-1")
+
+    def test_invalid_cursor_raises(self):
+        with self.assertRaises(InvalidCursor):
+            decode_cursor("not-a-cursor")
+
+    def test_cursor_values_must_be_plain(self):
+        """A crafted cursor cannot put operators into the keyset query"""
+        for sort_value, item_id in [({"$gt": ""}, "tx-1"), (True, "tx-1"), (None, "tx-1"), ("2025", {"$ne": None})]:
+            with self.subTest(sort_value=sort_value, item_id=item_id), self.assertRaises(InvalidCursor):
+                decode_cursor(encode_cursor(sort_value, item_id))
+        self.assertEqual(decode_cursor(encode_cursor(12.5, "c-1")), (12.5, "c-1"))
+
+    def test_keyset_query_continues_after_last_item(self):
+        created_at = datetime(2025, 1, 31, tzinfo=timezone.utc)
+        query = keyset_query({"customer_id": "c1"}, "created_at", encode_cursor(created_at, "tx-5"))
+        self.assertEqual(query["$and"][0], {"customer_id": "c1"})
+        self.assertEqual(query["$and"][1]["$or"], [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": "tx-5"}}
+        ])
+
+    async def test_next_cursor_only_when_more_items(self):
+        items = [{"id": f"tx-{i}", "created_at": datetime(2025, 1, i, tzinfo=timezone.utc)} for i in (3, 2, 1)]
+        collection, find_cursor = mock_collection(items)
+
+        page, next_cursor = await fetch_page(collection, {}, "created_at", limit=2)
+
+        self.assertEqual([item["id"] for item in page], ["tx-3", "tx-2"])
+        self.assertEqual(decode_cursor(next_cursor)[1], "tx-2")
+        find_cursor.skip.assert_not_called()
+
+        find_cursor.to_list.return_value = items[:1]
+        page, next_cursor = await fetch_page(collection, {}, "created_at", limit=2, cursor=next_cursor)
+        self.assertIsNone(next_cursor)
+
+    async def test_audit_log_page_rejects_invalid_cursor(self):
+        """Not reported as an empty page"""
+        collection, _ = mock_collection([])
+        db = MagicMock(audit_logs=collection)
+        with self.assertRaises(InvalidCursor):
+            await AuditLogger.get_logs_page(db, cursor="not-a-cursor")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the points expiry engine
+Tests batching, guarded lot updates and journal replay in points_expiry.py
+"""
+
+import unittest
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+
+from pymongo.errors import BulkWriteError
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from tests.helpers import NOW, iterates, mock_db, returns
+from points_expiry import apply_batch, build_batch, customer_decrements, expire_points, expiry_transaction_id
+
+
+def lot(lot_id, customer_id, remaining):
+    return {"_id": lot_id, "customer_id": customer_id, "remaining_points": remaining}
+
+
+class TestBuildBatch(unittest.TestCase):
+
+    def test_journal_keeps_remaining_points_per_lot(self):
+        batch = build_batch([lot(1, "a", 10), lot(2, "b", 5)], NOW)
+        self.assertEqual(batch["state"], "pending")
+        self.assertEqual(batch["lots"], [{"_id": 1, "points": 10}, {"_id": 2, "points": 5}])
+
+    def test_decrements_are_summed_per_customer(self):
+        closed = [
+            {"customer_id": "a", "expired_points": 10},
+            {"customer_id": "b", "expired_points": 5},
+            {"customer_id": "a", "expired_points": 2.5},
+        ]
+        self.assertEqual(customer_decrements(closed), [
+            {"customer_id": "a", "points": 12.5, "lots": 2},
+            {"customer_id": "b", "points": 5, "lots": 1},
+        ])
+
+    def test_transaction_ids_are_deterministic(self):
+        self.assertEqual(expiry_transaction_id("b1", "a"), expiry_transaction_id("b1", "a"))
+        self.assertNotEqual(expiry_transaction_id("b1", "a"), expiry_transaction_id("b2", "a"))
+
+
+@patch("points_expiry.bump_report_generation", new_callable=AsyncMock)
+class TestExpirePoints(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.db = mock_db(
+            "points_transactions.bulk_write", "points_transactions.insert_many", "customers.bulk_write",
+            "expiry_batches.insert_one", "expiry_batches.delete_many", "daily_stats.bulk_write", "system_settings.update_one"
+        )
+        returns(self.db, "points_transactions.find.sort.limit.to_list", [])
+        iterates(self.db, "expiry_batches.find.sort", [])
+        self.claim = returns(self.db, "expiry_batches.find_one_and_update", {"state": "pending"})
+
+    def due(self, *lot_batches):
+        """Due lots read per batch, each closed in full by its apply"""
+        returns(self.db, "points_transactions.find.sort.limit.to_list", *lot_batches, [])
+        self.closed(*[
+            [{"customer_id": lot["customer_id"], "expired_points": lot["remaining_points"]} for lot in lots]
+            for lots in lot_batches
+        ])
+
+    def closed(self, *closed_batches):
+        """Lots each apply closed"""
+        returns(self.db, "points_transactions.find.to_list", *closed_batches)
+
+    async def test_one_bulk_write_per_stage_and_batch(self, bump):
+        self.due([lot(1, "a", 10), lot(2, "b", 5), lot(3, "a", 5)])
+
+        stats = await expire_points(self.db, now=NOW, batch_size=100)
+
+        self.db.expiry_batches.insert_one.assert_awaited_once()
+        lot_updates = self.db.points_transactions.bulk_write.call_args[0][0]
+        self.assertEqual(lot_updates[0]._filter, {"_id": 1, "remaining_points": 10})
+        self.assertEqual(lot_updates[0]._doc["$set"]["remaining_points"], 0)
+        transactions = self.db.points_transactions.insert_many.call_args[0][0]
+        self.assertEqual([(t["customer_id"], t["points"]) for t in transactions], [("a", -15), ("b", -5)])
+        self.assertEqual(len(self.db.customers.bulk_write.call_args[0][0]), 2)
+        self.db.daily_stats.bulk_write.assert_awaited_once()
+        bump.assert_awaited_once()
+        self.assertEqual((stats["lots"], stats["customer_updates"], stats["points"], stats["batches"]), (3, 2, 20, 1))
+
+    async def test_runs_until_no_lots_are_due(self, bump):
+        self.due([lot(1, "a", 1), lot(2, "b", 1)], [lot(3, "c", 1)])
+        stats = await expire_points(self.db, now=NOW, batch_size=2)
+        self.assertEqual(stats["batches"], 2)
+        self.assertEqual(self.db.customers.bulk_write.await_count, 2)
+        self.db.points_transactions.find.return_value.sort.return_value.limit.assert_called_with(2)
+
+    async def test_only_closed_lots_are_deducted(self, bump):
+        # Lot 2 was consumed by a redemption between the read and the update
+        self.due([lot(1, "a", 10), lot(2, "b", 5)])
+        self.closed([{"customer_id": "a", "expired_points": 10}])
+        stats = await expire_points(self.db, now=NOW)
+        operations = self.db.customers.bulk_write.call_args[0][0]
+        self.assertEqual([op._filter["id"] for op in operations], ["a"])
+        self.assertEqual((stats["lots"], stats["points"]), (1, 10))
+
+    async def test_pending_batch_is_replayed(self, bump):
+        pending = build_batch([lot(1, "a", 10)], NOW)
+        iterates(self.db, "expiry_batches.find.sort", [pending])
+        self.closed([{"customer_id": "a", "expired_points": 10}])
+        self.db.points_transactions.insert_many.side_effect = BulkWriteError({
+            "writeErrors": [{"code": 11000, "errmsg": "duplicate key"}], "nInserted": 0
+        })
+
+        stats = await expire_points(self.db, now=NOW)
+
+        self.assertEqual(stats["replayed"], 1)
+        update = self.db.customers.bulk_write.call_args[0][0][0]
+        self.assertEqual(update._filter["last_expiry_batch"], {"$ne": pending["_id"]})
+        bump.assert_awaited_once()
+
+    async def test_already_closed_batch_is_not_counted_twice(self, bump):
+        self.closed([{"customer_id": "a", "expired_points": 10}])
+        self.claim.return_value = None
+        await apply_batch(self.db, build_batch([lot(1, "a", 10)], NOW))
+        self.db.daily_stats.bulk_write.assert_not_awaited()
+
+    async def test_other_write_errors_are_raised(self, bump):
+        self.closed([{"customer_id": "a", "expired_points": 10}])
+        self.db.points_transactions.insert_many.side_effect = BulkWriteError({
+            "writeErrors": [{"code": 121, "errmsg": "validation"}], "nInserted": 0
+        })
+        with self.assertRaises(BulkWriteError):
+            await apply_batch(self.db, build_batch([lot(1, "a", 10)], NOW))
+        self.db.customers.bulk_write.assert_not_awaited()
+
+    async def test_dry_run_writes_nothing(self, bump):
+        returns(self.db, "points_transactions.aggregate.to_list", [{"_id": None, "customers": 2, "lots": 3, "points": 20}])
+
+        stats = await expire_points(self.db, now=NOW, dry_run=True)
+
+        self.assertEqual((stats["lots"], stats["customer_updates"], stats["points"]), (3, 2, 20))
+        self.assertTrue(stats["dry_run"])
+        self.db.expiry_batches.insert_one.assert_not_awaited()
+        self.db.customers.bulk_write.assert_not_awaited()
+        self.db.system_settings.update_one.assert_not_awaited()
+        bump.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for points lots
+Tests FIFO consumption, expiring-soon sums and the remaining_points backfill in points_lots.py
+"""
+
+import unittest
+import sys
+from datetime import timedelta
+from pathlib import Path
+from unittest.mock import MagicMock
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from tests.helpers import NOW, iterates, mock_db, returns
+from points_lots import allocate_remaining, backfill_lots, consume_lots, expiring_soon, plan_consumption
+
+
+def open_lot(lot_id, remaining):
+    return {"_id": lot_id, "id": f"lot-{lot_id}", "remaining_points": remaining}
+
+
+class TestPlanning(unittest.TestCase):
+
+    def test_consumption_takes_lots_in_order(self):
+        plan = plan_consumption([open_lot(1, 10), open_lot(2, 10), open_lot(3, 10)], 15)
+        self.assertEqual([(lot["_id"], take) for lot, take in plan], [(1, 10), (2, 5)])
+
+    def test_balance_goes_to_newest_lots(self):
+        newest_first = [{"_id": 3, "points": 10}, {"_id": 2, "points": 10}, {"_id": 1, "points": 10}]
+        allocation, unbacked = allocate_remaining(newest_first, 15)
+        self.assertEqual([(lot["_id"], remaining) for lot, remaining in allocation], [(3, 10), (2, 5), (1, 0)])
+        self.assertEqual(unbacked, 0)
+
+    def test_balance_above_lots_is_unbacked(self):
+        _, unbacked = allocate_remaining([{"_id": 1, "points": 10}], 12)
+        self.assertEqual(unbacked, 2)
+
+
+class TestConsumeLots(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.db = mock_db()
+        self.update = returns(self.db, "points_transactions.update_one", MagicMock(modified_count=1))
+
+    def lots(self, *reads):
+        """Open lots read by each attempt"""
+        return returns(self.db, "points_transactions.find.sort.to_list", *reads)
+
+    def consumed_before(self, points):
+        returns(self.db, "points_transactions.aggregate.to_list", [{"_id": None, "points": points}])
+
+    async def test_whole_lot_is_closed_and_next_is_reduced(self):
+        self.lots([open_lot(1, 10), open_lot(2, 10)])
+
+        consumed, shortfall = await consume_lots(self.db, "c1", 15)
+
+        self.assertEqual(consumed, [{"lot_id": "lot-1", "points": 10}, {"lot_id": "lot-2", "points": 5}])
+        self.assertEqual(shortfall, 0)
+        first, second = self.update.call_args_list
+        self.assertEqual(first[0], ({"_id": 1, "remaining_points": 10}, {"$set": {"remaining_points": 0}}))
+        self.assertEqual(second[0], ({"_id": 2, "remaining_points": {"$gte": 5}}, {"$inc": {"remaining_points": -5}}))
+
+    async def test_lost_race_rereads_the_lots(self):
+        reads = self.lots([open_lot(1, 10)], [open_lot(1, 4)])
+        self.update.side_effect = [MagicMock(modified_count=0), MagicMock(modified_count=1)]
+
+        consumed, shortfall = await consume_lots(self.db, "c1", 4)
+
+        self.assertEqual(consumed, [{"lot_id": "lot-1", "points": 4}])
+        self.assertEqual(reads.await_count, 2)
+
+    async def test_transaction_id_records_and_resumes(self):
+        """A repeated call only takes what the deduction has not taken yet"""
+        self.lots([open_lot(1, 10), open_lot(2, 10)])
+        self.consumed_before(10)
+
+        consumed, shortfall = await consume_lots(self.db, "c1", 15, transaction_id="tx-1")
+
+        self.assertEqual((consumed, shortfall), ([{"lot_id": "lot-1", "points": 5}], 0))
+        lot_filter, update = self.update.call_args[0]
+        self.assertEqual(lot_filter, {"_id": 1, "remaining_points": {"$gte": 5}, "consumed_by.id": {"$ne": "tx-1"}})
+        self.assertEqual(update, {"$inc": {"remaining_points": -5}, "$push": {"consumed_by": {"id": "tx-1", "points": 5}}})
+
+    async def test_partly_taken_lot_gives_the_rest(self):
+        """A lot the deduction already took from is topped up under a guard on the recorded amount"""
+        self.lots([dict(open_lot(1, 6), consumed_by=[{"id": "tx-1", "points": 4}])])
+        self.consumed_before(4)
+
+        consumed, shortfall = await consume_lots(self.db, "c1", 10, transaction_id="tx-1")
+
+        self.assertEqual((consumed, shortfall), ([{"lot_id": "lot-1", "points": 6}], 0))
+        projection = self.db.points_transactions.find.call_args[0][1]
+        self.assertEqual(projection["consumed_by"], {"$elemMatch": {"id": "tx-1"}})
+        lot_filter, update = self.update.call_args[0]
+        self.assertEqual(lot_filter, {
+            "_id": 1, "remaining_points": 6, "consumed_by": {"$elemMatch": {"id": "tx-1", "points": 4}}
+        })
+        self.assertEqual(update, {"$set": {"remaining_points": 0}, "$inc": {"consumed_by.$.points": 6}})
+
+    async def test_fully_consumed_transaction_is_a_no_op(self):
+        self.consumed_before(15)
+
+        self.assertEqual(await consume_lots(self.db, "c1", 15, transaction_id="tx-1"), ([], 0))
+        self.db.points_transactions.find.assert_not_called()
+
+    async def test_shortfall_when_lots_run_out(self):
+        self.lots([open_lot(1, 3)], [])
+        consumed, shortfall = await consume_lots(self.db, "c1", 5)
+        self.assertEqual(shortfall, 2)
+
+
+class TestExpiringSoon(unittest.IsolatedAsyncioTestCase):
+
+    async def test_sum_is_computed_by_one_aggregation(self):
+        db = mock_db()
+        returns(db, "points_transactions.aggregate.to_list", [{"_id": None, "points": 12.5}])
+
+        self.assertEqual(await expiring_soon(db, "c1", now=NOW), 12.5)
+
+        match = db.points_transactions.aggregate.call_args[0][0][0]["$match"]
+        self.assertEqual(match, {
+            "remaining_points": {"$gt": 0},
+            "customer_id": "c1",
+            "expires_at": {"$gte": NOW, "$lte": NOW + timedelta(days=30)}
+        })
+
+    async def test_no_open_lots_is_zero(self):
+        db = mock_db()
+        returns(db, "points_transactions.aggregate.to_list", [])
+        self.assertEqual(await expiring_soon(db, "c1"), 0)
+
+
+class TestBackfill(unittest.IsolatedAsyncioTestCase):
+
+    async def test_remaining_points_follow_active_points(self):
+        db = mock_db("points_transactions.bulk_write", "system_settings.update_one")
+        iterates(db, "customers.find", [
+            {"id": "c1", "active_points": 15},
+            {"id": "c2", "active_points": 7},
+        ])
+        returns(
+            db, "points_transactions.find.sort.to_list",
+            [{"_id": 2, "points": 10}, {"_id": 1, "points": 10}],
+            [{"_id": 3, "points": 5}],
+        )
+
+        stats = await backfill_lots(db, batch_size=2)
+
+        written = [op for call in db.points_transactions.bulk_write.call_args_list for op in call[0][0]]
+        self.assertEqual([(op._filter["_id"], op._doc["$set"]["remaining_points"]) for op in written], [(2, 10), (1, 5), (3, 5)])
+        self.assertEqual(db.points_transactions.bulk_write.await_count, 2)
+        self.assertEqual((stats["lots"], stats["open_lots"], stats["unbacked_points"]), (3, 3, 2))
+        db.system_settings.update_one.assert_awaited_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
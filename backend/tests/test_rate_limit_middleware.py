@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the rate limiting middleware
+Tests route matching and enforcement in rate_limit_middleware.py
+"""
+
+import unittest
+import sys
+from pathlib import Path
+
+from fastapi import APIRouter, FastAPI
+from fastapi.testclient import TestClient
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from rate_limit_middleware import RateLimitMiddleware, RouteTable
+from rate_limiter import RateLimiter
+
+
+def make_app(limiter):
+    app = FastAPI()
+    router = APIRouter(prefix="/api")
+
+    @router.post("/auth/admin/login")
+    async def login():
+        return {"ok": True}
+
+    @router.get("/admin/customers/{customer_id}")
+    async def get_customer(customer_id: str):
+        return {"id": customer_id}
+
+    app.include_router(router)
+    app.add_middleware(RateLimitMiddleware, limiter=limiter)
+    return app
+
+
+class TestRouteTable(unittest.TestCase):
+
+    def test_static_parameterized_and_unknown_paths(self):
+        app = make_app(RateLimiter())
+        table = RouteTable(app.routes, {"default": (100, 60)})
+        self.assertEqual(table.match("/api/auth/admin/login"), "/api/auth/admin/login")
+        self.assertEqual(table.match("/api/admin/customers/abc"), "/api/admin/customers/{customer_id}")
+        self.assertEqual(table.match("/wp-login.php"), "default")
+
+    def test_limits_for_unknown_routes_are_reported(self):
+        app = make_app(RateLimiter())
+        table = RouteTable(app.routes, {"/api/auth/admin/login": (5, 300), "/api/typo": (1, 60), "default": (100, 60)})
+        self.assertEqual(table.unrouted_limits, ["/api/typo"])
+
+
+class TestRateLimitMiddleware(unittest.TestCase):
+
+    def test_listed_route_is_limited_with_headers(self):
+        client = TestClient(make_app(RateLimiter()))
+        responses = [client.post("/api/auth/admin/login") for _ in range(6)]
+
+        self.assertEqual([r.status_code for r in responses], [200] * 5 + [429])
+        self.assertEqual(responses[0].headers["RateLimit-Limit"], "5")
+        self.assertEqual(responses[0].headers["RateLimit-Remaining"], "4")
+        self.assertEqual(responses[0].headers["RateLimit-Policy"], "5;w=300")
+        denied = responses[5]
+        self.assertIn("Retry-After", denied.headers)
+        self.assertIn("Rate limit exceeded", denied.json()["detail"])
+
+    def test_default_limit_is_per_route_template(self):
+        limiter = RateLimiter()
+        limiter.limits["default"] = (2, 60)
+        client = TestClient(make_app(limiter))
+
+        self.assertEqual(client.get("/api/admin/customers/a").status_code, 200)
+        self.assertEqual(client.get("/api/admin/customers/b").status_code, 200)
+        # Same template, different id: still the same bucket
+        self.assertEqual(client.get("/api/admin/customers/c").status_code, 429)
+
+    def test_clients_are_limited_separately(self):
+        client = TestClient(make_app(RateLimiter()))
+        for _ in range(5):
+            client.post("/api/auth/admin/login", headers={"X-Forwarded-For": "1.1.1.1"})
+        self.assertEqual(client.post("/api/auth/admin/login", headers={"X-Forwarded-For": "1.1.1.1"}).status_code, 429)
+        self.assertEqual(client.post("/api/auth/admin/login", headers={"X-Forwarded-For": "2.2.2.2"}).status_code, 200)
+
+    def test_preflight_is_not_counted(self):
+        limiter = RateLimiter()
+        client = TestClient(make_app(limiter))
+        for _ in range(10):
+            client.options("/api/auth/admin/login")
+        self.assertEqual(client.post("/api/auth/admin/login").status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
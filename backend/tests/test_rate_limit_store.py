@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the rate limit stores
+Tests the MongoDB and shared memory backends in rate_limit_store.py
+"""
+
+import asyncio
+import multiprocessing
+import os
+import unittest
+import sys
+import uuid
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from rate_limit_store import MemoryStore, MongoStore, SharedMemoryStore, create_store, roll_window
+
+KEY = "1.2.3.4|/api/auth/customer/send-otp"
+
+
+def _hammer(name, lock_path, attempts, results):
+    """Worker process: try `attempts` requests against a shared limit of 5"""
+    async def main():
+        store = SharedMemoryStore(name=name, slots=64, lock_path=lock_path)
+        allowed = 0
+        for _ in range(attempts):
+            if (await store.hit(KEY, 900, 900, 1.0, 5)).allowed:
+                allowed += 1
+        store.close()
+        return allowed
+    results.put(asyncio.run(main()))
+
+
+class TestRollWindow(unittest.TestCase):
+
+    def test_same_adjacent_and_stale_windows(self):
+        self.assertEqual(roll_window(900, 2, 3, 900, 900), (2, 3))
+        self.assertEqual(roll_window(0, 2, 3, 900, 900), (3, 0))
+        self.assertEqual(roll_window(0, 2, 3, 2700, 900), (0, 0))
+        self.assertEqual(roll_window(None, 0, 0, 900, 900), (0, 0))
+
+
+class TestMongoStore(unittest.IsolatedAsyncioTestCase):
+    """One atomic upsert per decision"""
+
+    async def test_hit_is_one_pipeline_upsert(self):
+        collection = MagicMock()
+        collection.find_one_and_update = AsyncMock(return_value={"prev": 2, "cur": 3, "allowed": True})
+        store = MongoStore(collection)
+
+        counts = await store.hit(KEY, 900, 900, 0.5, 5)
+
+        self.assertEqual(tuple(counts), (True, 2, 3))
+        collection.find_one_and_update.assert_awaited_once()
+        args, kwargs = collection.find_one_and_update.call_args
+        self.assertEqual(args[0], {"_id": KEY})
+        self.assertIsInstance(args[1], list)  # update pipeline
+        self.assertEqual(args[1][0]["$set"]["start"], 900)
+        self.assertIn("expires_at", args[1][0]["$set"])
+        self.assertTrue(kwargs["upsert"])
+
+    async def test_peek_and_reset(self):
+        collection = MagicMock()
+        collection.find_one = AsyncMock(return_value={"start": 0, "prev": 1, "cur": 4})
+        collection.delete_one = AsyncMock()
+        store = MongoStore(collection)
+
+        self.assertEqual(await store.peek(KEY, 900, 900), (4, 0))
+        await store.reset(KEY)
+        collection.delete_one.assert_awaited_once_with({"_id": KEY})
+
+    def test_create_store(self):
+        db = MagicMock()
+        self.assertIsInstance(create_store("mongo", db), MongoStore)
+        self.assertIsInstance(create_store("memory"), MemoryStore)
+        with self.assertRaises(ValueError):
+            create_store("mongo")
+        with self.assertRaises(ValueError):
+            create_store("redis")
+
+
+@unittest.skipUnless(hasattr(os, "fork") and os.path.isdir("/dev/shm"), "POSIX shared memory required")
+class TestSharedMemoryStore(unittest.IsolatedAsyncioTestCase):
+    """Counters shared between processes"""
+
+    def setUp(self):
+        self.name = f"walreef_rl_test_{uuid.uuid4().hex[:8]}"
+        self.lock_path = os.path.join("/tmp", f"{self.name}.lock")
+
+    def tearDown(self):
+        SharedMemoryStore(name=self.name, lock_path=self.lock_path).unlink()
+        if os.path.exists(self.lock_path):
+            os.remove(self.lock_path)
+
+    async def test_limit_and_reset(self):
+        store = SharedMemoryStore(name=self.name, slots=64, lock_path=self.lock_path)
+        results = [await store.hit(KEY, 900, 900, 1.0, 5) for _ in range(6)]
+        self.assertEqual([r.allowed for r in results], [True] * 5 + [False])
+        self.assertEqual(await store.peek(KEY, 1800, 900), (5, 0))
+
+        await store.reset(KEY)
+        self.assertEqual(await store.peek(KEY, 900, 900), (0, 0))
+        store.close()
+
+    async def test_full_table_reuses_slots(self):
+        store = SharedMemoryStore(name=self.name, slots=8, lock_path=self.lock_path)
+        for i in range(50):
+            self.assertTrue((await store.hit(f"10.0.0.{i}|/api", 900, 900, 1.0, 5)).allowed)
+        store.close()
+
+    async def test_waiting_for_the_lock_does_not_block_the_loop(self):
+        import fcntl
+
+        store = SharedMemoryStore(name=self.name, slots=64, lock_path=self.lock_path)
+        other_worker = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(other_worker, fcntl.LOCK_EX)
+
+        hit = asyncio.create_task(store.hit(KEY, 900, 900, 1.0, 5))
+        await asyncio.sleep(0.02)  # the loop keeps running while the hit waits
+        self.assertFalse(hit.done())
+
+        fcntl.flock(other_worker, fcntl.LOCK_UN)
+        os.close(other_worker)
+        self.assertTrue((await asyncio.wait_for(hit, 1)).allowed)
+        store.close()
+
+    def test_workers_share_one_limit(self):
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        workers = [ctx.Process(target=_hammer, args=(self.name, self.lock_path, 10, results)) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+        allowed = sum(results.get(timeout=5) for _ in workers)
+        self.assertEqual(allowed, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
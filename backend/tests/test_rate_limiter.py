@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the rate limiter
+Tests the sliding window counter in rate_limiter.py and the memory store
+"""
+
+import unittest
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+
+from fastapi import HTTPException
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from rate_limit_store import MemoryStore
+from rate_limiter import RateLimiter
+
+OTP = "/api/auth/customer/verify-otp"  # 5 attempts per 300 seconds
+T0 = 3000.0  # start of a 300-second window
+
+
+def make_request(ip="1.2.3.4", path=OTP):
+    request = MagicMock()
+    request.headers = {}
+    request.client.host = ip
+    request.url.path = path
+    return request
+
+
+class TestSlidingWindow(unittest.IsolatedAsyncioTestCase):
+    """Limit, decay across windows and retry hints"""
+
+    async def test_limit_within_one_window(self):
+        limiter = RateLimiter()
+        results = [await limiter.hit("ip", OTP, now=T0 + i) for i in range(6)]
+        self.assertTrue(all(r.allowed for r in results[:5]))
+        self.assertEqual([r.remaining for r in results[:5]], [4, 3, 2, 1, 0])
+        self.assertFalse(results[5].allowed)
+        self.assertGreater(results[5].retry_after, 0)
+
+    async def test_denied_requests_are_not_counted(self):
+        limiter = RateLimiter()
+        for i in range(20):
+            await limiter.hit("ip", OTP, now=T0 + i)
+        self.assertEqual(limiter.store.windows[f"ip|{OTP}"][2], 5)
+
+    async def test_previous_window_decays(self):
+        limiter = RateLimiter()
+        for i in range(5):
+            await limiter.hit("ip", OTP, now=T0 + i)
+        # Start of the next window: the previous 5 still weigh ~5
+        self.assertFalse((await limiter.hit("ip", OTP, now=T0 + 301)).allowed)
+        # Halfway through it they weigh 2.5, so two more fit
+        self.assertTrue((await limiter.hit("ip", OTP, now=T0 + 450)).allowed)
+        self.assertTrue((await limiter.hit("ip", OTP, now=T0 + 451)).allowed)
+        self.assertFalse((await limiter.hit("ip", OTP, now=T0 + 452)).allowed)
+
+    async def test_retry_after_is_accurate(self):
+        limiter = RateLimiter()
+        for i in range(5):
+            await limiter.hit("ip", OTP, now=T0 + i)
+        denied = await limiter.hit("ip", OTP, now=T0 + 10)
+        self.assertFalse(denied.allowed)
+        # Allowed again once the sliding estimate drops below the limit
+        self.assertFalse((await limiter.hit("ip", OTP, now=T0 + 10 + denied.retry_after - 2)).allowed)
+        self.assertTrue((await limiter.hit("ip", OTP, now=T0 + 10 + denied.retry_after)).allowed)
+
+    async def test_gap_longer_than_a_window_resets(self):
+        limiter = RateLimiter()
+        for i in range(5):
+            await limiter.hit("ip", OTP, now=T0 + i)
+        self.assertEqual((await limiter.hit("ip", OTP, now=T0 + 900)).remaining, 4)
+
+    async def test_keys_are_per_ip_and_endpoint(self):
+        limiter = RateLimiter()
+        for i in range(5):
+            await limiter.hit("a", OTP, now=T0 + i)
+        self.assertFalse((await limiter.hit("a", OTP, now=T0 + 5)).allowed)
+        self.assertTrue((await limiter.hit("b", OTP, now=T0 + 5)).allowed)
+        self.assertTrue((await limiter.hit("a", "/api/other", now=T0 + 5)).allowed)
+
+
+class TestBoundedKeys(unittest.IsolatedAsyncioTestCase):
+    """LRU eviction keeps memory bounded"""
+
+    async def test_least_recently_seen_key_is_evicted(self):
+        limiter = RateLimiter(MemoryStore(max_keys=3))
+        for ip in ("a", "b", "c"):
+            await limiter.hit(ip, OTP, now=T0)
+        await limiter.hit("a", OTP, now=T0 + 1)  # "b" is now the oldest
+        await limiter.hit("d", OTP, now=T0 + 2)
+
+        self.assertEqual(len(limiter.store.windows), 3)
+        self.assertNotIn(f"b|{OTP}", limiter.store.windows)
+        self.assertIn(f"a|{OTP}", limiter.store.windows)
+        self.assertEqual(limiter.store.evicted, 1)
+
+
+class TestRequestHelpers(unittest.IsolatedAsyncioTestCase):
+    """check_rate_limit, reset and remaining attempts"""
+
+    async def test_check_rate_limit_raises_429(self):
+        limiter = RateLimiter()
+        request = make_request()
+        for _ in range(5):
+            self.assertTrue(await limiter.check_rate_limit(request))
+        with self.assertRaises(HTTPException) as ctx:
+            await limiter.check_rate_limit(request)
+        self.assertEqual(ctx.exception.status_code, 429)
+        self.assertIn("Retry-After", ctx.exception.headers)
+
+    async def test_forwarded_ip_is_used(self):
+        limiter = RateLimiter()
+        request = make_request(ip="10.0.0.1")
+        request.headers = {"X-Forwarded-For": "5.6.7.8, 10.0.0.1"}
+        await limiter.check_rate_limit(request)
+        self.assertIn(f"5.6.7.8|{OTP}", limiter.store.windows)
+
+    async def test_reset_and_remaining(self):
+        limiter = RateLimiter()
+        request = make_request()
+        self.assertEqual(await limiter.get_remaining_attempts(request), (5, 5))
+        await limiter.check_rate_limit(request)
+        await limiter.check_rate_limit(request)
+        self.assertLessEqual((await limiter.get_remaining_attempts(request))[0], 3)
+
+        await limiter.reset_rate_limit("1.2.3.4", OTP)
+        self.assertEqual(await limiter.get_remaining_attempts(request), (5, 5))
+
+    async def test_store_failure_fails_open(self):
+        store = MagicMock()
+        store.hit = AsyncMock(side_effect=RuntimeError("store down"))
+        limiter = RateLimiter(store)
+        self.assertTrue((await limiter.hit("ip", OTP)).allowed)
+        self.assertEqual(limiter.store_errors, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the points ledger reconciliation
+Tests expected balances, drift detection and guarded repair in reconcile_points.py
+"""
+
+import unittest
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import numpy as np
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from tests.helpers import NOW, iterates, mock_db, returns
+from reconcile_points import FIELDS, compare, drift_report, expected_balances, reconcile_points
+
+
+def ledger_row(customer_id, transaction_type, points, count=1):
+    return {"_id": {"customer_id": customer_id, "transaction_type": transaction_type}, "points": points, "count": count}
+
+
+def customer(customer_id, total, active, expired, redeemed, **extra):
+    return {
+        "id": customer_id, "total_points": total, "active_points": active,
+        "expired_points": expired, "redeemed_points": redeemed, "updated_at": NOW, **extra
+    }
+
+
+class TestExpectedBalances(unittest.TestCase):
+
+    def test_types_move_the_right_balances(self):
+        types = ["earned", "expired", "redeemed", "returned"]
+        expected = expected_balances(
+            1,
+            np.array([0, 0, 0, 0]),
+            np.arange(4),
+            np.array([100.0, -10.0, -30.0, -5.0]),
+            types
+        )
+        self.assertEqual(dict(zip(FIELDS, expected[0])), {
+            "total_points": 95.0, "active_points": 55.0, "expired_points": 10.0, "redeemed_points": 30.0
+        })
+
+    def test_pending_outbox_entries_count_as_ledger(self):
+        balances = {
+            "ids": ["c1"],
+            "stored": np.array([[100.0, 60.0, 0.0, 40.0]]),
+            "updated_at": [NOW],
+            "pending": [{"customer_id": "c1", "transaction_type": "redeemed", "points": -40.0}],
+            "has_pending": np.array([True]),
+        }
+        result = compare(balances, [{"customer_id": "c1", "transaction_type": "earned", "points": 100.0, "count": 1}])
+        self.assertFalse(result["drifts"].any())
+
+
+class TestReconcile(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.db = mock_db("system_settings.update_one")
+        returns(self.db, "expiry_batches.distinct", ["batch-1"])
+        self.unsettled = returns(self.db, "points_transactions.distinct", [])
+        returns(self.db, "customers.bulk_write", MagicMock(modified_count=1, matched_count=1))
+
+    def stored(self, customers, ledger):
+        iterates(self.db, "customers.find", customers)
+        iterates(self.db, "points_transactions.aggregate", ledger)
+
+    async def test_consistent_ledger_has_no_drift(self):
+        self.stored(
+            [customer("c1", 100, 70, 0, 30), customer("c2", 50, 50, 0, 0)],
+            [ledger_row("c1", "earned", 100), ledger_row("c1", "redeemed", -30), ledger_row("c2", "manual_add", 50)]
+        )
+        report = await reconcile_points(self.db)
+        self.assertEqual((report["customers"], report["transactions"], report["drifted_customers"]), (2, 3, 0))
+        self.db.customers.bulk_write.assert_not_awaited()
+
+    async def test_drift_is_reported_and_repaired(self):
+        self.stored(
+            [customer("c1", 100, 100, 0, 0), customer("c2", 50, 50, 0, 0)],
+            [ledger_row("c1", "earned", 100), ledger_row("c1", "expired", -40), ledger_row("c2", "earned", 50),
+             ledger_row("ghost", "earned", 5)]
+        )
+
+        report = await reconcile_points(self.db, repair=True)
+
+        self.assertEqual(report["drifted_customers"], 1)
+        self.assertEqual(report["fields"]["active_points"], {"customers": 1, "points": 40.0})
+        self.assertEqual(report["fields"]["expired_points"], {"customers": 1, "points": -40.0})
+        self.assertEqual(report["worst"][0]["customer_id"], "c1")
+        self.assertEqual(report["orphan_customers"], 1)
+
+        operation = self.db.customers.bulk_write.call_args[0][0][0]
+        self.assertEqual(operation._filter, {"id": "c1", "updated_at": NOW})
+        self.assertEqual(operation._doc["$set"]["active_points"], 60.0)
+        self.assertEqual(operation._doc["$set"]["expired_points"], 40.0)
+        self.assertEqual(report["repair"], {"repaired": 1, "skipped": 0})
+
+    async def test_customers_with_outbox_entries_are_not_repaired(self):
+        pending = [{"id": "tx-1", "transaction_type": "redeemed", "points": -10}]
+        # The entry was drained into the ledger after the balances were read
+        self.stored(
+            [customer("c1", 100, 90, 0, 10, pending_ledger=pending)],
+            [ledger_row("c1", "earned", 100), ledger_row("c1", "redeemed", -10)]
+        )
+
+        report = await reconcile_points(self.db, repair=True)
+
+        self.assertEqual(report["drifted_customers"], 1)
+        self.assertEqual(report["repair"], {"repaired": 0, "skipped": 1})
+        self.db.customers.bulk_write.assert_not_awaited()
+
+    async def test_transactions_awaiting_their_balance_write_are_not_repaired(self):
+        # Balances read, then the sync inserts a transaction whose $inc has not landed yet
+        self.stored(
+            [customer("c1", 100, 100, 0, 0), customer("c2", 50, 50, 0, 0)],
+            [ledger_row("c1", "earned", 120, count=2), ledger_row("c2", "earned", 40)]
+        )
+        self.unsettled.return_value = ["c1"]
+
+        report = await reconcile_points(self.db, repair=True)
+
+        self.assertEqual(report["drifted_customers"], 2)
+        self.assertEqual(report["repair"], {"repaired": 1, "skipped": 1})
+        operations = self.db.customers.bulk_write.call_args[0][0]
+        self.assertEqual([op._filter["id"] for op in operations], ["c2"])
+        query = self.db.points_transactions.distinct.call_args[0][1]
+        self.assertEqual(query["customer_id"], {"$in": ["c1", "c2"]})
+        self.assertEqual(query["$or"], [{"pending_steps": "balance"}, {"expiry_batch": {"$in": ["batch-1"]}}])
+
+    def test_worst_drifts_come_first(self):
+        balances = {
+            "ids": ["a", "b", "c"],
+            "stored": np.array([[1.0, 1.0, 0, 0], [9.0, 9.0, 0, 0], [5.0, 5.0, 0, 0]]),
+            "updated_at": [NOW] * 3,
+            "pending": [],
+            "has_pending": np.zeros(3, dtype=bool),
+        }
+        result = compare(balances, [])
+        report = drift_report(balances, result, top=2)
+        self.assertEqual([item["customer_id"] for item in report["worst"]], ["b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the dashboard report cache
+Tests ReportCache in report_cache.py
+"""
+
+import asyncio
+import unittest
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from report_cache import ReportCache
+
+
+class TestReportCache(unittest.IsolatedAsyncioTestCase):
+    """Test TTL hits, request coalescing and generation invalidation"""
+
+    def setUp(self):
+        self.mock_db = MagicMock()
+        self.mock_db.system_settings.find_one = AsyncMock(return_value={"value": 0})
+        self.calls = 0
+
+    async def compute(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return {"total": self.calls}
+
+    async def test_second_request_is_a_hit(self):
+        cache = ReportCache(ttl=60)
+        response = MagicMock(headers={})
+
+        first = await cache.get(self.mock_db, ("points", "month"), self.compute, response)
+        self.assertEqual(response.headers["X-Cache"], "MISS")
+        second = await cache.get(self.mock_db, ("points", "month"), self.compute, response)
+
+        self.assertEqual(response.headers["X-Cache"], "HIT")
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(first, second)
+        self.assertIn("computed_at", second)
+
+    async def test_concurrent_requests_share_one_computation(self):
+        cache = ReportCache(ttl=60)
+
+        results = await asyncio.gather(*[
+            cache.get(self.mock_db, ("charts", "week"), self.compute) for _ in range(5)
+        ])
+
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(result["total"] == 1 for result in results))
+
+    async def test_cancelled_request_does_not_cancel_the_waiters(self):
+        """The request that started the computation disconnects; the others still get the report"""
+        cache = ReportCache(ttl=60)
+        key = ("charts", "year")
+
+        first = asyncio.create_task(cache.get(self.mock_db, key, self.compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get(self.mock_db, key, self.compute))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        result = await waiter
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+        self.assertEqual((result["total"], self.calls), (1, 1))
+        # The computation finished and was cached despite the cancellation
+        await cache.get(self.mock_db, key, self.compute)
+        self.assertEqual(self.calls, 1)
+
+    async def test_generation_bump_invalidates(self):
+        cache = ReportCache(ttl=60, generation_poll=0)
+        await cache.get(self.mock_db, ("stats",), self.compute)
+
+        # Another process bumped the shared generation
+        self.mock_db.system_settings.find_one.return_value = {"value": 1}
+        result = await cache.get(self.mock_db, ("stats",), self.compute)
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(result["total"], 2)
+
+    async def test_failures_are_not_cached(self):
+        cache = ReportCache(ttl=60)
+        failing = AsyncMock(side_effect=RuntimeError("mongo down"))
+
+        with self.assertRaises(RuntimeError):
+            await cache.get(self.mock_db, ("stats",), failing)
+        result = await cache.get(self.mock_db, ("stats",), self.compute)
+
+        self.assertEqual(result["total"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
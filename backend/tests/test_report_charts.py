@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the report charts
+Tests bucket generation (get_chart_buckets) and series assembly (compute_chart_data) in server.py
+"""
+
+import os
+import unittest
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest.mock import patch
+
+# server.py validates its configuration on import
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test")
+os.environ.setdefault("JWT_SECRET", "test-secret-" + "x" * 32)
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from tests.helpers import mock_db, returns
+import server
+from server import compute_chart_data, get_chart_buckets
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class TestChartBuckets(unittest.TestCase):
+
+    def test_hours_align_and_cross_midnight(self):
+        start, unit, buckets = get_chart_buckets("day", utc(2025, 3, 2, 5, 47, 12))
+
+        self.assertEqual(unit, "hour")
+        self.assertEqual(len(buckets), 24)
+        self.assertEqual(start, utc(2025, 3, 1, 6))
+        self.assertEqual(buckets[-1], (utc(2025, 3, 2, 5), "05:00"))
+        self.assertEqual(buckets[17], (utc(2025, 3, 1, 23), "23:00"))
+        self.assertEqual(buckets[18], (utc(2025, 3, 2, 0), "00:00"))
+
+    def test_days_align_to_midnight(self):
+        start, unit, buckets = get_chart_buckets("week", utc(2025, 3, 2, 23, 59))
+
+        self.assertEqual(unit, "day")
+        self.assertEqual([label for _, label in buckets], ["24/02", "25/02", "26/02", "27/02", "28/02", "01/03", "02/03"])
+        self.assertEqual(start, utc(2025, 2, 24))
+        self.assertEqual(len(get_chart_buckets("month", utc(2025, 3, 2))[2]), 30)
+
+    def test_months_roll_over_january(self):
+        start, unit, buckets = get_chart_buckets("year", utc(2025, 2, 15, 10, 30))
+
+        self.assertEqual(unit, "month")
+        self.assertEqual(start, utc(2024, 3, 1))
+        starts = [bucket_start for bucket_start, _ in buckets]
+        self.assertEqual(starts[-3:], [utc(2024, 12, 1), utc(2025, 1, 1), utc(2025, 2, 1)])
+        self.assertEqual([label for _, label in buckets[-2:]], ["Jan 2025", "Feb 2025"])
+        self.assertEqual(len(set(starts)), 12)
+
+    def test_january_window_starts_in_the_previous_year(self):
+        start, _, buckets = get_chart_buckets("year", utc(2025, 1, 31))
+        self.assertEqual(start, utc(2024, 2, 1))
+        self.assertEqual(buckets[-1][1], "Jan 2025")
+
+    def test_unknown_period_falls_back_to_month(self):
+        _, unit, buckets = get_chart_buckets("decade", utc(2025, 3, 2))
+        self.assertEqual((unit, len(buckets)), ("day", 30))
+
+
+class TestChartSeries(unittest.IsolatedAsyncioTestCase):
+    """Grouped rows are mapped onto every bucket, in order, with zeros for the gaps"""
+
+    NOW = utc(2025, 1, 20, 14, 5)
+
+    def setUp(self):
+        self.db = mock_db()
+
+    def grouped(self, customers_before, new_customers, points, sales):
+        """Rows the chart aggregations return"""
+        returns(self.db, "customers.count_documents", customers_before)
+        returns(self.db, "customers.aggregate.to_list", new_customers, [{"_id": 0, "count": 3}, {"_id": 10, "count": 1}])
+        returns(self.db, "points_transactions.aggregate.to_list", points)
+        returns(self.db, "invoices.aggregate.to_list", sales)
+
+    async def compute(self, period):
+        with patch.object(server, "db", self.db), patch("server.datetime") as clock:
+            clock.now.return_value = self.NOW
+            return await compute_chart_data(period)
+
+    async def test_year_series(self):
+        self.grouped(
+            customers_before=40,
+            new_customers=[{"_id": utc(2024, 12, 1), "count": 5}, {"_id": utc(2025, 1, 1), "count": 2}],
+            points=[{"_id": utc(2025, 1, 1), "earned": 12.345, "redeemed": 3.0}],
+            sales=[{"_id": utc(2024, 12, 1), "total": 99.999, "count": 4}]
+        )
+
+        data = await self.compute("year")
+
+        growth = data["customer_growth"]
+        self.assertEqual(len(growth), 12)
+        self.assertEqual(growth[0], {"date": "Feb 2024", "customers": 40})
+        self.assertEqual([point["customers"] for point in growth[-3:]], [40, 45, 47])
+        self.assertEqual(data["points_comparison"][-1], {"date": "Jan 2025", "earned": 12.35, "redeemed": 3.0})
+        self.assertEqual(data["points_comparison"][-2], {"date": "Dec 2024", "earned": 0, "redeemed": 0})
+        self.assertEqual(data["sales_data"][-2], {"date": "Dec 2024", "sales": 100.0, "invoices": 4})
+        self.assertEqual(data["customer_distribution"], [{"name": "0-10", "value": 3}, {"name": "10-50", "value": 1}])
+
+        # Every series is filtered from the start of the window
+        window_start = utc(2024, 2, 1)
+        self.assertEqual(self.db.customers.count_documents.call_args[0][0], {"created_at": {"$lt": window_start}})
+        match = self.db.invoices.aggregate.call_args[0][0][0]["$match"]
+        self.assertEqual(match, {"invoice_date": {"$gte": window_start}})
+
+    async def test_rows_outside_the_buckets_are_ignored(self):
+        self.grouped(
+            customers_before=0,
+            new_customers=[{"_id": utc(2025, 1, 20, 14), "count": 1}, {"_id": utc(2025, 1, 19, 13), "count": 9}],
+            points=[],
+            sales=[]
+        )
+
+        data = await self.compute("day")
+
+        growth = data["customer_growth"]
+        self.assertEqual((growth[0]["date"], growth[-1]["date"]), ("15:00", "14:00"))
+        self.assertEqual([point["customers"] for point in growth], [0] * 23 + [1])
+        group = self.db.customers.aggregate.call_args_list[0][0][0][1]["$group"]["_id"]
+        self.assertEqual(group, {"$dateTrunc": {"date": "$created_at", "unit": "hour", "timezone": "UTC"}})
+
+
+if __name__ == "__main__":
+    unittest.main()
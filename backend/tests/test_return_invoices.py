@@ -17,29 +17,50 @@ sys.path.append(str(Path(__file__).parent.parent))
 
 from cron_jobs import sync_invoices_once
 from models import Customer, PointsTransaction
+from settings_cache import settings_cache
 
-class TestReturnInvoices(unittest.TestCase):
+def invoices_in_order(*invoices, first_number=160111):
+    """Rewaa mock: answer invoice numbers first_number, first_number + 1, ... in order, then None"""
+    async def get_invoice_by_number(invoice_number):
+        index = invoice_number - first_number
+        return invoices[index] if 0 <= index < len(invoices) else None
+    return get_invoice_by_number
+
+class TestReturnInvoices(unittest.IsolatedAsyncioTestCase):
     """Test return invoice processing logic"""
     
     def setUp(self):
         """Set up test fixtures"""
         self.mock_db = MagicMock()
         
-        # Mock settings
+        # Mock settings: sync_enabled and points_multiplier come from the settings cache
+        settings_cache.invalidate()
+        self.mock_db.settings.find.return_value.to_list = AsyncMock(return_value=[
+            {"key": "sync_enabled", "value": "true"},
+            {"key": "points_multiplier", "value": "10"},
+        ])
         self.mock_db.settings.find_one = AsyncMock()
         self.mock_db.settings.update_one = AsyncMock()
+        self.mock_db.system_settings.find_one = AsyncMock(return_value=None)
         
         # Mock customers collection
         self.mock_db.customers.find_one = AsyncMock()
         self.mock_db.customers.insert_one = AsyncMock()
         self.mock_db.customers.update_one = AsyncMock()
         
-        # Mock invoices collection
-        self.mock_db.invoices.find_one = AsyncMock()
-        self.mock_db.invoices.insert_one = AsyncMock()
+        self.mock_db.customers.bulk_write = AsyncMock()
+        self.mock_db.daily_stats.bulk_write = AsyncMock()
+        self.mock_db.system_settings.update_one = AsyncMock()
+        self.mock_db.daily_stats.update_one = AsyncMock()
+        
+        # Mock invoices collection (batched commit: one insert_many per batch)
+        self.mock_db.invoices.insert_many = AsyncMock()
         
-        # Mock points transactions collection
-        self.mock_db.points_transactions.insert_one = AsyncMock()
+        # Mock points transactions collection (return invoices consume the open lots)
+        self.mock_db.points_transactions.insert_many = AsyncMock()
+        self.mock_db.points_transactions.find.return_value.sort.return_value.to_list = AsyncMock(return_value=[])
+        self.mock_db.points_transactions.aggregate.return_value.to_list = AsyncMock(return_value=[])
+        self.mock_db.points_transactions.update_many = AsyncMock()
         
         # Mock existing customer
         self.mock_customer = {
@@ -57,17 +78,12 @@ class TestReturnInvoices(unittest.TestCase):
         
         # Mock settings responses
         self.mock_db.settings.find_one.side_effect = [
-            {"value": "true"},  # sync_enabled
             {"value": "160110"},  # last_synced_invoice
-            {"value": "10"}  # points_multiplier
         ]
         
         # Mock customer exists
         self.mock_db.customers.find_one.return_value = self.mock_customer
         
-        # Mock no existing invoice
-        self.mock_db.invoices.find_one.return_value = None
-        
         # Mock normal invoice data from Rewaa
         normal_invoice = {
             "id": 160111,
@@ -79,10 +95,9 @@ class TestReturnInvoices(unittest.TestCase):
         
         with patch('cron_jobs.rewaa_service') as mock_rewaa:
             # Mock Rewaa service responses
-            mock_rewaa.get_invoice_by_number.side_effect = [
-                normal_invoice,  # First invoice found
-                None  # No more invoices (triggers max_failures)
-            ]
+            mock_rewaa.get_invoice_by_number = AsyncMock(side_effect=invoices_in_order(
+                normal_invoice  # First invoice found, then no more (triggers max_failures)
+            ))
             
             # Run sync
             result = await sync_invoices_once(self.mock_db)
@@ -92,20 +107,20 @@ class TestReturnInvoices(unittest.TestCase):
             self.assertEqual(result["synced_count"], 1)
             
             # Verify invoice was saved with correct data
-            invoice_call = self.mock_db.invoices.insert_one.call_args[0][0]
+            invoice_call = self.mock_db.invoices.insert_many.call_args[0][0][0]
             self.assertEqual(invoice_call["invoice_number"], 160111)
             self.assertEqual(invoice_call["total_amount"], 100.0)
             self.assertEqual(invoice_call["points_earned"], 10.0)  # 100/10 = 10 points
             self.assertEqual(invoice_call["is_return"], False)
             
             # Verify transaction was created with positive points
-            trans_call = self.mock_db.points_transactions.insert_one.call_args[0][0]
+            trans_call = self.mock_db.points_transactions.insert_many.call_args[0][0][0]
             self.assertEqual(trans_call["transaction_type"], "earned")
             self.assertEqual(trans_call["points"], 10.0)  # Positive points
             self.assertIn("فاتورة رقم 160111", trans_call["description"])
             
             # Verify customer points were increased
-            customer_update_call = self.mock_db.customers.update_one.call_args[0][1]
+            customer_update_call = self.mock_db.customers.bulk_write.call_args[0][0][0]._doc
             self.assertEqual(customer_update_call["$inc"]["active_points"], 10.0)
             self.assertEqual(customer_update_call["$inc"]["total_points"], 10.0)
             
@@ -117,17 +132,12 @@ class TestReturnInvoices(unittest.TestCase):
         
         # Mock settings responses
         self.mock_db.settings.find_one.side_effect = [
-            {"value": "true"},  # sync_enabled
-            {"value": "160110"},  # last_synced_invoice
-            {"value": "10"}  # points_multiplier
+            {"value": "160111"},  # last_synced_invoice
         ]
         
         # Mock customer exists
         self.mock_db.customers.find_one.return_value = self.mock_customer
         
-        # Mock no existing invoice
-        self.mock_db.invoices.find_one.return_value = None
-        
         # Mock return invoice data from Rewaa
         return_invoice = {
             "id": 160112,
@@ -139,10 +149,10 @@ class TestReturnInvoices(unittest.TestCase):
         
         with patch('cron_jobs.rewaa_service') as mock_rewaa:
             # Mock Rewaa service responses
-            mock_rewaa.get_invoice_by_number.side_effect = [
-                return_invoice,  # Return invoice found
-                None  # No more invoices
-            ]
+            mock_rewaa.get_invoice_by_number = AsyncMock(side_effect=invoices_in_order(
+                return_invoice,  # Return invoice found, then no more
+                first_number=160112
+            ))
             
             # Run sync
             result = await sync_invoices_once(self.mock_db)
@@ -152,21 +162,21 @@ class TestReturnInvoices(unittest.TestCase):
             self.assertEqual(result["synced_count"], 1)
             
             # Verify invoice was saved with correct return data
-            invoice_call = self.mock_db.invoices.insert_one.call_args[0][0]
+            invoice_call = self.mock_db.invoices.insert_many.call_args[0][0][0]
             self.assertEqual(invoice_call["invoice_number"], 160112)
             self.assertEqual(invoice_call["total_amount"], 50.0)
             self.assertEqual(invoice_call["points_earned"], -5.0)  # Negative points for return
             self.assertEqual(invoice_call["is_return"], True)
             
             # Verify transaction was created with negative points and correct type
-            trans_call = self.mock_db.points_transactions.insert_one.call_args[0][0]
+            trans_call = self.mock_db.points_transactions.insert_many.call_args[0][0][0]
             self.assertEqual(trans_call["transaction_type"], "returned")  # Return type
             self.assertEqual(trans_call["points"], -5.0)  # Negative points
             self.assertIn("رجيع فاتورة رقم 160112", trans_call["description"])
             self.assertNotIn("expires_at", trans_call)  # No expiry for return transactions
             
             # Verify customer points were decreased
-            customer_update_call = self.mock_db.customers.update_one.call_args[0][1]
+            customer_update_call = self.mock_db.customers.bulk_write.call_args[0][0][0]._doc
             self.assertEqual(customer_update_call["$inc"]["active_points"], -5.0)
             self.assertEqual(customer_update_call["$inc"]["total_points"], -5.0)
             
@@ -178,19 +188,13 @@ class TestReturnInvoices(unittest.TestCase):
         
         # Mock settings responses (multiple calls)
         settings_responses = [
-            {"value": "true"},   # sync_enabled
             {"value": "160110"}, # last_synced_invoice
-            {"value": "10"},     # points_multiplier (normal invoice)
-            {"value": "10"},     # points_multiplier (return invoice)
         ]
         self.mock_db.settings.find_one.side_effect = settings_responses
         
         # Mock customer exists
         self.mock_db.customers.find_one.return_value = self.mock_customer
         
-        # Mock no existing invoices
-        self.mock_db.invoices.find_one.return_value = None
-        
         # Mock mixed invoice data
         normal_invoice = {
             "id": 160111,
@@ -210,11 +214,10 @@ class TestReturnInvoices(unittest.TestCase):
         
         with patch('cron_jobs.rewaa_service') as mock_rewaa:
             # Mock sequence: normal, return, then no more
-            mock_rewaa.get_invoice_by_number.side_effect = [
+            mock_rewaa.get_invoice_by_number = AsyncMock(side_effect=invoices_in_order(
                 normal_invoice,
-                return_invoice,
-                None, None, None, None, None, None, None, None, None  # Trigger max_failures
-            ]
+                return_invoice  # Then nothing more: triggers max_failures
+            ))
             
             # Run sync
             result = await sync_invoices_once(self.mock_db)
@@ -223,10 +226,14 @@ class TestReturnInvoices(unittest.TestCase):
             self.assertEqual(result["status"], "success")
             self.assertEqual(result["synced_count"], 2)
             
-            # Verify both invoices were processed
-            self.assertEqual(self.mock_db.invoices.insert_one.call_count, 2)
-            self.assertEqual(self.mock_db.points_transactions.insert_one.call_count, 2)
-            self.assertEqual(self.mock_db.customers.update_one.call_count, 2)
+            # Verify both invoices were committed in one batch
+            self.assertEqual(len(self.mock_db.invoices.insert_many.call_args[0][0]), 2)
+            self.assertEqual(len(self.mock_db.points_transactions.insert_many.call_args[0][0]), 2)
+            
+            # Verify the customer's points were merged into a single $inc (80/10 - 30/10 = 5)
+            customer_updates = self.mock_db.customers.bulk_write.call_args[0][0]
+            self.assertEqual(len(customer_updates), 1)
+            self.assertEqual(customer_updates[0]._doc["$inc"]["active_points"], 5.0)
             
             print("✅ Mixed invoices processing test passed")
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for Rewaa invoice fetching
+Tests the 404 / retry / give-up handling of RewaaService.get_invoice_by_number
+"""
+
+import unittest
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+
+import httpx
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from rewaa import RewaaService, RewaaUnavailable
+
+
+def authenticated_service(*responses):
+    """Service with a valid token whose invoice requests get `responses` in order"""
+    answers = iter(responses)
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    service = RewaaService()
+    service.id_token = "token"
+    service.token_expires_at = datetime.now(timezone.utc) + timedelta(minutes=30)
+    service._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return service, requests
+
+
+@patch("rewaa.asyncio.sleep", new_callable=AsyncMock)
+class TestGetInvoiceByNumber(unittest.IsolatedAsyncioTestCase):
+
+    async def test_404_is_a_missing_invoice(self, sleep):
+        service, requests = authenticated_service(httpx.Response(404))
+        self.assertIsNone(await service.get_invoice_by_number(160111))
+        self.assertEqual(len(requests), 1)
+        sleep.assert_not_awaited()
+
+    async def test_throttling_is_retried_with_retry_after(self, sleep):
+        service, requests = authenticated_service(
+            httpx.Response(429, headers={"Retry-After": "7"}),
+            httpx.Response(200, json={"id": 160111})
+        )
+        self.assertEqual(await service.get_invoice_by_number(160111), {"id": 160111})
+        sleep.assert_awaited_once_with(7.0)
+
+    async def test_network_error_is_retried(self, sleep):
+        service, requests = authenticated_service(
+            httpx.ConnectTimeout("timed out"),
+            httpx.Response(200, json={"id": 160111})
+        )
+        self.assertEqual(await service.get_invoice_by_number(160111), {"id": 160111})
+        self.assertEqual(len(requests), 2)
+
+    async def test_persistent_failure_raises(self, sleep):
+        service, requests = authenticated_service(*[httpx.Response(503)] * 4)
+        with self.assertRaises(RewaaUnavailable):
+            await service.get_invoice_by_number(160111)
+        self.assertEqual(len(requests), 4)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [1.0, 2.0, 4.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the settings cache
+Tests typed values and invalidation in settings_cache.py
+"""
+
+import unittest
+import sys
+from pathlib import Path
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from tests.helpers import mock_db, returns
+import settings_cache as settings_cache_module
+from settings_cache import SettingsCache, bump_settings_version
+
+
+class TestSettingsCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.db = mock_db("system_settings.update_one")
+        self.settings = returns(self.db, "settings.find.to_list", [{"key": "points_multiplier", "value": "20"}])
+        self.version = returns(self.db, "system_settings.find_one", {"value": 0})
+
+    async def test_values_are_typed_with_defaults(self):
+        self.settings.return_value = [
+            {"key": "points_multiplier", "value": "20"},
+            {"key": "sync_enabled", "value": "true"},
+            {"key": "points_expiry_days", "value": "not a number"},
+        ]
+        cache = SettingsCache()
+        self.assertEqual(await cache.get(self.db, "points_multiplier"), 20.0)
+        self.assertIs(await cache.get(self.db, "sync_enabled"), True)
+        self.assertEqual(await cache.get(self.db, "points_expiry_days"), 365)
+        self.assertEqual(await cache.get(self.db, "points_reward_multiplier"), 10.0)
+
+    async def test_reads_are_served_from_memory(self):
+        cache = SettingsCache(version_poll=60)
+        for _ in range(10):
+            await cache.get(self.db, "points_multiplier")
+        self.assertEqual(cache.loads, 1)
+        self.assertEqual(self.version.await_count, 1)
+
+    async def test_version_change_from_another_process_reloads(self):
+        self.version.return_value = {"value": 3}
+        cache = SettingsCache(version_poll=0)
+        await cache.get(self.db, "points_multiplier")
+
+        self.settings.return_value = [{"key": "points_multiplier", "value": "25"}]
+        self.assertEqual(await cache.get(self.db, "points_multiplier"), 20.0)  # same version
+        self.version.return_value = {"value": 4}
+        self.assertEqual(await cache.get(self.db, "points_multiplier"), 25.0)
+
+    async def test_bump_invalidates_locally_and_shares_version(self):
+        self.settings.return_value = [{"key": "sync_enabled", "value": "true"}]
+        cache = SettingsCache(version_poll=60)
+        original = settings_cache_module.settings_cache
+        settings_cache_module.settings_cache = cache
+        try:
+            self.assertTrue(await cache.get(self.db, "sync_enabled"))
+            self.settings.return_value = [{"key": "sync_enabled", "value": "false"}]
+            await bump_settings_version(self.db)
+            self.assertFalse(await cache.get(self.db, "sync_enabled"))
+            update = self.db.system_settings.update_one.call_args[0]
+            self.assertEqual(update[1]["$inc"], {"value": 1})
+        finally:
+            settings_cache_module.settings_cache = original
+
+
+if __name__ == "__main__":
+    unittest.main()
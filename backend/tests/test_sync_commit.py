@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Unit Tests for the batched invoice commit stage
+Tests InvoiceCommitBuffer in sync_commit.py
+"""
+
+import asyncio
+import unittest
+import sys
+from pathlib import Path
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# Add parent directory to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+from sync_commit import SYNC_LEASE_KEY, InvoiceCommitBuffer, SyncLeaseHeld, invoice_id, invoice_transaction_id
+
+
+NOW = datetime(2025, 1, 31, 12, 0, tzinfo=timezone.utc)
+
+
+def make_entry(invoice_number, customer_id, points, invoice_date=NOW):
+    invoice_doc = {
+        "id": f"inv-{invoice_number}",
+        "invoice_number": invoice_number,
+        "customer_id": customer_id,
+        "total_amount": abs(points) * 10,
+        "invoice_date": invoice_date
+    }
+    transaction_doc = {
+        "id": f"tx-{invoice_number}",
+        "customer_id": customer_id,
+        "transaction_type": "earned" if points >= 0 else "returned",
+        "points": points,
+        "invoice_id": invoice_doc["id"],
+        "created_at": NOW
+    }
+    return invoice_doc, transaction_doc
+
+
+class TestDerivedIds(unittest.TestCase):
+
+    def test_ids_are_stable_per_invoice_number(self):
+        self.assertEqual(invoice_id(160111), invoice_id(160111))
+        self.assertNotEqual(invoice_id(160111), invoice_id(160112))
+        self.assertNotEqual(invoice_id(160111), invoice_transaction_id(160111))
+
+
+class TestInvoiceCommitBuffer(unittest.IsolatedAsyncioTestCase):
+    """Test batching, merging and resume-after-failure of the commit stage"""
+
+    def setUp(self):
+        self.mock_db = MagicMock()
+        self.mock_db.invoices.insert_many = AsyncMock()
+        self.mock_db.points_transactions.insert_many = AsyncMock()
+        self.mock_db.points_transactions.find.return_value.sort.return_value.to_list = AsyncMock(return_value=[
+            {"_id": 1, "id": "lot-1", "remaining_points": 50.0}
+        ])
+        self.mock_db.points_transactions.update_one = AsyncMock(return_value=MagicMock(modified_count=1))
+        self.mock_db.points_transactions.update_many = AsyncMock()
+        self.mock_db.points_transactions.aggregate.return_value.to_list = AsyncMock(return_value=[])
+        self.mock_db.invoices.find.return_value.to_list = AsyncMock(return_value=[])
+        self.mock_db.points_transactions.find.return_value.to_list = AsyncMock(return_value=[])
+        self.mock_db.customers.bulk_write = AsyncMock()
+        self.mock_db.daily_stats.bulk_write = AsyncMock()
+        self.mock_db.system_settings.update_one = AsyncMock()
+        self.mock_db.settings.update_one = AsyncMock()
+
+    async def test_flush_merges_customer_increments(self):
+        """One insert_many per collection and one $inc per customer"""
+        buffer = InvoiceCommitBuffer(self.mock_db, batch_size=10)
+        buffer.add(*make_entry(101, "c1", 10.0))
+        buffer.add(*make_entry(102, "c2", 4.0))
+        buffer.add(*make_entry(103, "c1", -3.0))
+        buffer.advance(105)
+
+        committed = await buffer.flush()
+
+        self.assertEqual(committed, 3)
+        self.assertEqual(len(self.mock_db.invoices.insert_many.call_args[0][0]), 3)
+        self.assertEqual(len(self.mock_db.points_transactions.insert_many.call_args[0][0]), 3)
+
+        operations = self.mock_db.customers.bulk_write.call_args[0][0]
+        increments = {op._filter["id"]: op._doc["$inc"]["active_points"] for op in operations}
+        self.assertEqual(increments, {"c1": 7.0, "c2": 4.0})
+
+        checkpoint = self.mock_db.settings.update_one.call_args[0][1]["$set"]["value"]
+        self.assertEqual(checkpoint, "105")
+
+    async def test_return_invoices_consume_lots(self):
+        """Only return invoices take points out of the open lots, once per retry"""
+        self.mock_db.daily_stats.bulk_write.side_effect = [RuntimeError("mongo down"), None]
+        buffer = InvoiceCommitBuffer(self.mock_db)
+        buffer.add(*make_entry(101, "c1", 10.0))
+        buffer.add(*make_entry(102, "c1", -3.0))
+
+        await buffer.flush(retries=2)
+
+        self.mock_db.points_transactions.update_one.assert_awaited_once()
+        lot_filter, update = self.mock_db.points_transactions.update_one.call_args[0]
+        self.assertEqual(lot_filter, {"_id": 1, "remaining_points": {"$gte": 3.0}, "consumed_by.id": {"$ne": "tx-102"}})
+        self.assertEqual(update["$inc"], {"remaining_points": -3.0})
+
+    async def test_invoices_synced_before_derived_ids_are_dropped(self):
+        """An invoice stored under another id was credited by the run that wrote it"""
+        self.mock_db.invoices.insert_many.side_effect = BulkWriteError(
+            {"writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}], "nInserted": 1}
+        )
+        self.mock_db.invoices.find.return_value.to_list.return_value = [{"id": "legacy-id", "invoice_number": 101}]
+        buffer = InvoiceCommitBuffer(self.mock_db)
+        buffer.add(*make_entry(101, "c1", 10.0))
+        buffer.add(*make_entry(102, "c1", 5.0))
+
+        committed = await buffer.flush()
+
+        self.assertEqual(committed, 1)
+        self.assertEqual(self.mock_db.invoices.insert_many.call_count, 1)
+        transactions = self.mock_db.points_transactions.insert_many.call_args[0][0]
+        self.assertEqual([doc["id"] for doc in transactions], ["tx-102"])
+        operations = self.mock_db.customers.bulk_write.call_args[0][0]
+        self.assertEqual(operations[0]._doc["$inc"]["total_points"], 5.0)
+
+    async def test_rerun_finishes_interrupted_commit(self):
+        """A run that died after the inserts: the re-run only finishes the pending steps"""
+        duplicate = BulkWriteError({"writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}], "nInserted": 0})
+        self.mock_db.invoices.insert_many.side_effect = duplicate
+        self.mock_db.points_transactions.insert_many.side_effect = duplicate
+        stored_invoice, stored_transaction = make_entry(101, "c1", -3.0)
+        stored_transaction.update({"pending_steps": ["balance", "lots", "stats"], "sync_batch": "crashed-batch"})
+        self.mock_db.invoices.find.return_value.to_list.return_value = [stored_invoice]
+        self.mock_db.points_transactions.find.return_value.to_list.return_value = [stored_transaction]
+        self.mock_db.points_transactions.aggregate.return_value.to_list.return_value = [
+            {"_id": {"batch": "crashed-batch", "customer_id": "c1"}, "points": -3.0}
+        ]
+
+        buffer = InvoiceCommitBuffer(self.mock_db)
+        buffer.add(*make_entry(101, "c1", -3.0))
+        committed = await buffer.flush()
+
+        self.assertEqual(committed, 1)
+        operation = self.mock_db.customers.bulk_write.call_args[0][0][0]
+        self.assertEqual(operation._filter, {"id": "c1", "recent_sync_batches": {"$ne": "crashed-batch"}})
+        self.assertEqual(operation._doc["$inc"]["active_points"], -3.0)
+        self.mock_db.points_transactions.update_one.assert_awaited_once()
+        self.mock_db.daily_stats.bulk_write.assert_awaited_once()
+        cleared = [call[0][1] for call in self.mock_db.points_transactions.update_many.call_args_list]
+        self.assertEqual(cleared, [
+            {"$pull": {"pending_steps": "balance"}},
+            {"$pull": {"pending_steps": "lots"}},
+            {"$unset": {"pending_steps": "", "sync_batch": ""}},
+        ])
+
+    async def test_rerun_credits_the_whole_interrupted_batch(self):
+        """The re-run re-fetches a crashed batch over two flushes; each carries the batch sum under one guard"""
+        duplicate = BulkWriteError({"writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}], "nInserted": 0})
+        self.mock_db.invoices.insert_many.side_effect = duplicate
+        self.mock_db.points_transactions.insert_many.side_effect = duplicate
+        stored = [make_entry(101, "c1", 10.0), make_entry(102, "c1", 5.0)]
+        for _, transaction in stored:
+            transaction.update({"pending_steps": ["balance", "stats"], "sync_batch": "crashed-batch"})
+        self.mock_db.points_transactions.aggregate.return_value.to_list.return_value = [
+            {"_id": {"batch": "crashed-batch", "customer_id": "c1"}, "points": 15.0}
+        ]
+
+        buffer = InvoiceCommitBuffer(self.mock_db, batch_size=1)
+        for invoice, transaction in stored:
+            self.mock_db.invoices.find.return_value.to_list.return_value = [invoice]
+            self.mock_db.points_transactions.find.return_value.to_list.return_value = [transaction]
+            buffer.add(*make_entry(invoice["invoice_number"], "c1", transaction["points"]))
+            await buffer.flush()
+
+        operations = [call[0][0][0] for call in self.mock_db.customers.bulk_write.call_args_list]
+        self.assertEqual([op._filter for op in operations], [{"id": "c1", "recent_sync_batches": {"$ne": "crashed-batch"}}] * 2)
+        self.assertEqual([op._doc["$inc"]["total_points"] for op in operations], [15.0, 15.0])
+
+    async def test_overlapping_runs_are_serialized_by_the_lease(self):
+        """A second run flushing while the first one is mid-commit writes nothing"""
+        lease = {}
+
+        async def update_one(query, update, upsert=False):
+            if query.get("key") != SYNC_LEASE_KEY:
+                return
+            owner, now = query["$or"][0]["value.owner"], query["$or"][1]["value.expires_at"]["$lt"]
+            if lease and lease["owner"] != owner and lease["expires_at"] >= now:
+                raise DuplicateKeyError("key_unique")
+            lease.update(update["$set"]["value"])
+
+        async def delete_one(query):
+            if lease.get("owner") == query["value.owner"]:
+                lease.clear()
+
+        async def slow_insert(*args, **kwargs):
+            await asyncio.sleep(0.01)
+
+        self.mock_db.system_settings.update_one.side_effect = update_one
+        self.mock_db.system_settings.delete_one = AsyncMock(side_effect=delete_one)
+        self.mock_db.invoices.insert_many.side_effect = slow_insert
+        first, second = InvoiceCommitBuffer(self.mock_db), InvoiceCommitBuffer(self.mock_db)
+        first.add(*make_entry(101, "c1", 10.0))
+        second.add(*make_entry(101, "c1", 10.0))
+
+        results = await asyncio.gather(first.flush(), second.flush(), return_exceptions=True)
+
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], SyncLeaseHeld)
+        self.assertEqual(self.mock_db.invoices.insert_many.call_count, 1)
+        self.mock_db.customers.bulk_write.assert_awaited_once()
+        self.mock_db.daily_stats.bulk_write.assert_awaited_once()
+
+        await first.release_lease()
+        self.assertTrue(await second.acquire_lease())
+
+    async def test_rerun_skips_finished_commit(self):
+        """Nothing left pending: the re-run writes only the checkpoint"""
+        duplicate = BulkWriteError({"writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}], "nInserted": 0})
+        self.mock_db.invoices.insert_many.side_effect = duplicate
+        self.mock_db.points_transactions.insert_many.side_effect = duplicate
+        stored_invoice, stored_transaction = make_entry(101, "c1", 10.0)
+        self.mock_db.invoices.find.return_value.to_list.return_value = [stored_invoice]
+        self.mock_db.points_transactions.find.return_value.to_list.return_value = [stored_transaction]
+
+        buffer = InvoiceCommitBuffer(self.mock_db)
+        buffer.add(*make_entry(101, "c1", 10.0))
+        await buffer.flush()
+
+        self.mock_db.customers.bulk_write.assert_not_awaited()
+        self.mock_db.daily_stats.bulk_write.assert_not_awaited()
+        self.mock_db.settings.update_one.assert_awaited_once()
+
+    async def test_retry_resumes_after_partial_failure(self):
+        """A failed stage is resumed without re-writing what already succeeded"""
+        failure = BulkWriteError({"writeErrors": [{"index": 1, "code": 6, "errmsg": "network"}], "nInserted": 1})
+        self.mock_db.points_transactions.insert_many.side_effect = [failure, None]
+
+        buffer = InvoiceCommitBuffer(self.mock_db)
+        buffer.add(*make_entry(101, "c1", 10.0))
+        buffer.add(*make_entry(102, "c2", 5.0))
+
+        committed = await buffer.flush(retries=2)
+
+        self.assertEqual(committed, 2)
+        # Invoices were written once; only the unwritten transaction was retried
+        self.assertEqual(self.mock_db.invoices.insert_many.call_count, 1)
+        retried = self.mock_db.points_transactions.insert_many.call_args_list[1][0][0]
+        self.assertEqual([doc["id"] for doc in retried], ["tx-102"])
+        self.assertEqual(self.mock_db.customers.bulk_write.call_count, 1)
+
+    async def test_balance_retry_is_guarded_by_batch(self):
+        """A balance write with an unknown outcome is repeated under the same batch guard"""
+        self.mock_db.customers.bulk_write.side_effect = [RuntimeError("network timeout"), None]
+        buffer = InvoiceCommitBuffer(self.mock_db)
+        buffer.add(*make_entry(101, "c1", 10.0))
+        batch_id = buffer.batch_id
+
+        await buffer.flush(retries=2)
+
+        self.assertEqual(self.mock_db.customers.bulk_write.call_count, 2)
+        for call in self.mock_db.customers.bulk_write.call_args_list:
+            operation = call[0][0][0]
+            self.assertEqual(operation._filter, {"id": "c1", "recent_sync_batches": {"$ne": batch_id}})
+            self.assertEqual(operation._doc["$push"]["recent_sync_batches"]["$each"], [batch_id])
+        self.assertNotEqual(buffer.batch_id, batch_id)
+
+    async def test_daily_stats_merged_per_day(self):
+        """The batch adds one rollup update per day, sales by invoice date"""
+        yesterday = datetime(2025, 1, 30, 18, 0, tzinfo=timezone.utc)
+        buffer = InvoiceCommitBuffer(self.mock_db)
+        buffer.add(*make_entry(101, "c1", 10.0))
+        buffer.add(*make_entry(102, "c2", 4.0, invoice_date=yesterday))
+        buffer.add(*make_entry(103, "c1", -3.0))
+
+        await buffer.flush()
+
+        operations = self.mock_db.daily_stats.bulk_write.call_args[0][0]
+        by_day = {op._filter["day"].day: op._doc for op in operations}
+        self.assertEqual(by_day[31]["$inc"], {"earned": 14.0, "returned": 3.0, "sales": 130.0, "invoice_count": 2})
+        self.assertEqual(by_day[31]["$addToSet"]["active_customer_ids"]["$each"], ["c1", "c2"])
+        self.assertEqual(by_day[30]["$inc"], {"sales": 40.0, "invoice_count": 1})
+
+    async def test_checkpoint_not_written_when_flush_fails(self):
+        """last_synced_invoice only moves after the batch is committed"""
+        self.mock_db.customers.bulk_write.side_effect = RuntimeError("mongo down")
+        buffer = InvoiceCommitBuffer(self.mock_db)
+        buffer.add(*make_entry(101, "c1", 10.0))
+
+        with self.assertRaises(RuntimeError):
+            await buffer.flush(retries=1)
+
+        self.mock_db.settings.update_one.assert_not_called()
+        self.assertEqual(len(buffer), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()